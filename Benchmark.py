@@ -0,0 +1,471 @@
+##################################
+#
+# Desc.:
+#   Times every stage of the pipeline
+#   on synthetic data so speedups and
+#   regressions can be measured
+#   without the real AADR panel and
+#   bam files. Makes a .snp/.ind/.geno
+#   panel (text and packed), sorted
+#   and indexed bam files and .results
+#   files at the sizes asked for, then
+#   reports wall and CPU time,
+#   throughput and peak memory of each
+#   stage.
+#
+#   python Benchmark.py --snps 100000 --individuals 500 --ancient 4
+#
+##################################
+import argparse
+import json
+import os
+import resource
+import shutil
+import time
+import multiprocessing as mp
+import numpy as np
+import pysam
+from concurrent.futures import ProcessPoolExecutor
+import Instrument
+
+groupNames = ["CHB", "CHS", "CDX", "JPT", "KHV", "CEU", "GBR", "FIN", "IBS", "TSI", "YRI", "LWK"]
+bases = "ACGT"
+baseCodes = np.frombuffer(b"ACGT", dtype = np.uint8)
+
+'''
+Lays synthetic SNPs out over chromosomes 1 to 22 in snp file order,
+sorted by position within each chromosome.
+
+snpCount: number of SNP's
+spacing: average distance between SNP's on a chromosome
+seed: random seed
+
+return: list of [chrom, pos, refAllele, newAllele] like readSnpFile() gives
+'''
+def makeSnps(snpCount, spacing = 1000, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    chroms = np.sort(rng.integers(1, 23, snpCount))
+    gaps = rng.integers(1, 2 * spacing, snpCount)
+    snps = []
+    pos = 0
+
+    for i in range(snpCount):
+
+        if (i == 0 or chroms[i] != chroms[i - 1]):
+            pos = 0
+
+        pos += int(gaps[i])
+        ref, alt = rng.choice(4, 2, replace = False)
+        snps.append([str(chroms[i]), str(pos), bases[ref], bases[alt]])
+
+    return(snps)
+
+'''
+Writes a synthetic eigenstrat panel: a .snp file, a .ind file with the
+individuals split evenly over groups, a text .geno file and a packed
+(PACKEDANCESTRYMAP) copy of the same genotypes. About 5% of genotypes
+are missing.
+
+prefix: file name without extension (ex: "bench/panel")
+snps: list of [chrom, pos, refAllele, newAllele] from makeSnps()
+individualCount: number of modern individuals
+groups: list of population labels
+seed: random seed
+blockSize: number of SNP's generated at a time
+
+return: (snpFile, indFile, genoFile, packedGenoFile)
+'''
+def makePanel(prefix, snps, individualCount, groups, seed = 0, blockSize = 50000):
+
+    rng = np.random.default_rng(seed)
+
+    snpFile = open(f"{prefix}.snp", 'w')
+
+    for i in range(len(snps)):
+        snpFile.write(f"rs{i}\t{snps[i][0]}\t0.0\t{snps[i][1]}\t{snps[i][2]}\t{snps[i][3]}\n")
+
+    snpFile.close()
+
+    indFile = open(f"{prefix}.ind", 'w')
+
+    for i in range(individualCount):
+        indFile.write(f"I{i}\t{'MF'[i % 2]}\t{groups[i % len(groups)]}\n")
+
+    indFile.close()
+
+    recordLength = max(48, (individualCount * 2 + 7) // 8)
+    genoFile = open(f"{prefix}.geno", 'wb')
+    packedFile = open(f"{prefix}.pgeno", 'wb')
+    packedFile.write(f"GENO {individualCount} {len(snps)} 0 0".encode().ljust(recordLength, b'\0'))
+
+    for start in range(0, len(snps), blockSize):
+
+        rows = min(blockSize, len(snps) - start)
+        freqs = rng.uniform(0.01, 0.99, (rows, 1))
+        genotypes = rng.binomial(2, freqs, (rows, individualCount)).astype(np.uint8)
+        genotypes[rng.random((rows, individualCount)) < 0.05] = 9
+
+        text = np.full((rows, individualCount + 1), ord('\n'), dtype = np.uint8)
+        text[:, :individualCount] = genotypes + ord('0')
+        genoFile.write(text.tobytes())
+
+        # 4 individuals a byte, highest bits first, 3 for missing
+        codes = np.where(genotypes == 9, 3, genotypes)
+        padded = np.full((rows, recordLength * 4), 3, dtype = np.uint8)
+        padded[:, :individualCount] = codes
+        padded = padded.reshape(rows, recordLength, 4)
+        packed = (padded[:, :, 0] << 6) | (padded[:, :, 1] << 4) | (padded[:, :, 2] << 2) | padded[:, :, 3]
+        packedFile.write(packed.astype(np.uint8).tobytes())
+
+    genoFile.close()
+    packedFile.close()
+
+    return(f"{prefix}.snp", f"{prefix}.ind", f"{prefix}.geno", f"{prefix}.pgeno")
+
+'''
+Writes a sorted and indexed bam file of reads piled on the SNP's.
+Every SNP gets a Poisson(depth) number of reads at random offsets,
+each showing the ancestral or derived allele (or, rarely, another
+base) with random strand, mapping quality and base qualities.
+
+bamFile: bam file to write, ".sorted.bam" is what PreProcessReads.py reads
+snps: list of [chrom, pos, refAllele, newAllele] from makeSnps()
+depth: average reads per SNP
+readLength: length of each read
+seed: random seed
+'''
+def makeBam(bamFile, snps, depth = 2.0, readLength = 50, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    chromLengths = {}
+
+    for chrom, pos, ref, alt in snps:
+        chromLengths[chrom] = max(chromLengths.get(chrom, 0), int(pos) + readLength)
+
+    contigs = sorted(chromLengths, key = int)
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": chromLengths[contig]} for contig in contigs]}
+    reads = [] # (contig number, start, sequence, reverse, mapping quality)
+    readCounts = rng.poisson(depth, len(snps))
+
+    for i in np.flatnonzero(readCounts):
+
+        chrom, pos, ref, alt = snps[i]
+
+        for each in range(readCounts[i]):
+
+            offset = int(rng.integers(0, readLength))
+            start = max(0, int(pos) - 1 - offset)
+            sequence = bytearray(baseCodes[rng.integers(0, 4, readLength)].tobytes())
+            draw = rng.random()
+            allele = ref if draw < 0.45 else alt if draw < 0.9 else bases[rng.integers(0, 4)]
+            sequence[int(pos) - 1 - start] = ord(allele)
+            reads.append((contigs.index(chrom), start, sequence.decode(), bool(rng.random() < 0.5), int(rng.integers(0, 60))))
+
+    reads.sort()
+    qualities = pysam.qualitystring_to_array("I" * readLength)
+    tempFile = f"{bamFile}.unsorted.bam"
+
+    with pysam.AlignmentFile(tempFile, 'wb', header = header) as outFile:
+
+        for number in range(len(reads)):
+
+            contig, start, sequence, reverse, mappingQuality = reads[number]
+            read = pysam.AlignedSegment()
+            read.query_name = f"r{number}"
+            read.query_sequence = sequence
+            read.flag = 16 if reverse else 0
+            read.reference_id = contig
+            read.reference_start = start
+            read.mapping_quality = mappingQuality
+            read.cigarstring = f"{readLength}M"
+            read.query_qualities = qualities
+            outFile.write(read)
+
+    os.replace(tempFile, bamFile)
+    pysam.index(bamFile)
+
+'''
+Writes a .results file in the layout continuity.py prints, including
+Schraiber's "Reading line" output, for createCSV() and friends.
+
+resultsFile: file to write
+groups: list of 1k genomes groups
+individuals: list of ancient individuals (or sample set names)
+snpCount: SNP's per .reads file, sets how much "Reading line" output there is
+seed: random seed
+'''
+def makeResults(resultsFile, groups, individuals, snpCount, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    readingLines = " ".join(f"Reading line: {line}" for line in range(0, snpCount, 1000))
+    file = open(resultsFile, 'w')
+
+    for group in groups:
+        for individual in individuals:
+
+            falseFit = rng.uniform(0, 0.1, 3)
+            trueFit = rng.uniform(0, 0.1, 2)
+            LRT = rng.uniform(0, 1000)
+
+            file.write(f"{readingLines} [(array({list(falseFit)}), {rng.uniform(1e5, 1e6)}, {{'nit': 13}})]\n")
+            file.write(f"[(array({list(trueFit)}), {rng.uniform(1e5, 1e6)}, {{'nit': 12}})]\n")
+            file.write(f"1k genomes group: {group}\nAncient Individual: {individual}\n")
+            file.write(f"t1 continuity false:\n{falseFit}\nt2 continuity false: \n{rng.uniform(1e5, 1e6)}\ncontinuity false error: \n")
+            file.write(f"t1 continuity true: \n{trueFit}\nt2 continuity true:\n0\ncontinuity true error: \n")
+            file.write(f"LRT: \n[{LRT}]\nP values: \n[{-LRT / 2}]\n\n\n")
+
+    file.close()
+
+def fileSizes(fileNames):
+    return(sum(os.path.getsize(each) for each in fileNames if os.path.isfile(each)))
+
+'''
+Stage functions. Each runs in a fresh process inside the benchmark
+folder and returns (# SNP's, input bytes) for the throughput numbers.
+'''
+def pileupStage(settings, counting = None):
+    import PreProcessReads
+
+    PreProcessReads.createAncientReads(settings["ancient"], "panel.snp", "", settings["workers"], counting = counting)
+
+    return(settings["snps"], fileSizes([f"{name}.sorted.bam" for name in settings["ancient"]]))
+
+def nativePileupStage(settings):
+    return(pileupStage(settings, {"minBaseQuality": 20, "minMappingQuality": 25, "damageBases": 3}))
+
+def frequencyStage(settings, genoFile = "panel.geno"):
+    import computeAlleleFreq
+
+    computeAlleleFreq.computeAlleleFreqs(genoFile, "panel.ind", "panel.snp", settings["groups"])
+
+    return(settings["snps"], fileSizes([genoFile]))
+
+def packedFrequencyStage(settings):
+    return(frequencyStage(settings, "panel.pgeno"))
+
+def readsStage(settings):
+    import computeAlleleFreq
+
+    os.makedirs("reads", exist_ok = True)
+    os.makedirs("ind", exist_ok = True)
+    nameDict = {name: name for name in settings["ancient"]}
+    computeAlleleFreq.appendAncientIndividuals(settings["groups"], settings["sampleSets"], "AncientReads.output",
+                                               nameDict, "ancient.ind", "reads", "ind")
+
+    return(settings["snps"], fileSizes(["AncientReads.output"] + [f"{group}.output" for group in settings["groups"]]))
+
+def storeStage(settings):
+    import filecmp
+    import ReadStore
+
+    ReadStore.textToStore("AncientReads.output", "AncientReads.store")
+
+    # the reads start at random places, so the default counting's negative "other" counts show up here
+    ReadStore.storeToText("AncientReads.store", "AncientReads.roundtrip")
+
+    if (not filecmp.cmp("AncientReads.output", "AncientReads.roundtrip", shallow = False)):
+        raise RuntimeError("AncientReads.store doesn't give back AncientReads.output")
+
+    return(settings["snps"], fileSizes(["AncientReads.output"]))
+
+def csvStage(settings):
+    import CleanResults
+
+    for each in settings["resultsFiles"]:
+        CleanResults.createCSV(each)
+
+    CleanResults.createCombinedCSV(settings["resultsFiles"], "results.csv")
+
+    return(None, fileSizes(settings["resultsFiles"]) * 2) # every file is read twice
+
+def continuityStage(settings):
+    import continuity
+
+    setNames = ["_".join(individuals) for individuals in settings["sampleSets"]]
+    continuity.runContinuityGrid(settings["groups"], setNames, settings["workers"], 1, "continuity.jsonl")
+    readsFiles = [os.path.join("reads", f"{group}_{name}.reads") for group in settings["groups"] for name in setNames]
+
+    return(settings["snps"] * len(readsFiles), fileSizes(readsFiles))
+
+stages = [("pileup", pileupStage), ("pileup-native", nativePileupStage),
+          ("frequencies", frequencyStage), ("frequencies-packed", packedFrequencyStage),
+          ("reads", readsStage), ("store", storeStage), ("csv", csvStage), ("continuity", continuityStage)]
+
+'''
+Runs one stage and measures it. Meant to run alone in a fresh process so
+the peak memory is the stage's own. stdout goes to {name}.log and the
+stage's progress and timing events to {name}.events.jsonl, so neither
+ends up in the report. With settings["profile"] set, cProfile stats of
+the stage are saved in that folder (see Instrument.py).
+
+name: stage name from stages
+folder: benchmark folder with the synthetic data
+settings: dictionary of benchmark sizes and file lists
+
+return: dictionary of measurements, or the reason the stage was skipped
+'''
+def runStage(name, folder, settings):
+
+    os.chdir(folder)
+    logFile = os.open(f"{name}.log", os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(logFile, 1) # pool workers the stage starts write here too
+    Instrument.configure(f"{name}.events.jsonl", settings.get("profile"))
+
+    function = dict(stages)[name]
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+
+    try:
+        snpCount, inputBytes = function(settings)
+    except ImportError as error:
+        return({"stage": name, "skipped": str(error)})
+
+    seconds = time.perf_counter() - wallStart
+    childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KB on Linux, children is the biggest pool worker
+    peakRss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, childUsage.ru_maxrss) / 1024
+
+    return({"stage": name, "seconds": seconds,
+            "cpuSeconds": time.process_time() - cpuStart + childUsage.ru_utime + childUsage.ru_stime,
+            "snpsPerSecond": None if snpCount == None else snpCount / seconds,
+            "mbPerSecond": inputBytes / 1e6 / seconds, "peakRssMB": peakRss})
+
+'''
+Makes the synthetic data set in folder.
+
+folder: folder to make it in
+snpCount: number of SNP's
+individualCount: number of modern individuals in the panel
+ancientCount: number of ancient bam files
+groupCount: number of modern populations
+depth: average reads per SNP in each bam file
+resultsCount: number of .results files
+seed: random seed
+
+return: settings dictionary for the stages
+'''
+def makeData(folder, snpCount, individualCount, ancientCount, groupCount, depth, resultsCount, workers, seed = 0):
+
+    os.makedirs(folder, exist_ok = True)
+    groups = groupNames[:groupCount]
+    ancient = [f"ANC{i}" for i in range(ancientCount)]
+
+    snps = makeSnps(snpCount, seed = seed)
+    makePanel(os.path.join(folder, "panel"), snps, individualCount, groups, seed)
+
+    for i in range(ancientCount):
+        makeBam(os.path.join(folder, f"{ancient[i]}.sorted.bam"), snps, depth, seed = seed + i + 1)
+
+    ancientInd = open(os.path.join(folder, "ancient.ind"), 'w')
+
+    for name in ancient:
+        ancientInd.write(f"{name}\tM\tAncient{name}\n")
+
+    ancientInd.close()
+
+    # each individual on its own plus everyone together
+    sampleSets = [[name] for name in ancient]
+
+    if (ancientCount > 1):
+        sampleSets.append(ancient)
+
+    resultsFiles = []
+
+    for i in range(resultsCount):
+        resultsFiles.append(f"run{i}.results")
+        makeResults(os.path.join(folder, resultsFiles[-1]), groups, ["_".join(each) for each in sampleSets], snpCount, seed + i)
+
+    return({"snps": snpCount, "individuals": individualCount, "ancient": ancient, "groups": groups,
+            "sampleSets": sampleSets, "resultsFiles": resultsFiles, "depth": depth, "workers": workers})
+
+'''
+Times every stage in order (later stages use earlier stages' outputs),
+each in its own fresh process.
+
+folder: benchmark folder from makeData()
+settings: settings from makeData()
+stageNames: stages to run, all of them if None
+
+return: list of measurement dictionaries
+'''
+def runBenchmark(folder, settings, stageNames = None):
+
+    measurements = []
+    spawn = mp.get_context("spawn") # a fresh interpreter, so no memory is inherited from this one
+
+    for name, function in stages:
+
+        if (stageNames != None and name not in stageNames):
+            continue
+
+        with ProcessPoolExecutor(max_workers = 1, mp_context = spawn) as pool:
+            measurement = pool.submit(runStage, name, os.path.abspath(folder), settings).result()
+
+        measurements.append(measurement)
+
+    return(measurements)
+
+def printReport(settings, measurements):
+
+    print(f"{settings['snps']} SNP's, {settings['individuals']} modern individuals, {len(settings['groups'])} groups, "
+          f"{len(settings['ancient'])} bam files at {settings['depth']}x, {settings['workers']} workers")
+    print(f"{'stage':<20}{'wall s':>10}{'cpu s':>10}{'SNPs/s':>14}{'MB/s':>10}{'peak MB':>10}")
+
+    for each in measurements:
+
+        if ("skipped" in each):
+            print(f"{each['stage']:<20}skipped: {each['skipped']}")
+            continue
+
+        snpRate = "-" if each["snpsPerSecond"] == None else f"{each['snpsPerSecond']:.0f}"
+        print(f"{each['stage']:<20}{each['seconds']:>10.2f}{each['cpuSeconds']:>10.2f}{snpRate:>14}{each['mbPerSecond']:>10.1f}{each['peakRssMB']:>10.0f}")
+
+#############################
+#
+# Main
+#
+#############################
+
+# guard keeps process pool workers from re-running the main block
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Times each pipeline stage on synthetic data.")
+    parser.add_argument("--snps", type = int, default = 100000, help = "SNP's in the panel")
+    parser.add_argument("--individuals", type = int, default = 500, help = "modern individuals in the panel")
+    parser.add_argument("--ancient", type = int, default = 4, help = "ancient bam files")
+    parser.add_argument("--groups", type = int, default = 6, help = f"modern populations (up to {len(groupNames)})")
+    parser.add_argument("--depth", type = float, default = 2.0, help = "average reads per SNP in each bam file")
+    parser.add_argument("--results", type = int, default = 6, help = ".results files for the csv stage")
+    parser.add_argument("--workers", type = int, default = 1, help = "processes for the pileup and continuity stages")
+    parser.add_argument("--stages", nargs = "+", choices = [name for name, function in stages], help = "only run these stages")
+    parser.add_argument("--folder", default = "benchmark", help = "folder for the synthetic data")
+    parser.add_argument("--output", help = "append a JSON line per stage to this file for tracking runs")
+    parser.add_argument("--keep", action = "store_true", help = "keep the synthetic data afterwards")
+    parser.add_argument("--profile", help = "folder for cProfile .prof files of each stage")
+    parser.add_argument("--seed", type = int, default = 0)
+    arguments = parser.parse_args()
+
+    settings = makeData(arguments.folder, arguments.snps, arguments.individuals, arguments.ancient,
+                        min(arguments.groups, len(groupNames)), arguments.depth, arguments.results, arguments.workers, arguments.seed)
+
+    if (arguments.profile != None): # stages run inside the benchmark folder
+        settings["profile"] = os.path.abspath(arguments.profile)
+
+    measurements = runBenchmark(arguments.folder, settings, arguments.stages)
+    printReport(settings, measurements)
+
+    if (arguments.output != None):
+        outFile = open(arguments.output, 'a')
+
+        for each in measurements:
+            record = dict(each)
+            record.update({key: settings[key] for key in ("snps", "individuals", "depth", "workers")})
+            record.update({"ancient": len(settings["ancient"]), "groups": len(settings["groups"]), "time": time.time()})
+            outFile.write(f"{json.dumps(record)}\n")
+
+        outFile.close()
+
+    if (not arguments.keep):
+        shutil.rmtree(arguments.folder)
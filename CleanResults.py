@@ -13,6 +13,9 @@
 #   to be piped into a file.
 #
 ##################################
+import json
+import os
+
 '''
 Uses .results file to create a .csv that
 contains the 1k genome population, ancient
@@ -22,7 +25,7 @@ value, and the p value.
 '''
 def createCSV(fileName):
     file = open(fileName, 'r')
-    fileName = fileName.strip(".results")
+    fileName = os.path.splitext(fileName)[0] # strip(".results") would also eat trailing letters of the name
     newFile = open(f"{fileName}.csv", 'w')
     newFile.write("population,individual,continuity_false_t1,continuity_false_t2,continuity_true_t1,continuity_true_t2,LRT,p\n") # creates header
 
@@ -74,6 +77,90 @@ def createCSV(fileName):
     file.close()
     newFile.close()
 
+'''
+Converts any number of .results files into one combined .csv in a single
+streaming pass over each file. "Reading line" output is skipped as it's
+read, so no cleaned_ copy is needed. Each row gets a run column with the
+.results file name (without extension) and values are written as numbers.
+A sample set with individuals from more than one population gets a row
+per population (numbered in the order of its LRT and p values). Only the
+first population's t1 and t2 are printed, so they're empty on the other
+rows, as are values an older run didn't print.
+"run" | "population" | "individual" | "population_index" | ... | "LRT" | "p"
+
+fileNames: list of .results files
+outFileName: combined .csv file to write. WILL OVERWRITE.
+'''
+def createCombinedCSV(fileNames, outFileName = "results.csv"):
+    columns = ["population", "individual", "population_index", "continuity_false_t1", "continuity_false_t2",
+               "continuity_true_t1", "continuity_true_t2", "LRT", "p"]
+    firstOnly = ["continuity_false_t1", "continuity_false_t2", "continuity_true_t1", "continuity_true_t2"]
+
+    newFile = open(outFileName, 'w')
+    newFile.write(f"run,{','.join(columns)}\n") # creates header
+
+    # line that comes before each value we want -> which value it is
+    labels = {"t1 continuity false:": "false", "t1 continuity true:": "true", "LRT:": "LRT", "P values:": "p"}
+
+    for fileName in fileNames:
+        file = open(fileName, 'r')
+        run = os.path.splitext(os.path.basename(fileName))[0]
+        row = {}
+        expecting = None # which value the next line holds
+
+        for line in file:
+
+            if (line.startswith("Reading line")): # noise from Schraiber's parser
+                continue
+
+            line = line.strip()
+
+            if (expecting != None):
+                values = line.strip("[]").split()
+
+                if (expecting == "false"):
+                    row["continuity_false_t1"] = float(values[0])
+                    row["continuity_false_t2"] = float(values[1])
+                elif (expecting == "true"):
+                    row["continuity_true_t1"] = float(values[0])
+                else:
+                    row[expecting] = [float(value) for value in values] # one per population
+
+                if (expecting == "p" and "individual" in row): # last value of a result
+                    row["continuity_true_t2"] = 0 if "continuity_true_t1" in row else "" # t2 is fixed at 0 with continuity
+
+                    for index in range(len(row["p"])):
+
+                        popRow = dict(row, population_index = index, p = row["p"][index])
+                        popRow["LRT"] = row["LRT"][index] if index < len(row.get("LRT", [])) else ""
+
+                        if (index > 0): # only the first population's estimates are printed
+                            for column in firstOnly:
+                                popRow[column] = ""
+
+                        newFile.write(f"{run},{','.join(str(popRow.get(column, '')) for column in columns)}\n") # older runs didn't print every value
+
+                    row = {}
+
+                expecting = None
+
+            elif (line.startswith("1k genomes group:")):
+                row = {"population": line.split()[3]}
+
+            elif (line.startswith("Ancient Individual:")):
+
+                if ("individual" in row): # result without a group line
+                    row = {}
+
+                row["individual"] = line.split()[2]
+
+            elif (line in labels):
+                expecting = labels[line]
+
+        file.close()
+
+    newFile.close()
+
 '''
 Cleans .results file from running continuity.py.
 Removes "Reading line:" parts due to not
@@ -92,11 +179,66 @@ def cleanResults(fileName):
         if(not line.startswith("Reading line")):
             newFile.write(line)
 
+'''
+Loads the result records written by continuity.py
+(runContinuityGrid() with a resultsFile). One record per
+line, so no scanning for "Reading line" or print layout.
+
+fileName: .jsonl file of result records
+
+return: list of dictionaries, one per record
+'''
+def readRecords(fileName):
+    file = open(fileName, 'r')
+    records = []
+
+    for line in file:
+
+        if (line.strip()): # skip blank lines
+            records.append(json.loads(line))
+
+    file.close()
+
+    return(records)
+
+'''
+Uses a .jsonl file of result records to create a .csv with
+the same columns as createCSV(), plus the population label
+of the ancient individual(s) from the .ind file.
+"population" | "individual" | "ancient_population" | ... | "LRT" | "p"
+'''
+def recordsToCSV(fileName):
+    columns = ["population", "individual", "ancient_population",
+               "continuity_false_t1", "continuity_false_t2",
+               "continuity_true_t1", "continuity_true_t2", "LRT", "p"]
+
+    newFile = open(f"{os.path.splitext(fileName)[0]}.csv", 'w')
+    newFile.write(f"{','.join(columns)}\n") # creates header
+
+    for record in readRecords(fileName):
+        newFile.write(f"{','.join(str(record[column]) for column in columns)}\n")
+
+    newFile.close()
+
 #############################
 #
 # Main
 #
 #############################
 
-fileName = "CHB_CHS_CDX_JPT_KHV_CEU_uncontaminated_X.results"
-createCSV(fileName)
\ No newline at end of file
+# guard lets the pipeline driver import this file without running it
+if __name__ == "__main__":
+
+    '''
+    fileName = "CHB_CHS_CDX_JPT_KHV_CEU_uncontaminated_X.results"
+    createCSV(fileName)
+    '''
+
+    # every run in one table, run column tells them apart
+    fileNames = ["CHB_CHS_CDX_JPT.results",
+                 "CHB_CHS_CDX_JPT_KHV_CEU_filtered_grouped.results",
+                 "CHB_CHS_CDX_JPT_KHV_CEU_filtered_ungrouped.results",
+                 "CHB_CHS_CDX_JPT_KHV_CEU_old.results",
+                 "CHB_CHS_CDX_JPT_KHV_CEU_uncontaminated_X.results",
+                 "CHB_CHS_CDX_JPT_KHV_CEU_unfiltered_reads.results"]
+    createCombinedCSV(fileNames, "results.csv")
@@ -0,0 +1,221 @@
+########################################
+#
+# Description:
+#   Progress and timing events for the
+#   long running steps. Events are JSON
+#   lines written to stderr, or to a log
+#   file, so stdout only ever holds
+#   results. Each step reports how far
+#   along it is with a rate and ETA, and
+#   its wall time, CPU time and peak
+#   memory when it finishes. Steps can
+#   also be run under cProfile to find
+#   where a long job spends its time.
+#
+#   Settings are kept in environment
+#   variables so process pool workers
+#   report to the same place:
+#       CONTINUITY_LOG      log file (stderr if not set)
+#       CONTINUITY_PROFILE  folder for cProfile .prof files
+#       CONTINUITY_INTERVAL seconds between progress events
+#
+########################################
+import contextlib
+import cProfile
+import io
+import json
+import os
+import resource
+import sys
+import time
+
+profilers = {} # stage -> cProfile.Profile, kept so a step run many times by one process adds up
+profiling = [] # stage being profiled in this process, cProfile can only run one at a time
+
+'''
+Sets where events go and whether steps are profiled. Process pool
+workers started afterwards use the same settings.
+
+logFile: file to append events to, None for stderr
+profileDir: Optional folder for a cProfile .prof file per step and process.
+            Look at them with python -m pstats FILE.
+interval: minimum seconds between progress events of a step
+'''
+def configure(logFile = None, profileDir = None, interval = 10):
+
+    for key, value in (("CONTINUITY_LOG", logFile), ("CONTINUITY_PROFILE", profileDir)):
+
+        if (value == None):
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = os.path.abspath(value) # workers may run in another folder
+
+    os.environ["CONTINUITY_INTERVAL"] = str(interval)
+
+    if (profileDir != None):
+        os.makedirs(profileDir, exist_ok = True)
+
+'''
+Writes one event as a JSON line.
+
+event: kind of event ("start", "progress", "finish", ...)
+stage: name of the step it's about
+fields: other values to record
+'''
+def logEvent(event, stage, **fields):
+
+    record = {"time": round(time.time(), 3), "pid": os.getpid(), "event": event, "stage": stage}
+    record.update(fields)
+    line = f"{json.dumps(record)}\n"
+    logFile = os.environ.get("CONTINUITY_LOG")
+
+    if (logFile == None):
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return()
+
+    # one short append per event, so processes sharing the log don't split each other's lines
+    file = open(logFile, 'a')
+    file.write(line)
+    file.close()
+
+'''
+Peak memory so far, in MB.
+
+return: (this process, biggest finished child process)
+'''
+def peakMemory():
+
+    # ru_maxrss is in KB on Linux
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+'''
+Reports how far a step is. Events are only written every interval
+seconds (and always for the last unit), so this can be called as
+often as is convenient.
+
+timer: dictionary from timedStage()
+done: units finished so far
+'''
+def progress(timer, done):
+
+    timer["done"] = done
+    now = time.perf_counter()
+    finished = timer["total"] != None and done >= timer["total"]
+
+    if (now - timer["lastReport"] < float(os.environ.get("CONTINUITY_INTERVAL", 10)) and not finished):
+        return()
+
+    timer["lastReport"] = now
+    seconds = now - timer["wallStart"]
+    rate = done / seconds if seconds > 0 else None
+    fields = {"done": done, "unit": timer["unit"], "rate": None if rate == None else round(rate, 1), "elapsed": round(seconds, 1)}
+
+    if (timer["total"] != None):
+        fields["total"] = timer["total"]
+        fields["eta"] = None if not rate else round((timer["total"] - done) / rate, 1)
+
+    logEvent("progress", timer["stage"], **fields)
+
+'''
+Times a step. Writes a start event, then a finish event with the wall
+time, CPU time (including finished child processes) and peak memory.
+If a profile folder is set, the step runs under cProfile and its
+stats are saved as {stage}.{pid}.prof there. A process that runs the
+same step several times keeps adding to the same stats, and a step
+inside one that is already profiled is counted in the outer step.
+
+    with Instrument.timedStage("frequencies", snpCount, "SNPs") as timer:
+        ...
+        Instrument.progress(timer, snpsDone)
+
+stage: name of the step
+total: Optional number of units the step will do, for the ETA
+unit: what the units are (ex: "SNPs")
+report: if False only profile, without start and finish events
+        (for small steps that run many times, like pool jobs)
+
+return: context manager giving the timer dictionary for progress()
+'''
+@contextlib.contextmanager
+def timedStage(stage, total = None, unit = "items", report = True):
+
+    now = time.perf_counter()
+    timer = {"stage": stage, "total": total, "unit": unit, "done": 0,
+             "wallStart": now, "lastReport": now, "cpuStart": cpuTime()}
+    profileDir = os.environ.get("CONTINUITY_PROFILE")
+    profiler = None
+
+    if (report):
+        logEvent("start", stage, total = total, unit = unit)
+
+    if (profileDir != None and len(profiling) == 0):
+        profiler = profilers.setdefault(stage, cProfile.Profile())
+        profiling.append(stage)
+        profiler.enable()
+
+    try:
+        yield(timer)
+
+    finally:
+        if (profiler != None):
+            profiler.disable()
+            profiling.pop()
+            profiler.dump_stats(os.path.join(profileDir, f"{stage}.{os.getpid()}.prof"))
+
+        if (report):
+            seconds = time.perf_counter() - timer["wallStart"]
+            selfMemory, childMemory = peakMemory()
+            logEvent("finish", stage, done = timer["done"], unit = unit, wall = round(seconds, 3),
+                     cpu = round(cpuTime() - timer["cpuStart"], 3),
+                     rate = round(timer["done"] / seconds, 1) if seconds > 0 else None,
+                     peakMB = round(selfMemory, 1), childPeakMB = round(childMemory, 1))
+
+'''
+CPU seconds used by this process and its finished child processes.
+'''
+def cpuTime():
+
+    selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+    childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return(selfUsage.ru_utime + selfUsage.ru_stime + childUsage.ru_utime + childUsage.ru_stime)
+
+'''
+Keeps what a call prints off stdout. Schraiber's parser prints
+"Reading line: N" every 1000 lines, that becomes a single event with
+the last line number it printed. Anything else is logged as an
+"output" event.
+
+stage: name to log the output under
+fields: other values to record with it (ex: the file being parsed)
+
+return: context manager
+'''
+@contextlib.contextmanager
+def capturedStdout(stage, **fields):
+
+    captured = io.StringIO()
+
+    try:
+        with contextlib.redirect_stdout(captured):
+            yield()
+
+    finally:
+        lastLine = None
+        other = []
+
+        for token in captured.getvalue().replace("Reading line:", "\nReading line:").split("\n"):
+
+            if (token.startswith("Reading line:")):
+                lineNumber = token[len("Reading line:"):].strip()
+                lastLine = int(lineNumber) if lineNumber.isdigit() else lastLine
+            elif (token.strip()):
+                other.append(token.strip())
+
+        if (lastLine != None):
+            logEvent("parsed", stage, lines = lastLine, **fields)
+
+        if (len(other) > 0):
+            logEvent("output", stage, text = "\n".join(other), **fields)
@@ -13,8 +13,14 @@
 #   eigenstrat SNP file
 #
 ########################################
+import json
+import multiprocessing as mp
+import os
 import subprocess as sp
+import numpy as np
 import pysam
+import Instrument
+import ReadStore
 
 '''
 Uses string representing mpileup command to run subprocess and return
@@ -37,6 +43,411 @@ def runSubprocess(command):
 
     return (tokens)
 
+'''
+Reads an eigenstrat SNP file into memory so every bam file can be
+walked against the same list of positions.
+
+snpFile: eigenstrat format snp file
+
+return: list of [chrom, pos, refAllele, newAllele] in snp file order
+'''
+def readSnpFile(snpFile):
+
+    sFile = open(snpFile, 'r')
+    snps = []
+
+    for line in sFile:
+
+        lineList = line.split() # should be in "rsID | chrom | pos | physPos | refAllele | newAllele" format
+        snps.append([lineList[1], lineList[3], lineList[4], lineList[5]])
+
+    sFile.close() # for good practice
+
+    return(snps)
+
+'''
+Groups SNPs by chromosome and sorts them by position so a bam file
+can be swept once per chromosome.
+
+snps: list of [chrom, pos, refAllele, newAllele] from readSnpFile()
+
+return: dictionary of eigenstrat chrom -> list of (pos, [snp indices at pos])
+        sorted by position
+'''
+def groupSnpsByChrom(snps):
+
+    positions = {} # chrom -> {pos: [snp indices]}
+
+    for i in range(len(snps)):
+        chromPositions = positions.setdefault(snps[i][0], {})
+        chromPositions.setdefault(int(snps[i][1]), []).append(i) # same position can show up twice
+
+    chromSnps = {}
+
+    for chrom in positions:
+        chromSnps[chrom] = sorted(positions[chrom].items())
+
+    return(chromSnps)
+
+'''
+Converts the eigenstrat chromosome code into the contig name used
+in the bam files. Eigenstrat codes X as 23 and Y as 24.
+
+chrom: chromosome code from the snp file
+
+return: contig name
+'''
+def contigName(chrom):
+
+    if (chrom == '23'): # if X chromosome
+        return("X")
+
+    elif (chrom == '24'): # if Y chromosome
+        return("Y")
+
+    return(chrom)
+
+# read counting settings, see countColumn()
+defaultCounting = {"minBaseQuality": 13, "minMappingQuality": 0, "clipEnds": 0,
+                   "damageBases": 0, "library": "double"}
+
+'''
+Fills in the settings left out of a read counting dictionary.
+
+counting: dictionary of read counting settings or None
+
+return: None for mpileup counting, otherwise a full settings dictionary
+'''
+def countingSettings(counting):
+
+    if (counting == None):
+        return(None)
+
+    settings = dict(defaultCounting)
+    settings.update(counting)
+
+    if (settings["library"] not in ("double", "single")):
+        raise ValueError(f"library must be \"double\" or \"single\", not {settings['library']}")
+
+    return(settings)
+
+'''
+Counts derived, ancestral and other reads at one SNP straight from the
+reads of a pileup column. Unlike the mpileup read string, bases on both
+strands count, and each base is checked against the settings:
+
+minBaseQuality: bases below this quality are skipped
+minMappingQuality: reads below this mapping quality are skipped
+clipEnds: bases this close to either end of a read are skipped
+damageBases: at C/T and G/A SNPs, a base that could come from ancient
+             DNA deamination is skipped when it's this close to the read
+             end where deamination shows up (0 turns this off, a large
+             number masks the whole read)
+library: "double" or "single" stranded library, decides where deamination
+         shows up. In reference orientation double stranded libraries
+         show C->T near the left end of every read and G->A near the
+         right end. Single stranded libraries show C->T at both ends of
+         forward reads and G->A at both ends of reverse reads.
+
+Deletions and reference skips aren't bases, so they aren't counted.
+
+column: pysam PileupColumn at the SNP
+snp: [chrom, pos, refAllele, newAllele]
+counting: full settings dictionary from countingSettings()
+
+return: (der, anc, other)
+'''
+def countColumn(column, snp, counting):
+
+    anc = snp[2]
+    der = snp[3]
+    alleles = {anc, der}
+    damageBase = None # base a deaminated read shows at this SNP
+
+    if (counting["damageBases"] > 0 and alleles == {'C', 'T'}):
+        damageBase = 'T'
+    elif (counting["damageBases"] > 0 and alleles == {'G', 'A'}):
+        damageBase = 'A'
+
+    derReads = 0
+    ancReads = 0
+    otherReads = 0
+
+    for read in column.pileups:
+
+        if (read.is_del or read.is_refskip):
+            continue
+
+        alignment = read.alignment
+        position = read.query_position
+        qualities = alignment.query_qualities
+
+        if (alignment.mapping_quality < counting["minMappingQuality"]):
+            continue
+
+        if (qualities != None and qualities[position] < counting["minBaseQuality"]):
+            continue
+
+        fromLeft = position
+        fromRight = alignment.query_length - 1 - position
+
+        if (fromLeft < counting["clipEnds"] or fromRight < counting["clipEnds"]):
+            continue
+
+        base = alignment.query_sequence[position].upper()
+
+        if (base == damageBase):
+
+            if (counting["library"] == "double"):
+                fromDamageEnd = fromLeft if base == 'T' else fromRight
+            elif ((base == 'T') != alignment.is_reverse): # C->T on forward reads, G->A on reverse reads
+                fromDamageEnd = min(fromLeft, fromRight)
+            else:
+                fromDamageEnd = None
+
+            if (fromDamageEnd != None and fromDamageEnd < counting["damageBases"]):
+                continue
+
+        if (base == der):
+            derReads += 1
+        elif (base == anc):
+            ancReads += 1
+        else:
+            otherReads += 1
+
+    return(derReads, ancReads, otherReads)
+
+'''
+Counts derived, ancestral and other reads for the SNPs of one chromosome
+with a single pileup sweep. The pileup settings mirror the defaults of
+samtools mpileup (flag filter, orphan and overlap handling, min base
+quality 13, max depth 8000) and the read string is rebuilt exactly as
+mpileup prints it, so counts are identical to running mpileup on each
+position. Given read counting settings, reads are counted with
+countColumn() in the same sweep instead.
+
+bam: open pysam AlignmentFile
+chrom: eigenstrat chromosome code
+positions: sorted list of (pos, [snp indices at pos]) for chrom, from groupSnpsByChrom()
+snps: indexable by snp index, giving [chrom, pos, refAllele, newAllele]
+counting: Optional read counting settings from countingSettings().
+          None counts the way mpileup did.
+
+return: list of (snp index, der, anc, other) for SNPs that had a pileup.
+        SNPs without one have no reads.
+'''
+def countChrom(bam, chrom, positions, snps, counting = None):
+
+    contig = contigName(chrom)
+    covered = []
+
+    if (contig not in bam.references): # no reads for this chromosome
+        return(covered)
+
+    nextSnp = 0 # index into sorted positions we're waiting for
+
+    minBaseQuality = 13 if counting == None else counting["minBaseQuality"]
+    minMappingQuality = 0 if counting == None else counting["minMappingQuality"]
+
+    # pileup works in 0-based coordinates, snp file is 1-based
+    pileup = bam.pileup(contig, positions[0][0] - 1, positions[-1][0], truncate = True,
+                        stepper = "samtools", ignore_orphans = True, ignore_overlaps = True,
+                        min_base_quality = minBaseQuality, min_mapping_quality = minMappingQuality, max_depth = 8000)
+
+    for column in pileup:
+
+        pos = column.reference_pos + 1
+
+        while (nextSnp < len(positions) and positions[nextSnp][0] < pos): # no coverage on skipped SNPs
+            nextSnp += 1
+
+        if (nextSnp == len(positions)):
+            break
+
+        if (positions[nextSnp][0] != pos): # column isn't on a SNP
+            continue
+
+        if (counting != None):
+            for i in positions[nextSnp][1]:
+                covered.append((i,) + countColumn(column, snps[i], counting))
+
+            nextSnp += 1
+            continue
+
+        # same string mpileup gives in its 5th column (read bases with ^, $ and indel marks)
+        totalReads = column.get_num_aligned()
+        reads = ''.join(column.get_query_sequences(mark_matches = False, mark_ends = True, add_indels = True))
+
+        for i in positions[nextSnp][1]:
+            ancReads = reads.count(snps[i][2])
+            derReads = reads.count(snps[i][3])
+            covered.append((i, derReads, ancReads, totalReads - ancReads - derReads))
+
+        nextSnp += 1
+
+    return(covered)
+
+'''
+Counts derived, ancestral and other reads for every SNP of an individual
+by opening its bam file once and sweeping a single pileup over each
+chromosome.
+
+bamFile: sorted and indexed bam file of the individual
+snps: list of [chrom, pos, refAllele, newAllele] from readSnpFile()
+chromSnps: SNPs grouped by groupSnpsByChrom(). Computed if not given.
+counting: Optional read counting settings (see countColumn())
+
+return: numpy array of shape (# SNP's, 3) holding der, anc, other reads
+'''
+def pileupIndividual(bamFile, snps, chromSnps = None, counting = None):
+
+    if (chromSnps == None):
+        chromSnps = groupSnpsByChrom(snps)
+
+    counts = np.zeros((len(snps), 3), dtype = np.int64) # der | anc | other for each SNP
+    bam = pysam.AlignmentFile(bamFile, 'rb')
+
+    for chrom in chromSnps:
+
+        for i, derReads, ancReads, otherReads in countChrom(bam, chrom, chromSnps[chrom], snps, countingSettings(counting)):
+            counts[i] = (derReads, ancReads, otherReads)
+
+    bam.close()
+
+    return(counts)
+
+'''
+Pileup for a single (bam file, chromosome) shard. Used as the
+process pool worker in createAncientReads().
+
+shard: tuple of (individual number, bamFile, chrom, positions, shardSnps, counting)
+       where shardSnps maps the snp indices of chrom to their snp info
+
+return: (individual number, chrom, list of (snp index, der, anc, other))
+'''
+def pileupShard(shard):
+
+    individualNumber, bamFile, chrom, positions, shardSnps, counting = shard
+
+    with Instrument.timedStage("pileupShard", report = False): # only profiled, the pool reports progress
+        bam = pysam.AlignmentFile(bamFile, 'rb')
+        covered = countChrom(bam, chrom, positions, shardSnps, counting)
+        bam.close()
+
+    return(individualNumber, chrom, covered)
+
+'''
+Path of the checkpoint file for a finished (individual, chromosome) shard.
+
+checkpointDir: folder holding the checkpoints
+individual: ancient individual the shard belongs to
+chrom: eigenstrat chromosome code of the shard
+
+return: path to the shard's .npz checkpoint
+'''
+def shardCheckpoint(checkpointDir, individual, chrom):
+
+    return(os.path.join(checkpointDir, f"{individual}.chr{chrom}.npz"))
+
+'''
+Counts der/anc/other reads of each individual at every SNP. Work is split
+into (bam file, chromosome) shards. If a checkpoint folder is given, every
+finished shard is saved there and shards that already have a checkpoint are
+loaded instead of piled up again, so a killed job picks up where it stopped.
+
+individuals: list of ancient individuals who have sorted and
+             indexed bam files available
+snps: list of [chrom, pos, refAllele, newAllele] from readSnpFile()
+chromSnps: SNPs grouped by groupSnpsByChrom()
+bamFilePath: directory path to the bam files
+workers: number of processes. With more than 1 the shards run in a process pool.
+checkpointDir: Optional folder for per-shard checkpoints
+counting: Optional read counting settings (see countColumn())
+
+return: list of (# SNP's, 3) der/anc/other arrays, one per individual
+'''
+def countIndividuals(individuals, snps, chromSnps, bamFilePath, workers = 1, checkpointDir = None, counting = None):
+
+    individualCounts = [] # one (# SNP's, 3) array per individual
+    shards = []
+    counting = countingSettings(counting)
+    countingStamp = json.dumps(counting, sort_keys = True) # checkpoints only count for the same settings
+
+    if (checkpointDir != None):
+        os.makedirs(checkpointDir, exist_ok = True)
+
+    for i in range(len(individuals)):
+
+        individualCounts.append(np.zeros((len(snps), 3), dtype = np.int64))
+
+        for chrom in chromSnps:
+            # only ship the SNPs of this chromosome to the worker
+            shardSnps = {}
+
+            for pos, indices in chromSnps[chrom]:
+                for index in indices:
+                    shardSnps[index] = snps[index]
+
+            checkpointFile = None if checkpointDir == None else shardCheckpoint(checkpointDir, individuals[i], chrom)
+            bamFile = f"{bamFilePath}{individuals[i]}.sorted.bam"
+
+            # a checkpoint older than its bam file was made from different reads
+            if (checkpointFile != None and os.path.exists(checkpointFile) and os.path.getmtime(checkpointFile) >= os.path.getmtime(bamFile)):
+
+                checkpoint = np.load(checkpointFile)
+
+                # a checkpoint made from a different snp file or with other counting settings can't be reused
+                if (int(checkpoint["snpCount"]) == len(snps) and int(checkpoint["chromSnpCount"]) == len(shardSnps)
+                        and str(checkpoint.get("counting", "null")) == countingStamp):
+                    for index, derReads, ancReads, otherReads in checkpoint["covered"]:
+                        individualCounts[i][index] = (derReads, ancReads, otherReads)
+                    continue
+
+            shards.append((i, bamFile, chrom, chromSnps[chrom], shardSnps, counting))
+
+    if (len(shards) == 0):
+        return(individualCounts)
+
+    shards.sort(key = lambda shard: len(shard[4]), reverse = True) # biggest chromosomes first to balance the pool
+    chromSnpCounts = {}
+
+    for shard in shards:
+        chromSnpCounts[shard[2]] = len(shard[4])
+
+    if (workers > 1):
+        pool = mp.Pool(workers)
+        finishedShards = pool.imap_unordered(pileupShard, shards)
+    else:
+        pool = None
+        finishedShards = map(pileupShard, shards)
+
+    snpsDone = 0
+
+    # progress is counted in SNPs, chromosomes are too uneven for shards to give a useful ETA
+    with Instrument.timedStage("pileup", sum(len(shard[4]) for shard in shards), "SNPs") as timer:
+
+        for individualNumber, chrom, covered in finishedShards:
+
+            for index, derReads, ancReads, otherReads in covered:
+                individualCounts[individualNumber][index] = (derReads, ancReads, otherReads)
+
+            if (checkpointDir != None):
+                # write then rename so a kill mid-write never leaves a half checkpoint
+                checkpointFile = shardCheckpoint(checkpointDir, individuals[individualNumber], chrom)
+                np.savez(f"{checkpointFile}.tmp.npz", covered = np.array(covered, dtype = np.int64).reshape(-1, 4),
+                         snpCount = len(snps), chromSnpCount = chromSnpCounts[chrom], counting = countingStamp)
+                os.replace(f"{checkpointFile}.tmp.npz", checkpointFile)
+
+            snpsDone += chromSnpCounts[chrom]
+            Instrument.progress(timer, snpsDone)
+
+        # joined inside the timer so the workers' CPU time is counted
+        if (pool != None):
+            pool.close()
+            pool.join()
+
+    return(individualCounts)
+
 '''
 Creates new file containing reads of each ancient
 sample's mpileup reads. WILL OVERWRITE EXISTING
@@ -49,12 +460,37 @@ individuals: list of ancient individuals who have sorted and
 snpFile: eigenstrat format snp file
 bamFilePath: directory path to the bam files. Make sure that
              the path you give it is the FOLDER, not a file.
+workers: number of processes to use. With more than 1 the work is
+         split into (bam file, chromosome) shards that run in a
+         process pool and are merged back in snp file order.
+checkpointDir: Optional folder for per-shard checkpoints. Rerunning
+               with the same folder resumes an unfinished run.
+ancientFile: file to write. A name ending in .store (ex: "AncientReads.store")
+             writes a binary store instead of text (see ReadStore.py).
+counting: Optional dictionary of read counting settings, see countColumn()
+          for the keys (ex: {"minBaseQuality": 20, "minMappingQuality": 25,
+          "damageBases": 3}). Left out settings use defaultCounting. If not
+          given reads are counted the way mpileup did.
 '''
 
-def createAncientReads(individuals, snpFile, bamFilePath):
+def createAncientReads(individuals, snpFile, bamFilePath, workers = 1, checkpointDir = None, ancientFile = "AncientReads.output", counting = None):
 
-    sFile = open(snpFile, 'r')
-    outFile = open("AncientReads.output", 'w') # will OVERWRITE contents of existing file
+    snps = readSnpFile(snpFile)
+    chromSnps = groupSnpsByChrom(snps)
+    individualCounts = countIndividuals(individuals, snps, chromSnps, bamFilePath, workers, checkpointDir, counting)
+
+    writeAncientReads(ancientFile, individuals, snps, individualCounts)
+
+'''
+Writes the read counts of each individual out in the
+AncientReads.output layout. WILL OVERWRITE EXISTING FILE.
+
+fileName: file to write, or a binary store if it ends in .store
+individuals: list of ancient individuals, in column order
+snps: list of [chrom, pos, refAllele, newAllele] from readSnpFile()
+individualCounts: list of (# SNP's, 3) der/anc/other arrays, one per individual
+'''
+def writeAncientReads(fileName, individuals, snps, individualCounts):
 
     header = 'Chrom\tPos'
 
@@ -62,73 +498,171 @@ def createAncientReads(individuals, snpFile, bamFilePath):
 
         header = f"{header}\t{individuals[i]}_der\t{individuals[i]}_anc\t{individuals[i]}_other"
 
+    if (len(individualCounts) > 0):
+        counts = np.hstack(individualCounts) # (# SNP's, 3 * # individuals)
+    else:
+        counts = np.zeros((len(snps), 0), dtype = np.int64)
+
+    if (ReadStore.isStore(fileName)):
+        ReadStore.writeStore(fileName, header.split('\t'), [snp[0] for snp in snps], [int(snp[1]) for snp in snps], counts)
+        return()
+
+    outFile = open(fileName, 'w') # will OVERWRITE contents of existing file
     outFile.write(f"{header}\n")
 
-    for line in sFile:
+    for i in range(len(snps)):
 
-        lineList = line.split() # should be in "rsID | chrom | pos | physPos | refAllele | newAllele" format
-        writtenLine = f"{lineList[1]}\t{lineList[3]}" # resets/starts the line we'll write to AncientReads.output file
+        writtenLine = '\t'.join(map(str, counts[i].tolist()))
 
-        for i in range(len(individuals)): # run mpileup on each individual
+        if (writtenLine):
+            outFile.write(f"{snps[i][0]}\t{snps[i][1]}\t{writtenLine}\n")
+        else:
+            outFile.write(f"{snps[i][0]}\t{snps[i][1]}\n")
 
-            # in format "samtools mpileup -r chromosome:pos-pos bamFile"
-            # Even if you only want one positon, do pos-pos. Otherwise
-            # You'll get reads from that position to the end of the
-            # chromosome.
+    outFile.close()
 
-            if (lineList[1] == '23'): # if X chromosome
-                reads = pysam.mpileup('-r', f"X:{lineList[3]}-{lineList[3]}", f"{bamFilePath}{individuals[i]}.sorted.bam")
-                reads = reads.split()
+'''
+Adds columns for new ancient individuals to an existing
+AncientReads.output file. Only the new bam files are piled up,
+then their columns are spliced onto the existing file in one
+streaming pass. Individuals already in the file are skipped (logged
+as "skipped" events). Raises a ValueError if the file's SNPs don't
+match snpFile.
+
+individuals: list of ancient individuals to add who have sorted
+             and indexed bam files available
+snpFile: eigenstrat format snp file AncientReads.output was made with
+bamFilePath: directory path to the bam files. Make sure that
+             the path you give it is the FOLDER, not a file.
+ancientFile: existing file made by createAncientReads(), text or
+             binary store
+workers: number of processes to use for the pileup
+checkpointDir: Optional folder for per-shard checkpoints
+counting: Optional read counting settings (see createAncientReads()).
+          Use the same ones the existing file was made with.
+'''
+def appendtoAncientReads(individuals, snpFile, bamFilePath, ancientFile = "AncientReads.output", workers = 1, checkpointDir = None, counting = None):
 
-            elif(lineList[1] == '24'): # if Y chromosome
-                reads = pysam.mpileup('-r', f"Y:{lineList[3]}-{lineList[3]}", f"{bamFilePath}{individuals[i]}.sorted.bam")
-                reads = reads.split()
+    if (ReadStore.isStore(ancientFile)):
+        appendtoAncientStore(individuals, snpFile, bamFilePath, ancientFile, workers, checkpointDir, counting)
+        return()
 
-            else:
-                reads = pysam.mpileup('-r', f"{lineList[1]}:{lineList[3]}-{lineList[3]}", f"{bamFilePath}{individuals[i]}.sorted.bam")
-                reads = reads.split()
-            # list of strings ["chrom", "pos", "N", "total reads", "reads", "read quality"]
+    aFile = open(ancientFile, 'r')
+    header = aFile.readline().rstrip('\n')
+    headerList = header.split('\t')
+    newIndividuals = []
 
-            if not reads: # no read was found
-                ancReads = 0
-                derReads = 0
-                otherReads = 0
+    for each in individuals:
 
-            else:
-                totalReads = int(reads[3])
-                ancReads = reads[4].count(lineList[4])
-                derReads = reads[4].count(lineList[5])
-                otherReads = totalReads - ancReads - derReads
+        if (f"{each}_der" in headerList or each in newIndividuals):
+            Instrument.logEvent("skipped", "appendReads", individual = each, file = ancientFile, reason = "already added")
+        else:
+            newIndividuals.append(each)
+
+    if (len(newIndividuals) == 0):
+        aFile.close()
+        return()
+
+    snps = readSnpFile(snpFile)
+    chromSnps = groupSnpsByChrom(snps)
+    individualCounts = countIndividuals(newIndividuals, snps, chromSnps, bamFilePath, workers, checkpointDir, counting)
+    counts = np.hstack(individualCounts) # (# SNP's, 3 * # new individuals)
+
+    # new file is only swapped in once every line has been written
+    outFile = open(f"{ancientFile}.tmp", 'w')
 
-            writtenLine = f"{writtenLine}\t{derReads}\t{ancReads}\t{otherReads}" # append reads to line
+    for each in newIndividuals:
+        header = f"{header}\t{each}_der\t{each}_anc\t{each}_other"
 
-        outFile.write(f"{writtenLine}\n")
+    outFile.write(f"{header}\n")
+    lineNumber = 0
+
+    for line in aFile:
+
+        lineList = line.split('\t', 2) # only need chrom and pos to check we're on the same SNP
 
-    sFile.close()   # for good practice
+        if (lineNumber >= len(snps) or lineList[0] != snps[lineNumber][0] or lineList[1].rstrip('\n') != snps[lineNumber][1]):
+            aFile.close()
+            outFile.close()
+            os.remove(f"{ancientFile}.tmp")
+            raise ValueError(f"{ancientFile} line {lineNumber + 2} does not match {snpFile}")
+
+        newColumns = '\t'.join(map(str, counts[lineNumber].tolist()))
+        outFile.write(f"{line.rstrip()}\t{newColumns}\n")
+        lineNumber += 1
+
+    aFile.close()
     outFile.close()
 
+    if (lineNumber != len(snps)):
+        os.remove(f"{ancientFile}.tmp")
+        raise ValueError(f"{ancientFile} has {lineNumber} SNP's but {snpFile} has {len(snps)}")
+
+    os.replace(f"{ancientFile}.tmp", ancientFile)
+
+'''
+Store version of appendtoAncientReads(). The new individuals' counts
+are added as columns of a new store that replaces the old one.
+
+Same arguments as appendtoAncientReads(), ancientFile is a .store folder.
+'''
+def appendtoAncientStore(individuals, snpFile, bamFilePath, ancientFile, workers = 1, checkpointDir = None, counting = None):
+
+    header, chroms, positions, freqs, counts = ReadStore.readStore(ancientFile)
+    newIndividuals = []
+
+    for each in individuals:
+
+        if (f"{each}_der" in header or each in newIndividuals):
+            Instrument.logEvent("skipped", "appendReads", individual = each, file = ancientFile, reason = "already added")
+        else:
+            newIndividuals.append(each)
+
+    if (len(newIndividuals) == 0):
+        return()
+
+    snps = readSnpFile(snpFile)
+
+    if (len(snps) != len(positions)):
+        raise ValueError(f"{ancientFile} has {len(positions)} SNP's but {snpFile} has {len(snps)}")
+
+    if (chroms.astype(str).tolist() != [snp[0] for snp in snps] or positions.tolist() != [int(snp[1]) for snp in snps]):
+        raise ValueError(f"{ancientFile} does not match {snpFile}")
+
+    chromSnps = groupSnpsByChrom(snps)
+    individualCounts = countIndividuals(newIndividuals, snps, chromSnps, bamFilePath, workers, checkpointDir, counting)
+
+    for each in newIndividuals:
+        header = header + [f"{each}_der", f"{each}_anc", f"{each}_other"]
+
+    ReadStore.writeStore(ancientFile, header, chroms, positions, np.hstack([counts] + individualCounts))
+
 ########################################
 #
 # Main
 #
 ########################################
 
-# test bois
-#ancientIndividuals = ["HRR051935"]
-#snpFile = "test.snp"
+# guard keeps process pool workers from re-running the main block
+if __name__ == "__main__":
+
+    # test bois
+    #ancientIndividuals = ["HRR051935"]
+    #snpFile = "test.snp"
 
-snpFile = "v42.4.1240K.EG.snp"
+    snpFile = "v42.4.1240K.EG.snp"
 
-ancientIndividuals = ["HRR051935", "HRR051936", "HRR051937",\
-                      "HRR051938", "HRR051939", "HRR051940",\
-                      "HRR051941", "HRR051942", "HRR051943",\
-                      "HRR051944", "HRR051945", "HRR051946",\
-                      "HRR051947", "HRR051948", "HRR051949",\
-                      "HRR051950", "HRR051951", "HRR051952",\
-                      "HRR051953", "HRR051954", "HRR051955",\
-                      "HRR051956", "HRR051957", "HRR051958",\
-                      "HRR051959", "HRR051960"]
+    ancientIndividuals = ["HRR051935", "HRR051936", "HRR051937",\
+                          "HRR051938", "HRR051939", "HRR051940",\
+                          "HRR051941", "HRR051942", "HRR051943",\
+                          "HRR051944", "HRR051945", "HRR051946",\
+                          "HRR051947", "HRR051948", "HRR051949",\
+                          "HRR051950", "HRR051951", "HRR051952",\
+                          "HRR051953", "HRR051954", "HRR051955",\
+                          "HRR051956", "HRR051957", "HRR051958",\
+                          "HRR051959", "HRR051960"]
 
-bamFiles = "/home/classes/myanglab/data/earlyCN/"
+    bamFiles = "/home/classes/myanglab/data/earlyCN/"
+    workers = 48 # processes for (bam file, chromosome) shards
 
-createAncientReads(ancientIndividuals, snpFile, bamFiles)
+    createAncientReads(ancientIndividuals, snpFile, bamFiles, workers)
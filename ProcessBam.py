@@ -1,42 +1,155 @@
+import os
 import pysam
-import subprocess as sp
-
-
-# list of bam files
-bamFiles = ["91KLH11.q30.autosome.bam", "91KLH18.q30.autosome.bam",
-            "91KLM2.q30.autosome.bam", "BLSM27S.q30.autosome.bam",
-            "BLSM41.q30.autosome.bam", "BLSM45.q30.autosome.bam",
-            "DCZM17IV.q30.autosome.bam", "DCZ-M21II.q30.autosome.bam",
-            "DCZ-M22IV.q30.autosome.bam", "DCZ-M6.q30.autosome.bam",
-            "EDM124.q30.autosome.bam", "EDM139.q30.autosome.bam",
-            "EDM176.q30.autosome.bam", "HJTM107.q30.autosome.bam",
-            "HJTM109.q30.autosome.bam", "HJTM115.q30.autosome.bam",
-            "HJTW13.q30.autosome.bam", "HMF32.q30.autosome.bam",
-            "JCKM1-1.q30.autosome.bam", "JXNTM23.q30.autosome.bam",
-            "JXNTM2.q30.autosome.bam", "LGM41.q30.autosome.bam",
-            "LGM79.q30.autosome.bam", "LJM14.q30.autosome.bam",
-            "LJM25.q30.autosome.bam", "LJM2.q30.autosome.bam",
-            "LJM3.q30.autosome.bam", "LJM4.q30.autosome.bam",
-            "LJM5.q30.autosome.bam", "MGS-M6.q30.autosome.bam",
-            "MGS-M7L.q30.autosome.bam", "MGS-M7R.q30.autosome.bam",
-            "MZGM10-1.q30.autosome.bam", "MZGM16.q30.autosome.bam",
-            "MZGM25-2.q30.autosome.bam", "PLTM310.q30.autosome.bam",
-            "PLTM311.q30.autosome.bam", "PLTM312.q30.autosome.bam",
-            "PLTM313.q30.autosome.bam", "SM-SGDLM27.q30.autosome.bam",
-            "SM-SGDLM6.q30.autosome.bam", "SM-SGDLM7X.q30.autosome.bam",
-            "WD-WT1H16.q30.autosome.bam", "WD-WT5M2.q30.autosome.bam",
-            "WGH35-1.q30.autosome.bam", "WGM20.q30.autosome.bam",
-            "WGM35.q30.autosome.bam", "WGM43.q30.autosome.bam",
-            "WGM70.q30.autosome.bam", "WGM76S.q30.autosome.bam",
-            "WGM94.q30.autosome.bam", "WQM4.q30.autosome.bam",
-            "XW-M1R18.q30.autosome.bam", "ZLNR-1.q30.autosome.bam",
-            "ZLNR-2.q30.autosome.bam"]
-
-for file in bamFiles:
-    length = len(file)
-    fileName = f"/home/classes/myanglab/data/earlyCN/{file}"
-    sortedFileName = f"/home/classes/myanglab/data/earlyCN/{file[:length - 4]}.sorted.bam"
-    sp.Popen(["samtools", "sort", fileName, "-o", sortedFileName], stdout = sp.PIPE)
-    sp.Popen(["samtools", "index", sortedFileName], stdout = sp.PIPE)
-    #pysam.sort("-o", file, sortedFileName) # length - 5 trims off the .bam
-    #pysam.index(sortedFileName) I hate you pysam. Why won't you work?
\ No newline at end of file
+import Instrument
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+Checks whether a bam file's sorted copy and its index are newer than
+the bam file itself, meaning there's nothing left to do for it.
+
+fileName: bam file
+sortedFileName: sorted bam file made from fileName
+
+return: True if both the sorted file and its .bai are up to date
+'''
+def isUpToDate(fileName, sortedFileName):
+
+    indexFileName = f"{sortedFileName}.bai"
+
+    if (not os.path.exists(sortedFileName) or not os.path.exists(indexFileName)):
+        return(False)
+
+    inputTime = os.path.getmtime(fileName)
+
+    return(os.path.getmtime(sortedFileName) >= inputTime and os.path.getmtime(indexFileName) >= os.path.getmtime(sortedFileName))
+
+'''
+Sorts and then indexes one bam file with pysam's in-process samtools.
+Sorting writes to a temporary file that is only renamed once samtools
+finishes, so a failed or killed sort never looks up to date. Index only
+starts after sort has succeeded.
+
+fileName: bam file
+sortedFileName: sorted bam file to make
+threads: samtools -@ threads for the sort
+memory: samtools -m memory per sort thread (ex: "768M")
+
+return: (fileName, None) on success or (fileName, error message)
+'''
+def sortAndIndex(fileName, sortedFileName, threads = 1, memory = "768M"):
+
+    tempFileName = f"{sortedFileName[:-4]}.tmp.bam"
+
+    try:
+        pysam.sort("-@", str(threads), "-m", memory, "-o", tempFileName, fileName)
+        os.replace(tempFileName, sortedFileName)
+        pysam.index(sortedFileName)
+
+    except (pysam.SamtoolsError, OSError) as error:
+        if (os.path.exists(tempFileName)):
+            os.remove(tempFileName)
+
+        return(fileName, str(error))
+
+    return(fileName, None)
+
+'''
+Sorts and indexes every bam file with a bounded number of jobs at once.
+Bam files whose .sorted.bam and .bai are already newer than them are
+skipped. Each job reports whether samtools succeeded.
+
+bamFiles: list of bam file names
+bamFilePath: directory path to the bam files. Make sure that
+             the path you give it is the FOLDER, not a file.
+workers: number of bam files sorted at the same time
+threadsPerJob: samtools -@ threads for each sort. workers * threadsPerJob
+               should be about the number of cores.
+memory: samtools -m memory per sort thread. A node needs about
+        workers * threadsPerJob * memory of free memory.
+
+return: list of (bam file, error message) for the bam files that failed
+'''
+def processBams(bamFiles, bamFilePath, workers = 4, threadsPerJob = 4, memory = "768M"):
+
+    failed = []
+
+    # the pool is shut down inside the timer so the sorts' CPU time is counted
+    with Instrument.timedStage("sort", unit = "bam files") as timer, ProcessPoolExecutor(max_workers = workers) as pool:
+
+        jobs = []
+
+        for file in bamFiles:
+
+            fileName = f"{bamFilePath}{file}"
+            sortedFileName = f"{bamFilePath}{file[:-4]}.sorted.bam" # trims off the .bam
+
+            if (isUpToDate(fileName, sortedFileName)):
+                Instrument.logEvent("skipped", "sort", file = file, reason = "already sorted and indexed")
+                continue
+
+            jobs.append(pool.submit(sortAndIndex, fileName, sortedFileName, threadsPerJob, memory))
+
+        timer["total"] = len(jobs)
+        jobsDone = 0
+
+        for job in as_completed(jobs):
+
+            fileName, error = job.result()
+            jobsDone += 1
+
+            if (error != None):
+                failed.append((fileName, error))
+                Instrument.logEvent("failed", "sort", file = fileName, error = error)
+
+            Instrument.progress(timer, jobsDone)
+
+    return(failed)
+
+#############################
+#
+# Main
+#
+#############################
+
+# guard keeps process pool workers from re-running the main block
+if __name__ == "__main__":
+
+    # list of bam files
+    bamFiles = ["91KLH11.q30.autosome.bam", "91KLH18.q30.autosome.bam",
+                "91KLM2.q30.autosome.bam", "BLSM27S.q30.autosome.bam",
+                "BLSM41.q30.autosome.bam", "BLSM45.q30.autosome.bam",
+                "DCZM17IV.q30.autosome.bam", "DCZ-M21II.q30.autosome.bam",
+                "DCZ-M22IV.q30.autosome.bam", "DCZ-M6.q30.autosome.bam",
+                "EDM124.q30.autosome.bam", "EDM139.q30.autosome.bam",
+                "EDM176.q30.autosome.bam", "HJTM107.q30.autosome.bam",
+                "HJTM109.q30.autosome.bam", "HJTM115.q30.autosome.bam",
+                "HJTW13.q30.autosome.bam", "HMF32.q30.autosome.bam",
+                "JCKM1-1.q30.autosome.bam", "JXNTM23.q30.autosome.bam",
+                "JXNTM2.q30.autosome.bam", "LGM41.q30.autosome.bam",
+                "LGM79.q30.autosome.bam", "LJM14.q30.autosome.bam",
+                "LJM25.q30.autosome.bam", "LJM2.q30.autosome.bam",
+                "LJM3.q30.autosome.bam", "LJM4.q30.autosome.bam",
+                "LJM5.q30.autosome.bam", "MGS-M6.q30.autosome.bam",
+                "MGS-M7L.q30.autosome.bam", "MGS-M7R.q30.autosome.bam",
+                "MZGM10-1.q30.autosome.bam", "MZGM16.q30.autosome.bam",
+                "MZGM25-2.q30.autosome.bam", "PLTM310.q30.autosome.bam",
+                "PLTM311.q30.autosome.bam", "PLTM312.q30.autosome.bam",
+                "PLTM313.q30.autosome.bam", "SM-SGDLM27.q30.autosome.bam",
+                "SM-SGDLM6.q30.autosome.bam", "SM-SGDLM7X.q30.autosome.bam",
+                "WD-WT1H16.q30.autosome.bam", "WD-WT5M2.q30.autosome.bam",
+                "WGH35-1.q30.autosome.bam", "WGM20.q30.autosome.bam",
+                "WGM35.q30.autosome.bam", "WGM43.q30.autosome.bam",
+                "WGM70.q30.autosome.bam", "WGM76S.q30.autosome.bam",
+                "WGM94.q30.autosome.bam", "WQM4.q30.autosome.bam",
+                "XW-M1R18.q30.autosome.bam", "ZLNR-1.q30.autosome.bam",
+                "ZLNR-2.q30.autosome.bam"]
+
+    bamFilePath = "/home/classes/myanglab/data/earlyCN/"
+    workers = 6 # bam files sorted at once
+    threadsPerJob = 8 # samtools threads per sort, workers * threadsPerJob ~ cores
+    memory = "2G" # samtools memory per sort thread
+
+    failed = processBams(bamFiles, bamFilePath, workers, threadsPerJob, memory)
+
+    for fileName, error in failed:
+        print(f"{fileName} was not sorted and indexed: {error}")
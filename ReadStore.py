@@ -0,0 +1,247 @@
+########################################
+#
+# Description:
+#   Binary store for AncientReads.output
+#   and .reads tables. A store is a folder
+#   ending in .store holding one .npy file
+#   per column group, so counts can be
+#   memory mapped and an individual's
+#   der/anc/other columns read without
+#   parsing or copying. Text files in the
+#   original layout can be written back
+#   out for Schraiber's parser.
+#
+#   NAME.store/
+#       header.json  column names, same as the text header
+#       chrom.npy    chromosome of each SNP (bytes)
+#       pos.npy      position of each SNP (uint32)
+#       freq.npy     AF column, .reads tables only (float64)
+#       counts.npy   read counts in the smallest of uint8, uint16
+#                    and uint32 that fits the deepest site (int8,
+#                    int16 or int32 if a count is negative, see
+#                    writeStore()), shape (# SNP's, # count columns)
+#
+########################################
+import json
+import os
+import shutil
+import numpy as np
+
+'''
+Checks whether a file name refers to a binary store
+instead of a text table.
+
+fileName: table file name
+
+return: True if fileName ends with .store
+'''
+def isStore(fileName):
+    return(fileName.rstrip('/').endswith(".store"))
+
+'''
+Lists the files of a store in a fixed order, for hashing.
+
+storeFile: store folder
+
+return: list of file paths
+'''
+def storeFiles(storeFile):
+    return([os.path.join(storeFile, name) for name in sorted(os.listdir(storeFile))])
+
+'''
+Writes a store. The store is written into a temporary folder
+that only replaces storeFile once every column is written.
+WILL OVERWRITE EXISTING STORE.
+
+storeFile: store folder to write (should end with .store)
+header: list of column names (ex: ["Chrom", "Pos", "AF", "ind1_der", ...])
+chroms: chromosome of each SNP (list of strings or numpy array)
+positions: position of each SNP
+counts: read counts with shape (# SNP's, # count columns)
+freqs: Optional AF column, written for .reads tables
+'''
+def writeStore(storeFile, header, chroms, positions, counts, freqs = None):
+
+    storeFile = storeFile.rstrip('/')
+    tempFile = f"{storeFile}.tmp"
+    counts = np.asarray(counts)
+
+    # low coverage counts mostly fit a byte, where text takes 2 bytes a count
+    minCount = counts.min() if counts.size > 0 else 0
+    maxCount = counts.max() if counts.size > 0 else 0
+    countTypes = (np.uint8, np.uint16, np.uint32)
+
+    # mpileup counting can make "other" negative (a read start's ^ and
+    # MAPQ character count as bases), the store keeps what the text has
+    if (minCount < 0):
+        countTypes = (np.int8, np.int16, np.int32)
+
+    countType = next(each for each in countTypes if np.iinfo(each).min <= minCount and maxCount <= np.iinfo(each).max)
+
+    if (os.path.exists(tempFile)):
+        shutil.rmtree(tempFile)
+
+    os.makedirs(tempFile)
+
+    headerFile = open(os.path.join(tempFile, "header.json"), 'w')
+    json.dump(list(header), headerFile)
+    headerFile.close()
+
+    np.save(os.path.join(tempFile, "chrom.npy"), np.asarray(chroms, dtype = np.bytes_))
+    np.save(os.path.join(tempFile, "pos.npy"), np.asarray(positions, dtype = np.uint32))
+    np.save(os.path.join(tempFile, "counts.npy"), np.ascontiguousarray(counts, dtype = countType))
+
+    if (freqs is not None):
+        np.save(os.path.join(tempFile, "freq.npy"), np.asarray(freqs, dtype = np.float64))
+
+    # a folder can't be renamed over a full one, so the old store is moved aside first
+    if (os.path.exists(storeFile)):
+        os.replace(storeFile, f"{storeFile}.old")
+        os.replace(tempFile, storeFile)
+        shutil.rmtree(f"{storeFile}.old")
+    else:
+        os.replace(tempFile, storeFile)
+
+'''
+Opens a store. Columns are memory mapped by default, so only the
+rows and columns that get used are ever read from disk.
+
+storeFile: store folder
+mmap: if False columns are read fully into memory
+
+return: list of header names,
+        numpy bytes array of chromosomes,
+        numpy uint32 array of positions,
+        numpy float64 array of AF (None for AncientReads tables),
+        numpy uint8/uint16/uint32 (int8/int16/int32 with negative counts)
+        array of counts, shape (# SNP's, # count columns)
+'''
+def readStore(storeFile, mmap = True):
+
+    mode = 'r' if mmap else None
+
+    headerFile = open(os.path.join(storeFile, "header.json"), 'r')
+    header = json.load(headerFile)
+    headerFile.close()
+
+    chroms = np.load(os.path.join(storeFile, "chrom.npy"), mmap_mode = mode)
+    positions = np.load(os.path.join(storeFile, "pos.npy"), mmap_mode = mode)
+    counts = np.load(os.path.join(storeFile, "counts.npy"), mmap_mode = mode)
+    freqs = None
+
+    if (os.path.exists(os.path.join(storeFile, "freq.npy"))):
+        freqs = np.load(os.path.join(storeFile, "freq.npy"), mmap_mode = mode)
+
+    return(header, chroms, positions, freqs, counts)
+
+'''
+Gets one individual's der/anc/other columns. The three columns
+sit next to each other, so this is a view of counts, not a copy.
+
+header: header from readStore()
+counts: counts from readStore()
+individual: name used in the header (ex: "HRR051935")
+
+return: numpy array view with shape (# SNP's, 3)
+'''
+def individualCounts(header, counts, individual):
+
+    firstCount = header.index("AF") + 1 if "AF" in header else 2
+    column = header.index(f"{individual}_der") - firstCount
+
+    return(counts[:, column:column + 3])
+
+'''
+Converts a text AncientReads.output or .reads table into a store.
+Tables with an AF third column keep it as the freq column.
+
+textFile: tab separated table with a header line
+storeFile: store folder to write
+chunkSize: number of lines to convert to integers at a time
+'''
+def textToStore(textFile, storeFile, chunkSize = 50000):
+
+    file = open(textFile, 'r')
+    header = file.readline().split()
+    hasFreqs = len(header) > 2 and header[2] == "AF"
+    splits = 3 if hasFreqs else 2
+    chroms = []
+    positions = []
+    freqs = []
+    countChunks = []
+    chunk = []
+
+    for line in file:
+
+        lineList = line.split(None, splits)
+        chroms.append(lineList[0])
+        positions.append(int(lineList[1]))
+
+        if (hasFreqs):
+            freqs.append(float(lineList[2]))
+
+        chunk.append(lineList[splits] if len(lineList) > splits else "")
+
+        if (len(chunk) == chunkSize):
+            countChunks.append(np.array(" ".join(chunk).split(), dtype = np.int64).reshape(len(chunk), -1))
+            chunk = []
+
+    if (len(chunk) > 0):
+        countChunks.append(np.array(" ".join(chunk).split(), dtype = np.int64).reshape(len(chunk), -1))
+
+    file.close()
+
+    if (len(countChunks) > 0):
+        counts = np.vstack(countChunks)
+    else:
+        counts = np.zeros((0, len(header) - splits), dtype = np.int64)
+
+    writeStore(storeFile, header, chroms, positions, counts, freqs if hasFreqs else None)
+
+'''
+Writes a store back out as a text table in the same layout
+PreProcessReads.py and computeAlleleFreq.py write, so it can
+be given to Schraiber's parse_reads_by_pop().
+
+storeFile: store folder
+textFile: text file to write. WILL OVERWRITE.
+chunkSize: number of lines to format at a time
+rows: Optional numpy array of the rows to write, in order (ex: the
+      SNPs a filter keeps, see SnpFilter.py). Every row if None.
+'''
+def storeToText(storeFile, textFile, chunkSize = 50000, rows = None):
+
+    header, chroms, positions, freqs, counts = readStore(storeFile)
+
+    if (rows is not None):
+        chroms = chroms[rows]
+        positions = positions[rows]
+        freqs = None if freqs is None else freqs[rows]
+        counts = counts[rows]
+
+    outFile = open(textFile, 'w')
+    headerLine = '\t'.join(header)
+    outFile.write(f"{headerLine}\n")
+
+    for start in range(0, len(positions), chunkSize):
+
+        end = min(start + chunkSize, len(positions))
+        chunkChroms = chroms[start:end].astype(str).tolist()
+        chunkPositions = positions[start:end].tolist()
+        chunkFreqs = None if freqs is None else freqs[start:end].tolist()
+        chunkCounts = counts[start:end].tolist()
+        lines = []
+
+        for i in range(end - start):
+
+            fields = [chunkChroms[i], str(chunkPositions[i])]
+
+            if (chunkFreqs != None):
+                fields.append(str(chunkFreqs[i]))
+
+            lines.append('\t'.join(fields + [str(count) for count in chunkCounts[i]]))
+
+        outFile.write('\n'.join(lines))
+        outFile.write('\n')
+
+    outFile.close()
@@ -0,0 +1,541 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import ProcessBam
+import PreProcessReads
+import computeAlleleFreq
+import CleanResults
+import Instrument
+import ReadStore
+import SnpFilter
+
+'''
+Runs every stage from bam files to the results table with one command:
+
+    python RunPipeline.py pipeline.json [--dry-run] [--log FILE] [--profile FOLDER]
+
+Each stage makes a set of artifacts, one target per artifact:
+
+sort:        {bamFilePath}{individual}.bam -> .sorted.bam and .sorted.bam.bai
+             (skipped for individuals that only have the .sorted.bam
+             and .bai, so a pipeline can start from sorted bam files)
+pileup:      .sorted.bam files and the snp file -> AncientReads.output
+frequencies: the eigenstrat panel -> {group}.output
+reads:       {group}.output and AncientReads.output -> reads/{group}_{set}.reads
+             (and ind/{group}_{set}.ind when there's a nameDict). With
+             "groupOutputs": false there's no frequencies stage, freqs are
+             streamed from the panel into the .reads files instead.
+             With a "panelDir" both read each group's genotype columns
+             from a cached per-population panel (see subPanels()).
+
+With "binary": true in the config, AncientReads.store and .reads.store
+binary stores (see ReadStore.py) are made instead of the text tables.
+continuity:  reads/ and ind/ files -> records/{group}_{set}.jsonl
+             ("virtualSets" are fit from their members' files, which
+             the reads stage makes, without files of their own). A
+             "snpFilter" (see SnpFilter.py) picks the SNPs that are fit,
+             changing it refits every pair but rebuilds nothing else.
+results:     every record file -> resultsFile and its .csv
+
+A target is stale when one of its outputs is missing, an output is older
+than one of its inputs, or the settings it was built with (kept in
+.pipeline/{stage}.json) have changed. Stages with hashInputs also keep
+a hash of each input, so a rewritten .reads file with the same contents
+(ex: after an individual is added to AncientReads.output) doesn't send
+its pair back through the optimizer. Only stale targets are rebuilt,
+and a stage starts as soon as the stages it depends on are finished, so
+frequencies runs alongside sort and pileup.
+
+Progress, rate and ETA of the long steps and the wall time, CPU time
+and peak memory of every stage are written as JSON lines to stderr, or
+to --log (see Instrument.py). --profile saves cProfile stats of each
+stage and of the pool jobs inside it.
+'''
+
+readsDir = "reads" # continuity.py reads the .reads and .ind files from these
+indDir = "ind"
+recordsDir = "records"
+stampDir = ".pipeline"
+
+'''
+Reads the pipeline config, filling in defaults for optional settings.
+
+configFile: .json file with the pipeline settings (see pipeline.json)
+
+return: dictionary of settings
+'''
+def readConfig(configFile):
+    file = open(configFile, 'r')
+    config = json.load(file)
+    file.close()
+
+    defaults = {"nameDict": None, "ancientIndFile": None,
+                "workers": 1, "sortWorkers": 1, "sortThreads": 1, "sortMemory": "768M",
+                "checkpointDir": None, "cacheDir": None,
+                "totalCores": 1, "coresPerJob": 1, "warmStart": False,
+                "resultsFile": "continuity.jsonl", "binary": False, "counting": None, "virtualSets": [],
+                "groupOutputs": True, "panelDir": None, "snpFilter": None}
+
+    for key in defaults:
+        config.setdefault(key, defaults[key])
+
+    return(config)
+
+def sortedBam(config, individual):
+    return(f"{config['bamFilePath']}{individual}.sorted.bam")
+
+# pooled members of a virtual sample set are joined by '+', same as continuity.pairName()
+def setName(individuals):
+    return("_".join(member if isinstance(member, str) else "+".join(member) for member in individuals))
+
+def setMembers(individuals):
+    return([each for member in individuals for each in ([member] if isinstance(member, str) else member)])
+
+# sample sets that need .reads files: virtual sample sets are built from their members' own files
+def readsSets(config):
+    sets = [list(individuals) for individuals in config["sampleSets"]]
+
+    for individuals in config["virtualSets"]:
+        for each in setMembers(individuals):
+            if ([each] not in sets):
+                sets.append([each])
+
+    return(sets)
+
+def ancientReadsFile(config):
+    return("AncientReads.store" if config["binary"] else "AncientReads.output")
+
+def readsFile(config, group, name):
+    return(os.path.join(readsDir, f"{group}_{name}.reads.store" if config["binary"] else f"{group}_{name}.reads"))
+
+'''
+Functions that list each stage's targets. A target is
+key -> (inputs, outputs, params), where params are the settings
+the outputs depend on that aren't captured by the input files.
+'''
+def sortTargets(config):
+    targets = {}
+
+    for individual in config["individuals"]:
+        bamFile = f"{config['bamFilePath']}{individual}.bam"
+        outputs = [sortedBam(config, individual), f"{sortedBam(config, individual)}.bai"]
+
+        # bam files that come sorted and indexed have nothing to sort from, pileup uses them as they are
+        if (not os.path.exists(bamFile) and all(os.path.exists(output) for output in outputs)):
+            continue
+
+        targets[individual] = ([bamFile], outputs, {})
+
+    return(targets)
+
+def pileupTargets(config):
+    inputs = [config["snpFile"]] + [sortedBam(config, individual) for individual in config["individuals"]]
+    params = {"snpFile": config["snpFile"], "individuals": sorted(config["individuals"]),
+              "counting": PreProcessReads.countingSettings(config["counting"])}
+
+    return({ancientReadsFile(config): (inputs, [ancientReadsFile(config)], params)})
+
+def frequencyTargets(config):
+    inputs = [config["genoFile"], config["indFile"], config["snpFile"]]
+    params = {"genoFile": config["genoFile"], "indFile": config["indFile"], "snpFile": config["snpFile"]}
+
+    if (not config["groupOutputs"]): # the reads stage streams freqs from the panel itself
+        return({})
+
+    return({group: (inputs, [f"{group}.output"], params) for group in config["groups"]})
+
+def readsTargets(config):
+    targets = {}
+
+    for group in config["groups"]:
+        for individuals in readsSets(config):
+
+            name = setName(individuals)
+            inputs = [f"{group}.output", ancientReadsFile(config)]
+            outputs = [readsFile(config, group, name)]
+            params = {"individuals": individuals, "names": None}
+
+            if (not config["groupOutputs"]):
+                inputs = [config["genoFile"], config["indFile"], config["snpFile"], ancientReadsFile(config)]
+                params["panel"] = [config["genoFile"], config["indFile"], config["snpFile"]]
+
+            if (config["nameDict"] != None):
+                inputs.append(config["ancientIndFile"])
+                outputs.append(os.path.join(indDir, f"{group}_{name}.ind"))
+                params["names"] = [config["nameDict"][each] for each in individuals]
+
+            targets[f"{group}_{name}"] = (inputs, outputs, params)
+
+    return(targets)
+
+def continuityTargets(config):
+    targets = {}
+    # the .reads files already change with the snp file, so it isn't an input (hashing it for every pair costs too much)
+    params = {"warmStart": config["warmStart"], "snpFilter": SnpFilter.filterSettings(config["snpFilter"])}
+
+    for group in config["groups"]:
+        for individuals in config["sampleSets"]:
+
+            name = setName(individuals)
+            inputs = [readsFile(config, group, name), os.path.join(indDir, f"{group}_{name}.ind")]
+            targets[f"{group}_{name}"] = (inputs, [os.path.join(recordsDir, f"{group}_{name}.jsonl")], params)
+
+        for individuals in config["virtualSets"]: # fit straight from the members' files
+
+            name = setName(individuals)
+            inputs = []
+
+            for each in setMembers(individuals):
+                inputs += [readsFile(config, group, each), os.path.join(indDir, f"{group}_{each}.ind")]
+
+            targets[f"{group}_{name}"] = (inputs, [os.path.join(recordsDir, f"{group}_{name}.jsonl")], params)
+
+    return(targets)
+
+def resultsTargets(config):
+    inputs = [outputs[0] for inputs, outputs, params in continuityTargets(config).values()]
+    outputs = [config["resultsFile"], f"{os.path.splitext(config['resultsFile'])[0]}.csv"]
+
+    return({config["resultsFile"]: (inputs, outputs, {"records": inputs})})
+
+'''
+Functions that build a stage's stale targets.
+
+config: pipeline settings
+keys: stale target keys
+stamps: stamp each key was last built with (missing if never built)
+'''
+def sortBuild(config, keys, stamps):
+    failed = ProcessBam.processBams([f"{individual}.bam" for individual in keys], config["bamFilePath"],
+                                    config["sortWorkers"], config["sortThreads"], config["sortMemory"])
+
+    if (len(failed) > 0):
+        raise RuntimeError(f"{len(failed)} bam files failed to sort and index")
+
+def pileupBuild(config, keys, stamps):
+    ancientFile = ancientReadsFile(config)
+    inputs, outputs, params = pileupTargets(config)[ancientFile]
+    old = stamps.get(ancientFile, {}).get("params")
+
+    # only new individuals need piling up if the old ones' bam files haven't changed
+    if (old != None and os.path.exists(ancientFile) and old["snpFile"] == params["snpFile"] and old.get("counting") == params["counting"]
+            and set(old["individuals"]) <= set(params["individuals"])
+            and all(os.path.getmtime(sortedBam(config, each)) <= os.path.getmtime(ancientFile) for each in old["individuals"])
+            and os.path.getmtime(config["snpFile"]) <= os.path.getmtime(ancientFile)):
+
+        newIndividuals = [each for each in config["individuals"] if each not in old["individuals"]]
+        PreProcessReads.appendtoAncientReads(newIndividuals, config["snpFile"], config["bamFilePath"], ancientFile,
+                                             config["workers"], config["checkpointDir"], config["counting"])
+    else:
+        PreProcessReads.createAncientReads(config["individuals"], config["snpFile"], config["bamFilePath"],
+                                           config["workers"], config["checkpointDir"], ancientFile, config["counting"])
+
+def frequencyBuild(config, keys, stamps):
+    computeAlleleFreq.computeAlleleFreqs(config["genoFile"], config["indFile"], config["snpFile"], keys, panelDir = config["panelDir"])
+
+def readsBuild(config, keys, stamps):
+    os.makedirs(readsDir, exist_ok = True)
+    os.makedirs(indDir, exist_ok = True)
+
+    # groups that need the same sample sets share one load of AncientReads.output
+    groupSets = {}
+
+    for group in config["groups"]:
+        sets = tuple(tuple(individuals) for individuals in readsSets(config) if f"{group}_{setName(individuals)}" in keys)
+
+        if (len(sets) > 0):
+            groupSets.setdefault(sets, []).append(group)
+
+    for sets in groupSets:
+
+        if (config["groupOutputs"]):
+            computeAlleleFreq.appendAncientIndividuals(groupSets[sets], [list(individuals) for individuals in sets], ancientReadsFile(config),
+                                                       config["nameDict"], config["ancientIndFile"], readsDir, indDir, config["binary"])
+        else:
+            computeAlleleFreq.computeReads(config["genoFile"], config["indFile"], config["snpFile"], groupSets[sets],
+                                           [list(individuals) for individuals in sets], ancientReadsFile(config),
+                                           config["nameDict"], config["ancientIndFile"], readsDir, indDir, config["binary"],
+                                           panelDir = config["panelDir"])
+
+def continuityBuild(config, keys, stamps):
+    import continuity # needs ancient_genotypes, only imported when there are fits to run
+
+    pairs = [(group, setName(individuals)) for group in config["groups"] for individuals in config["sampleSets"]
+             if f"{group}_{setName(individuals)}" in keys]
+    pairs += [(group, individuals) for group in config["groups"] for individuals in config["virtualSets"]
+              if f"{group}_{setName(individuals)}" in keys]
+
+    # masks are kept with the parsed data, or with the stamps if there's no cache
+    maskDir = stampDir if config["cacheDir"] == None else config["cacheDir"]
+    snpFilter = SnpFilter.compileFilter(config["snpFilter"], config["snpFile"], maskDir)
+
+    continuity.runContinuityGrid(config["groups"], [setName(individuals) for individuals in config["sampleSets"]],
+                                 config["totalCores"], config["coresPerJob"], cacheDir = config["cacheDir"],
+                                 warmStart = config["warmStart"], pairs = pairs, recordsDir = recordsDir, snpFilter = snpFilter)
+
+def resultsBuild(config, keys, stamps):
+    inputs, outputs, params = resultsTargets(config)[config["resultsFile"]]
+    outFile = open(f"{config['resultsFile']}.tmp", 'w')
+
+    for recordFile in inputs:
+        file = open(recordFile, 'r')
+        outFile.write(file.read())
+        file.close()
+
+    outFile.close()
+    os.replace(f"{config['resultsFile']}.tmp", config["resultsFile"])
+    CleanResults.recordsToCSV(config["resultsFile"])
+
+# hashInputs only for stages with small inputs, hashing bam and geno files would cost more than it saves
+stages = [{"name": "sort", "after": [], "targets": sortTargets, "build": sortBuild, "hashInputs": False},
+          {"name": "pileup", "after": ["sort"], "targets": pileupTargets, "build": pileupBuild, "hashInputs": False},
+          {"name": "frequencies", "after": [], "targets": frequencyTargets, "build": frequencyBuild, "hashInputs": False},
+          {"name": "reads", "after": ["pileup", "frequencies"], "targets": readsTargets, "build": readsBuild, "hashInputs": False},
+          {"name": "continuity", "after": ["reads"], "targets": continuityTargets, "build": continuityBuild, "hashInputs": True},
+          {"name": "results", "after": ["continuity"], "targets": resultsTargets, "build": resultsBuild, "hashInputs": True}]
+
+stageDict = {stage["name"]: stage for stage in stages}
+
+def readStamps(stageName):
+    stampFile = os.path.join(stampDir, f"{stageName}.json")
+
+    if (not os.path.exists(stampFile)):
+        return({})
+
+    file = open(stampFile, 'r')
+    stamps = json.load(file)
+    file.close()
+
+    return(stamps)
+
+def writeStamps(stageName, stamps):
+    os.makedirs(stampDir, exist_ok = True)
+    stampFile = os.path.join(stampDir, f"{stageName}.json")
+
+    file = open(f"{stampFile}.tmp", 'w')
+    json.dump(stamps, file, indent = 1)
+    file.close()
+    os.replace(f"{stampFile}.tmp", stampFile)
+
+def fileHash(fileName):
+    sha = hashlib.sha1()
+    fileNames = ReadStore.storeFiles(fileName) if os.path.isdir(fileName) else [fileName]
+
+    for each in fileNames:
+        file = open(each, 'rb')
+
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+
+        file.close()
+
+    return(sha.hexdigest())
+
+'''
+Checks one target's files and settings.
+
+target: (inputs, outputs, params)
+stamp: {"params": ..., "hashes": {input: sha1}} the target was last
+       built with, None if never built. Leave it out to only check files.
+
+return: reason the target is stale, or None if it's up to date
+'''
+def staleReason(target, stamp = False):
+    inputs, outputs, params = target
+
+    for output in outputs:
+        if (not os.path.exists(output)):
+            return(f"{output} is missing")
+
+    for each in inputs:
+        if (not os.path.exists(each)):
+            return(f"input {each} is missing")
+
+    if (stamp == None):
+        return("never built")
+
+    if (stamp != False and json.loads(json.dumps(params)) != stamp["params"]): # round trip turns tuples into lists like the stamp file
+        return("settings changed")
+
+    if (len(inputs) > 0):
+        oldestOutput = min(outputs, key = os.path.getmtime)
+
+        for each in inputs:
+
+            if (os.path.getmtime(each) <= os.path.getmtime(oldestOutput)):
+                continue
+
+            # a newer input with the same contents it was built from is fine
+            if (stamp != False and each in stamp.get("hashes", {}) and fileHash(each) == stamp["hashes"][each]):
+                continue
+
+            return(f"{each} is newer than {oldestOutput}")
+
+    return(None)
+
+def runStage(stageName, config, keys, stamps):
+    with Instrument.timedStage(f"pipeline.{stageName}", len(keys), "targets") as timer:
+        stageDict[stageName]["build"](config, keys, stamps)
+        timer["done"] = len(keys)
+
+'''
+Prints which targets each stage would rebuild without building anything.
+Outputs of stale targets count as changed for the stages after them.
+
+config: pipeline settings
+'''
+def dryRun(config):
+    pendingOutputs = set()
+
+    for stage in stages:
+        targets = stage["targets"](config)
+        stamps = readStamps(stage["name"])
+        staleKeys = 0
+
+        for key in targets:
+            inputs, outputs, params = targets[key]
+            reason = next((f"input {each} will be rebuilt" for each in inputs if each in pendingOutputs), None)
+
+            if (reason != None and stage["hashInputs"]):
+                reason = f"{reason}, rerun only if its contents change"
+
+            if (reason == None):
+                reason = staleReason(targets[key], stamps.get(key))
+
+            if (reason != None):
+                print(f"{stage['name']}: {key} ({reason})")
+                pendingOutputs.update(outputs)
+                staleKeys += 1
+
+        print(f"{stage['name']}: {staleKeys}/{len(targets)} targets to build")
+
+'''
+Builds every stale target, running each stage once the stages it
+depends on are done. Stages that don't depend on each other run at
+the same time. A stage that fails stops the stages after it, the
+others keep going.
+
+config: pipeline settings
+
+return: list of stage names that failed or were skipped
+'''
+def runPipeline(config):
+    done = set()
+    failed = []
+    running = {}
+
+    with ProcessPoolExecutor(max_workers = len(stages)) as pool:
+
+        while (True):
+
+            for stage in stages:
+
+                name = stage["name"]
+
+                if (name in done or name in failed or name in running.values()):
+                    continue
+
+                if (any(each in failed for each in stage["after"])):
+                    print(f"Skipping {name}, a stage before it failed", flush = True)
+                    failed.append(name)
+                    continue
+
+                if (not all(each in done for each in stage["after"])):
+                    continue
+
+                # staleness is checked once the stages before have written their outputs
+                targets = stage["targets"](config)
+                stamps = readStamps(name)
+                staleKeys = [key for key in targets if staleReason(targets[key], stamps.get(key)) != None]
+
+                if (len(staleKeys) == 0):
+                    print(f"{name} is up to date", flush = True)
+                    done.add(name)
+                    continue
+
+                # forgetting the stamps first means a build that dies part way is redone
+                oldStamps = {key: stamps.pop(key) for key in staleKeys if key in stamps}
+                writeStamps(name, stamps)
+
+                print(f"Building {name} ({len(staleKeys)}/{len(targets)} targets)", flush = True)
+                running[pool.submit(runStage, name, config, staleKeys, oldStamps)] = name
+
+            if (len(running) == 0):
+                break
+
+            finished, pending = wait(running, return_when = FIRST_COMPLETED)
+
+            for job in finished:
+
+                name = running.pop(job)
+
+                try:
+                    job.result()
+                except Exception as error:
+                    print(f"{name} failed: {error}", flush = True)
+                    failed.append(name)
+                    continue
+
+                # some steps print a message and return instead of raising,
+                # so only targets whose outputs really are up to date get stamped
+                targets = stageDict[name]["targets"](config)
+                stamps = readStamps(name)
+                missed = []
+
+                for key in targets:
+
+                    if (key in stamps):
+                        continue
+
+                    inputs, outputs, params = targets[key]
+
+                    if (staleReason((inputs, outputs, params)) == None):
+                        stamps[key] = {"params": json.loads(json.dumps(params)), "hashes": {}}
+
+                        if (stageDict[name]["hashInputs"]):
+                            stamps[key]["hashes"] = {each: fileHash(each) for each in inputs}
+                    else:
+                        missed.append(key)
+
+                writeStamps(name, stamps)
+
+                if (len(missed) > 0):
+                    print(f"{name} failed: {len(missed)} targets were not built ({', '.join(missed[:5])})", flush = True)
+                    failed.append(name)
+                else:
+                    print(f"Finished {name}", flush = True)
+                    done.add(name)
+
+    return(failed)
+
+#############################
+#
+# Main
+#
+#############################
+
+# guard keeps process pool workers from re-running the main block
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Rebuilds the stale steps from bam files to the results table.")
+    parser.add_argument("config", help = "pipeline settings .json file (see pipeline.json)")
+    parser.add_argument("--dry-run", action = "store_true", help = "only print what would be rebuilt")
+    parser.add_argument("--log", help = "file for progress and timing events (default stderr)")
+    parser.add_argument("--profile", help = "folder for a cProfile .prof file per step and process")
+    parser.add_argument("--interval", type = float, default = 10, help = "seconds between progress events")
+    arguments = parser.parse_args()
+
+    config = readConfig(arguments.config)
+    Instrument.configure(arguments.log, arguments.profile, arguments.interval) # before the pool starts so its workers get it
+
+    if (arguments.dry_run):
+        dryRun(config)
+    else:
+        failed = runPipeline(config)
+
+        if (len(failed) > 0):
+            print(f"Stages not finished: {', '.join(failed)}")
+            raise SystemExit(1)
@@ -0,0 +1,288 @@
+########################################
+#
+# Description:
+#   Declarative SNP filters for the
+#   continuity fits. A filter is a
+#   dictionary (see defaultFilter) that
+#   is compiled once into a boolean mask
+#   over the SNPs of the .snp file, the
+#   index every .output and .reads table
+#   is a subset of. The mask is applied
+#   when continuity.py loads a pair's
+#   reads, so trying a new set of SNPs
+#   (no X, transversions only, ...) costs
+#   one pass over the .snp file instead
+#   of new .output and .reads files.
+#
+#   chromosomes          eigenstrat chromosome codes to keep, None for all
+#                        ("X"/"Y" and "chr" prefixes are read as 23/24)
+#   excludeChromosomes   codes to drop (ex: ["23", "24"])
+#   mutations            "all", "transitions" (A<->G, C<->T) or
+#                        "transversions", from the .snp alleles
+#   coverage             [min, max] reads (derived + ancestral) an
+#                        individual needs at a SNP, either can be None.
+#                        Reads outside the range are zeroed, the same
+#                        way Schraiber's coverage_filter() does.
+#   percentileFilter     False skips Schraiber's coverage_filter()
+#
+########################################
+import hashlib
+import itertools
+import json
+import os
+import numpy as np
+import Instrument
+import ReadStore
+
+# SNP filter settings, see the description above
+defaultFilter = {"chromosomes": None, "excludeChromosomes": [], "mutations": "all",
+                 "coverage": None, "percentileFilter": True}
+
+transitions = {("A", "G"), ("G", "A"), ("C", "T"), ("T", "C")}
+
+'''
+Converts a chromosome name into the code the .snp file uses.
+Eigenstrat codes X as 23 and Y as 24.
+
+chrom: chromosome name or code (ex: "chrX", "X", "23", 1)
+
+return: eigenstrat chromosome code as a string
+'''
+def chromCode(chrom):
+
+    chrom = str(chrom)
+
+    if (chrom.startswith("chr")):
+        chrom = chrom[3:]
+
+    return({"X": "23", "Y": "24"}.get(chrom.upper(), chrom))
+
+'''
+Fills in the settings left out of a SNP filter dictionary.
+
+snpFilter: dictionary of SNP filter settings or None
+
+return: None for no filter, otherwise a full settings dictionary
+'''
+def filterSettings(snpFilter):
+
+    if (snpFilter == None):
+        return(None)
+
+    settings = dict(defaultFilter)
+    settings.update(snpFilter)
+
+    if (settings["mutations"] not in ("all", "transitions", "transversions")):
+        raise ValueError(f"mutations must be \"all\", \"transitions\" or \"transversions\", not {settings['mutations']}")
+
+    if (settings["chromosomes"] != None):
+        settings["chromosomes"] = sorted(set(chromCode(chrom) for chrom in settings["chromosomes"]))
+
+    settings["excludeChromosomes"] = sorted(set(chromCode(chrom) for chrom in settings["excludeChromosomes"]))
+
+    if (settings["coverage"] != None and len(settings["coverage"]) != 2):
+        raise ValueError(f"coverage must be [min, max], not {settings['coverage']}")
+
+    return(settings)
+
+'''
+Compiles a SNP filter into a mask over the SNPs of a .snp file. The
+mask is saved in maskDir under a name made from the filter's settings
+and the .snp file's size and modification time, so it's only computed
+again when one of them changes.
+
+snpFilter: dictionary of SNP filter settings (see defaultFilter) or None
+snpFile: eigenstrat format snp file the .output and .reads rows come from
+maskDir: folder for compiled masks
+
+return: None for no filter, otherwise the full settings with "maskFile"
+        set to the compiled mask (None if every SNP is kept, then only
+        the coverage settings apply)
+'''
+def compileFilter(snpFilter, snpFile, maskDir):
+
+    settings = filterSettings(snpFilter)
+
+    if (settings == None):
+        return(None)
+
+    settings["maskFile"] = None
+
+    if (settings["chromosomes"] == None and len(settings["excludeChromosomes"]) == 0 and settings["mutations"] == "all"):
+        return(settings)
+
+    rowSettings = {key: settings[key] for key in ("chromosomes", "excludeChromosomes", "mutations")}
+    source = {"snpFile": os.path.abspath(snpFile), "size": os.path.getsize(snpFile), "mtime": os.path.getmtime(snpFile)}
+    digest = hashlib.sha1(json.dumps([rowSettings, source], sort_keys = True).encode()).hexdigest()
+    settings["maskFile"] = os.path.join(maskDir, f"mask.{digest}.npz")
+
+    if (os.path.exists(settings["maskFile"])):
+        return(settings)
+
+    with Instrument.timedStage("snpMask", unit = "SNPs") as timer:
+
+        chroms = []
+        positions = []
+        alleles = []
+        file = open(snpFile, 'r')
+
+        for line in file:
+
+            lineList = line.split() # should be in "rsID | chrom | pos | physPos | refAllele | newAllele" format
+            chroms.append(lineList[1])
+            positions.append(int(lineList[3]))
+            alleles.append((lineList[4].upper(), lineList[5].upper()))
+
+        file.close()
+
+        chroms = np.array(chroms, dtype = np.bytes_)
+        keep = np.ones(len(chroms), dtype = bool)
+
+        if (rowSettings["chromosomes"] != None):
+            keep &= np.isin(chroms, np.array(rowSettings["chromosomes"], dtype = np.bytes_))
+
+        if (len(rowSettings["excludeChromosomes"]) > 0):
+            keep &= ~np.isin(chroms, np.array(rowSettings["excludeChromosomes"], dtype = np.bytes_))
+
+        if (rowSettings["mutations"] != "all"):
+            transition = np.array([pair in transitions for pair in alleles], dtype = bool)
+            keep &= transition if rowSettings["mutations"] == "transitions" else ~transition
+
+        # written then renamed so a job never loads half a mask
+        os.makedirs(maskDir, exist_ok = True)
+        tempFile = open(f"{settings['maskFile']}.{os.getpid()}.tmp", 'wb')
+        np.savez(tempFile, chrom = chroms, pos = np.array(positions, dtype = np.int64), keep = keep)
+        tempFile.close()
+        os.replace(f"{settings['maskFile']}.{os.getpid()}.tmp", settings["maskFile"])
+
+        timer["done"] = len(keep)
+        Instrument.logEvent("mask", "snpMask", sites = len(keep), kept = int(keep.sum()), settings = rowSettings)
+
+    return(settings)
+
+'''
+Loads a compiled mask for looking up table rows.
+
+maskFile: mask from compileFilter()
+
+return: dictionary of chromosome (bytes) -> (sorted positions, keep
+        flag of each position)
+'''
+def loadMask(maskFile):
+
+    compiled = np.load(maskFile)
+    chroms = compiled["chrom"]
+    positions = compiled["pos"]
+    keep = compiled["keep"]
+    mask = {}
+
+    for chrom in np.unique(chroms):
+
+        snps = np.flatnonzero(chroms == chrom)
+        order = np.argsort(positions[snps], kind = "stable") # a position in the .snp file twice goes by its first line
+        mask[chrom] = (positions[snps][order], keep[snps][order])
+
+    return(mask)
+
+'''
+Looks rows of an .output or .reads table up in a mask. Rows that
+aren't SNPs of the .snp file are dropped.
+
+mask: mask from loadMask()
+chroms: chromosome of each row
+positions: position of each row
+
+return: numpy bool array, True for the rows to keep
+'''
+def rowMask(mask, chroms, positions):
+
+    chroms = np.asarray(chroms, dtype = np.bytes_)
+    positions = np.asarray(positions, dtype = np.int64)
+    keep = np.zeros(len(positions), dtype = bool)
+
+    for chrom in np.unique(chroms):
+
+        if (chrom not in mask):
+            continue
+
+        rows = np.flatnonzero(chroms == chrom)
+        snpPositions, snpKeep = mask[chrom]
+        found = np.minimum(np.searchsorted(snpPositions, positions[rows]), max(len(snpPositions) - 1, 0))
+        keep[rows] = (snpPositions[found] == positions[rows]) & snpKeep[found]
+
+    return(keep)
+
+'''
+Writes the rows of a .reads table a SNP filter keeps as a text table
+for Schraiber's parser. Works for text tables and binary stores.
+
+readsFile: .reads text file or .reads.store folder
+textFile: text file to write. WILL OVERWRITE.
+snpFilter: compiled filter from compileFilter(), or None for every row
+chunkSize: number of lines to look up at a time
+'''
+def writeReadsText(readsFile, textFile, snpFilter = None, chunkSize = 50000):
+
+    mask = None
+
+    if (snpFilter != None and snpFilter["maskFile"] != None):
+        mask = loadMask(snpFilter["maskFile"])
+
+    if (ReadStore.isStore(readsFile)):
+        rows = None
+
+        if (mask != None):
+            header, chroms, positions, freqs, counts = ReadStore.readStore(readsFile)
+            rows = np.flatnonzero(rowMask(mask, chroms, positions))
+
+        ReadStore.storeToText(readsFile, textFile, chunkSize, rows)
+        return()
+
+    inFile = open(readsFile, 'r')
+    outFile = open(textFile, 'w')
+    outFile.write(inFile.readline()) # header
+
+    while (True):
+
+        lines = list(itertools.islice(inFile, chunkSize))
+        if (len(lines) == 0):
+            break
+
+        if (mask != None):
+            fields = [line.split(None, 2) for line in lines]
+            keep = rowMask(mask, [field[0] for field in fields], [int(field[1]) for field in fields])
+            lines = [lines[row] for row in np.flatnonzero(keep)]
+
+        outFile.writelines(lines)
+
+    inFile.close()
+    outFile.close()
+
+'''
+Zeroes each individual's reads at SNPs where they have fewer or more
+reads than the filter's coverage range allows. Works in place like
+Schraiber's coverage_filter().
+
+read_lists: read_lists as given by Schraiber's parse_reads_by_pop()
+snpFilter: compiled filter from compileFilter() or None
+'''
+def coverageBand(read_lists, snpFilter):
+
+    if (snpFilter == None or snpFilter["coverage"] == None):
+        return()
+
+    low, high = snpFilter["coverage"]
+
+    for pop in read_lists:
+        for reads in pop:
+
+            depth = reads.sum(axis = 1)
+            outside = np.zeros(len(depth), dtype = bool)
+
+            if (low != None):
+                outside |= depth < low
+
+            if (high != None):
+                outside |= depth > high
+
+            reads[outside] = 0
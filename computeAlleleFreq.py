@@ -15,8 +15,13 @@
 #
 ######################################################
 
+import difflib
+import json
 import numpy as np
-import subprocess as sp
+import os
+import shutil
+import Instrument
+import ReadStore
 
 '''
 Reads fileName and adds line number (starting at 0) of specified population to a list
@@ -50,101 +55,542 @@ def readIndividuals(fileName, group):
     return(individuals, lineList)
 
 '''
-Uses string representing terminal command to run subprocess and return
-the output as a list of tokens
+Indexes an ind file once so populations and individuals can be looked up
+any number of times without scanning it again (see lookupIndividuals()).
 
-command: String representing terminal command
+fileName: ind file in eigenstrat format
+
+return: dictionary with "lines": list of the file's lines,
+        "samples": sample ID -> line number,
+        "populations": population label -> list of line numbers
+'''
+def readIndIndex(fileName):
+
+    index = {"lines": [], "samples": {}, "populations": {}}
+    file = open(fileName, 'r')
+
+    for line in file:
+
+        lineList = line.split() # in format "sample ID | sex | population"
+        lineNumber = len(index["lines"])
+        index["lines"].append(line)
+
+        if (len(lineList) < 3): # keeps line numbers in step with the geno columns
+            continue
+
+        index["samples"].setdefault(lineList[0], lineNumber)
+        index["populations"].setdefault(lineList[2], []).append(lineNumber)
+
+    file.close()
+
+    return(index)
+
+'''
+Looks a population or individual up in an index from readIndIndex().
+Unlike readIndividuals() names are matched whole, so "CHB" doesn't
+also pick up "CHB.SG" or an individual whose ID holds "CHB".
+
+index: index from readIndIndex()
+term: population label or sample ID. '' gives every individual.
+
+return: list of line numbers for searched individuals,
+        list of lines that matched search
+'''
+def lookupIndividuals(index, term):
+
+    if (term == ''):
+        lineNumbers = list(range(len(index["lines"])))
+    elif (term in index["populations"]):
+        lineNumbers = index["populations"][term]
+    elif (term in index["samples"]):
+        lineNumbers = [index["samples"][term]]
+    else:
+        lineNumbers = []
+
+    return(list(lineNumbers), [index["lines"][lineNumber] for lineNumber in lineNumbers])
+
+'''
+Finds the population labels and sample IDs closest to a term that
+matched nothing, for the error message. Names holding the term (the
+old substring matches, ex: "CHB.DG" for "CHB") come first.
+
+index: index from readIndIndex()
+term: population label or sample ID that wasn't found
+count: most names to give
+
+return: list of names
+'''
+def closestNames(index, term, count = 5):
+
+    names = list(index["populations"]) + list(index["samples"])
+    holding = [name for name in names if term in name]
+
+    return(list(dict.fromkeys(holding + difflib.get_close_matches(term, names, count)))[:count])
+
+'''
+Turns a block of raw geno file bytes into a matrix of genotype codes.
+Every line of an eigenstrat geno file has the same width, so the block
+can be viewed as a (# SNP's, lineWidth) array without parsing.
+
+block: bytes holding whole lines of the geno file
+lineWidth: length of one geno line including the newline
+individualIndices: Optional numpy array of columns to keep
+
+return: uint8 numpy array of shape (# SNP's in block, # columns) where
+        0, 1, 2 are copies of the reference allele and 9 is no data.
+        Returns None if the block doesn't split into equal width lines.
+'''
+def decodeGenoBlock(block, lineWidth, individualIndices = None):
+
+    if (len(block) % lineWidth != 0):
+        return(None)
+
+    genotypes = np.frombuffer(block, dtype = np.uint8).reshape(-1, lineWidth)
+
+    if (not np.all(genotypes[:, -1] == ord('\n'))): # every line must end where we think it does
+        return(None)
+
+    if (individualIndices is not None):
+        genotypes = genotypes[:, individualIndices]
+
+    return(genotypes - ord('0')) # '0' -> 0, '9' -> 9
+
+'''
+Checks whether a geno file is in packed (PACKEDANCESTRYMAP) format and
+reads its header. Packed files start with a record holding
+"GENO # individuals # SNP's ..." and every SNP after it is a record of
+2 bits per individual.
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
+
+return: (# individuals, # SNP's, record length in bytes) for a
+        packed file, None for a text geno file
+'''
+def readPackedGenoHeader(genoFile):
+
+    gFile = open(genoFile, 'rb')
+    header = gFile.read(48) # records are never shorter than 48 bytes
+    gFile.close()
+
+    if (not header.startswith(b"GENO")):
+        return(None)
+
+    headerList = header.split()
+    individualCount = int(headerList[1])
+    snpCount = int(headerList[2])
+    recordLength = max(48, (individualCount * 2 + 7) // 8)
+
+    return(individualCount, snpCount, recordLength)
+
+'''
+Unpacks the 2 bit genotypes of selected individuals from packed geno
+records. Individual i sits in byte i // 4, highest bits first. The packed
+value 3 means no data and is turned into 9 to match text geno files.
+
+records: uint8 numpy array of shape (# SNP's, record length)
+individualIndices: numpy array of individual columns to unpack
+
+return: uint8 numpy array of shape (# SNP's, # individuals) of genotype codes
+'''
+def unpackGenoBlock(records, individualIndices):
+
+    shifts = (6 - 2 * (individualIndices % 4)).astype(np.uint8)
+    genotypes = (records[:, individualIndices // 4] >> shifts) & 3
+    genotypes[genotypes == 3] = 9
+
+    return(genotypes)
+
+'''
+Gets the number of SNP's in a geno file without reading through it.
+Packed geno files have it in their header. Text geno lines all have
+the same width, so the file size gives it.
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
 
-return: list of string tokens from terminal output
+return: # of SNP's in the geno file
 '''
-def runSubprocess(command):
-    
-    runCommand = sp.Popen(command.split(), stdout = sp.PIPE)
-    terminalOutput = runCommand.communicate() # tuple of stdout (output, stderr)
+def countGenoSnps(genoFile):
 
-    # Formats output into usable encoding and trims extra chars so we'll just have our
-    # terminal output now. 
-    stdoutList = terminalOutput[0].decode("utf-8").split('\n') # should have ["terminal output", ""] stored
+    packedHeader = readPackedGenoHeader(genoFile)
 
-    tokens = stdoutList[0].split() # tokenizes terminal output into list of strings
+    if (packedHeader != None):
+        return(packedHeader[1])
 
-    return(tokens)
+    gFile = open(genoFile, 'rb')
+    lineWidth = len(gFile.readline()) # every line is one char per individual plus newline
+    gFile.close()
+
+    if (lineWidth == 0): # empty file
+        return(0)
+
+    # rounding up counts a last line without a newline
+    return((os.path.getsize(genoFile) + lineWidth - 1) // lineWidth)
+
+'''
+Reads a geno file block by block, giving only the selected individuals'
+genotype codes. Text geno files are read in blocks of lines. Packed geno
+files are memory mapped and only the selected individuals' bits are
+unpacked.
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
+individualIndices: numpy array of individual columns to keep
+blockSize: number of SNP's per block
+
+return: generator of uint8 numpy arrays of shape (# SNP's in block, # individuals).
+        Raises ValueError if the file isn't the size its header says or
+        a line isn't as wide as the first, rather than ending early.
+'''
+def readGenoBlocks(genoFile, individualIndices, blockSize = 100000):
+
+    packedHeader = readPackedGenoHeader(genoFile)
+
+    if (packedHeader != None):
+
+        individualCount, snpCount, recordLength = packedHeader
+
+        if (os.path.getsize(genoFile) != recordLength * (snpCount + 1)):
+            raise ValueError(f"{genoFile} is not the size its header says it is")
+
+        # first record is the header
+        records = np.memmap(genoFile, dtype = np.uint8, mode = 'r', offset = recordLength, shape = (snpCount, recordLength))
+
+        for blockStart in range(0, snpCount, blockSize):
+            yield(unpackGenoBlock(records[blockStart:blockStart + blockSize], individualIndices))
+
+        del records
+        return
+
+    gFile = open(genoFile, 'rb') # read as bytes so blocks can go straight into numpy
+    lineWidth = len(gFile.readline()) # every line is one char per individual plus newline
+    gFile.seek(0)
+    lineNumber = 0
+
+    while True:
+
+        block = gFile.read(lineWidth * blockSize)
+
+        if (not block):
+            break
+
+        if (len(block) % lineWidth == lineWidth - 1 and not block.endswith(b'\n')): # last line has no newline
+            block = block + b'\n'
+
+        genotypes = decodeGenoBlock(block, lineWidth, individualIndices)
+
+        if (genotypes is None): # stopping here would pass a truncated panel on as complete
+            lineEnds = np.frombuffer(block, dtype = np.uint8)[lineWidth - 1::lineWidth] != ord('\n')
+            badLine = lineNumber + (int(np.argmax(lineEnds)) if lineEnds.any() else len(lineEnds) - 1) + 1
+            gFile.close()
+            raise ValueError(f"{genoFile} line {badLine} isn't {lineWidth - 1} genotypes wide like line 1")
+
+        lineNumber += len(genotypes)
+
+        yield(genotypes)
+
+    gFile.close()
+
+'''
+Cuts each group's genotype columns out of the geno file into a small
+per-population panel, so later runs read megabytes instead of the whole
+geno file. A panel is {panelDir}/{group}.npy, a uint8 array of genotype
+codes with shape (# SNP's, # individuals in group), next to a
+{group}.json saying what it was cut from. Panels are reused while the
+geno file has the same path, size and mtime and the group the same
+individuals. Missing or stale panels are all cut in one pass.
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
+groupIndices: dictionary of group -> numpy array of the group's geno
+              columns (see lookupIndividuals())
+panelDir: folder for the panels
+blockSize: number of SNP's to cut at a time
+
+return: dictionary of group -> memory mapped uint8 numpy array
+'''
+def subPanels(genoFile, groupIndices, panelDir, blockSize = 100000):
+
+    os.makedirs(panelDir, exist_ok = True)
+    source = {"genoFile": os.path.abspath(genoFile), "size": os.path.getsize(genoFile), "mtime": os.path.getmtime(genoFile)}
+    snpCount = countGenoSnps(genoFile)
+    stale = []
+
+    for group in groupIndices:
+
+        panelFile = os.path.join(panelDir, f"{group}.npy")
+        infoFile = os.path.join(panelDir, f"{group}.json")
+
+        if (os.path.exists(panelFile) and os.path.exists(infoFile)):
+            file = open(infoFile, 'r')
+            info = json.load(file)
+            file.close()
+
+            if (info == dict(source, individuals = groupIndices[group].tolist())):
+                continue
+
+            os.remove(infoFile) # a panel without its .json is never reused, even if this run dies
+
+        stale.append(group)
+
+    if (len(stale) > 0):
+        allIndices = np.unique(np.concatenate([groupIndices[group] for group in stale] + [np.zeros(0, dtype = np.intp)]))
+        panels = {}
+        columns = {}
+
+        for group in stale: # written straight to disk, a big group's panel never has to fit in memory
+            panelFile = os.path.join(panelDir, f"{group}.npy")
+            panels[group] = np.lib.format.open_memmap(f"{panelFile}.tmp", mode = 'w+', dtype = np.uint8, shape = (snpCount, len(groupIndices[group])))
+            columns[group] = np.searchsorted(allIndices, groupIndices[group])
+
+        lineNumber = 0
+
+        try:
+            with Instrument.timedStage("subPanels", snpCount, "SNPs") as timer:
+
+                for genotypes in readGenoBlocks(genoFile, allIndices, blockSize):
+
+                    for group in stale:
+                        panels[group][lineNumber:lineNumber + len(genotypes)] = genotypes[:, columns[group]]
+
+                    lineNumber += len(genotypes)
+                    Instrument.progress(timer, lineNumber)
+
+        except Exception: # a bad geno file leaves no half cut panels behind
+            for group in stale:
+                del panels[group]
+                os.remove(os.path.join(panelDir, f"{group}.npy.tmp"))
+            raise
+
+        for group in stale:
+
+            panelFile = os.path.join(panelDir, f"{group}.npy")
+            panels[group].flush()
+            del panels[group]
+            os.replace(f"{panelFile}.tmp", panelFile)
+
+            file = open(os.path.join(panelDir, f"{group}.json"), 'w')
+            json.dump(dict(source, individuals = groupIndices[group].tolist()), file)
+            file.close()
+
+    return({group: np.load(os.path.join(panelDir, f"{group}.npy"), mmap_mode = 'r') for group in groupIndices})
+
+'''
+Computes derived allele frequencies of a set of individuals for a block
+of SNP's.
+
+genotypes: genotype code matrix from readGenoBlocks()
+individualIndices: numpy array of the individuals' columns
+
+return: numpy array of derived allele freqs (nan if no data),
+        numpy array of # individuals with no data for each SNP
+'''
+def blockAlleleFreqs(genotypes, individualIndices):
+
+    selected = genotypes[:, individualIndices]
+    hasData = selected != 9
+    missing = selected.shape[1] - np.count_nonzero(hasData, axis = 1)
+
+    refAlleles = np.where(hasData, selected, 0).sum(axis = 1, dtype = np.int64)
+    alleleTotal = 2 * (selected.shape[1] - missing) # we're diploid, two copies of each allele
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'): # SNP's with no data become nan
+        freqs = 1 - (refAlleles / alleleTotal)
+
+    return(freqs, missing)
 
 '''
 Use line numbers from ind file to search geno file for allele freqs for a single SNP.
+The geno file is read in large blocks that are decoded and summed as numpy
+arrays instead of one character at a time.
 
-genoFile: geno file in eigenstrat format
+genoFile: geno file in eigenstrat or packed eigenstrat format
 indFile: ind file in eigenstrat format
 snpFile: snp file in eigenstrat format
 group: Search term to select populations from ind file. To specify no group, enter ''
+blockSize: number of geno lines to decode at a time
 
 return: numpy array of freqs, # of lines in geno file (# SNP's), searched group name
 '''
-def computeAlleleFreq(genoFile, indFile, snpFile, group):
+def computeAlleleFreq(genoFile, indFile, snpFile, group, blockSize = 100000):
 
-    individualIndices, searchedLines = readIndividuals(indFile, group) # creates list of indices
+    return(computeAlleleFreqs(genoFile, indFile, snpFile, [group], blockSize)[group])
 
-    # need to count number of lines in .geno file to construct
+'''
+Computes allele freqs for several groups in one pass over the geno and
+snp files. Each block of the geno file is decoded once and every group's
+freqs are taken from it, so adding groups doesn't add file reads.
+Writes a {group}.output file for every group.
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
+indFile: ind file in eigenstrat format
+snpFile: snp file in eigenstrat format
+groups: list of populations (or individuals) in the ind file, matched
+        exactly (see lookupIndividuals())
+blockSize: number of geno lines to decode at a time
+panelDir: Optional folder of cached per-population panels (see subPanels())
+
+return: dictionary of group -> (numpy array of freqs, # of lines in geno
+        file (# SNP's), searched group name, # of missing genotypes)
+'''
+def computeAlleleFreqs(genoFile, indFile, snpFile, groups, blockSize = 100000, panelDir = None):
+
+    results = {}
+
+    for group, records in frequencyRecords(genoFile, indFile, snpFile, groups, blockSize, True, results, panelDir):
+        pass # the generator writes the files
+
+    return(results)
+
+'''
+Generator behind computeAlleleFreqs(). Gives each block's SNPs for every
+group as soon as the block is decoded, so they can go straight into
+appendAncientIndividuals() without writing {group}.output files and
+reading them back. SNPs at frequency 0 or 1 or with no data are left
+out, same as in {group}.output.
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
+indFile: ind file in eigenstrat format
+snpFile: snp file in eigenstrat format
+groups: list of populations (or individuals) in the ind file, matched
+        exactly (see lookupIndividuals())
+blockSize: number of geno lines to decode at a time
+outputFiles: if True {group}.output files are written along the way
+results: Optional dictionary that gets computeAlleleFreqs()'s return
+         value once the generator is used up
+panelDir: Optional folder of cached per-population panels (see
+          subPanels()). Freqs are read from the panels, cutting any
+          that are missing or out of date first.
+
+return: generator of (group, list of (chrom, pos, AF) strings), one per
+        group for each block
+'''
+def frequencyRecords(genoFile, indFile, snpFile, groups, blockSize = 100000, outputFiles = False, results = None, panelDir = None):
+
+    groupIndices = {}
+    outFiles = {}
+    freqs = {}
+    snpLost = {} # keeps track of how many SNP's had no data for each group
+
+    # need the number of SNP's in the .geno file to construct
     # the numpy array with the correct size. Appending to the
     # array requires resizing and becomes EXTREMELY expensive.
 
-    lineCount = runSubprocess(f"wc -l {genoFile}") # contains ["lineCount", "genoFile"]
+    snpCount = countGenoSnps(genoFile)
+    index = readIndIndex(indFile)
 
-    gFile = open(genoFile, 'r')
-    sFile = open(snpFile, 'r')
-    
-    outFile = open(f"{group}.output", 'w') # will overwrite contents of existing file
-    outFile.write(f"Chrom\tPos\tAF\n") # creates header, aFileHeader[10:] skips chrom and pos
+    for group in groups:
 
-    freqs = np.zeros(int(lineCount[0])) # one element for each SNP freq (line)
+        individualIndices, searchedLines = lookupIndividuals(index, group) # creates list of indices
+
+        if (len(individualIndices) == 0): # would give a header only .output and nan freqs
+            raise ValueError(f"{group} matches no population or individual in {indFile}, closest are: {', '.join(closestNames(index, group))}")
+
+        groupIndices[group] = np.array(individualIndices, dtype = np.intp)
+
+        if (outputFiles):
+            outFiles[group] = open(f"{group}.output.tmp", 'w') # replaces {group}.output once every SNP is written
+            outFiles[group].write(f"Chrom\tPos\tAF\n") # creates header
+
+        freqs[group] = np.zeros(snpCount) # one element for each SNP freq (line)
+        snpLost[group] = 0
+
+    # blocks are (# SNP's, group -> genotype codes), columns are each group's columns in them
+    if (panelDir != None):
+        panels = subPanels(genoFile, groupIndices, panelDir, blockSize)
+        columns = {group: slice(None) for group in groupIndices} # a panel is only its group's columns
+        blocks = ((min(blockSize, snpCount - start), {group: panels[group][start:start + blockSize] for group in groupIndices})
+                  for start in range(0, snpCount, blockSize))
+    else:
+        # only decode the individuals some group needs, each group
+        # then indexes into the columns of that smaller matrix
+        allIndices = np.unique(np.concatenate([groupIndices[group] for group in groupIndices] + [np.zeros(0, dtype = np.intp)]))
+        columns = {group: np.searchsorted(allIndices, groupIndices[group]) for group in groupIndices}
+        blocks = ((len(genotypes), {group: genotypes for group in groupIndices}) for genotypes in readGenoBlocks(genoFile, allIndices, blockSize))
+
+    sFile = open(snpFile, 'r')
     lineNumber  = 0  # represents which SNP we're on
-    snpInfoLine = sFile.readline() # for loop iterates over geno file, iterate over SNP file simultaneously
-    snpLost = 0 # keeps track of how many SNP's had no data for the group
-    
-    # for each line in file, calculate freq of SNP
-    for line in gFile:
+    finished = False
 
-        alleleTotal = 0
+    try:
+        with Instrument.timedStage("frequencies", snpCount, "SNPs") as timer:
 
-        # for each char in line, a 0 means no copies of reference allele, 1 is one
-        # copy, 2 is two copies, and 9 is no data. 9's are handled by excluding from
-        # total allele count.
-        for index in individualIndices:
+            for blockLength, genotypes in blocks:
 
-            if line[index] != '9': # if read has data
+                blockEnd = lineNumber + blockLength
+                snpInfoLines = [sFile.readline().split() for i in range(blockLength)] # iterate over SNP file alongside geno file
+                # should be in "rsID | chromosome | pos | physPos | refAllele | newAllele" format
 
-                freqs[lineNumber] += float(line[index]) # need to cast char to float for numpy array
-                alleleTotal += 2 # we're diploid, two copies of each allele
+                for group in groupIndices:
 
-            else:
-                snpLost += 1
-
-        freqs[lineNumber] = 1 - (freqs[lineNumber] / alleleTotal) # calculate derived allele freq step
-
-        # need to skip alleles at frequency 0 or 1 in reference modern
-        # population for Schraiber's program. Skips writing out line
-        # for SNP and moves to next iteration. Also skipping if snp
-        # has no data for calculating AF
-        if (freqs[lineNumber] == 0 or freqs[lineNumber] == 1 or np.isnan(freqs[lineNumber])):
-            # need to advance these before passing onto next iteration
-            snpInfoLine = sFile.readline()
-            lineNumber += 1 # advance to next SNP's counts
-            continue
+                    blockFreqs, missing = blockAlleleFreqs(genotypes[group], columns[group])
+                    freqs[group][lineNumber:blockEnd] = blockFreqs
+                    snpLost[group] += int(missing.sum())
 
-        lineList = snpInfoLine.split() # should be in "rsID | chromosome | pos | physPos | refAllele | newAllele" format
-        
-        # writing chrom, physpos, and allele freq
-        outFile.write(f"{lineList[1]}\t{lineList[3]}\t{freqs[lineNumber]}\n")
-        snpInfoLine = sFile.readline() # advance to info of next SNP
+                    # need to skip alleles at frequency 0 or 1 in reference modern
+                    # population for Schraiber's program. Also skipping if snp
+                    # has no data for calculating AF
+                    keep = ~((blockFreqs == 0) | (blockFreqs == 1) | np.isnan(blockFreqs))
 
-        lineNumber += 1 # advance to next SNP's counts
-            
-    gFile.close()
-    sFile.close() # for good practice
-    outFile.close()
+                    # chrom, physpos, and allele freq
+                    records = [(snpInfoLines[i][1], snpInfoLines[i][3], f"{blockFreqs[i]}") for i in np.flatnonzero(keep)]
+
+                    if (outputFiles):
+                        outFiles[group].writelines([f"{chrom}\t{pos}\t{freq}\n" for chrom, pos, freq in records])
+
+                    yield((group, records))
+
+                lineNumber = blockEnd # advance to next block's SNP's
+                Instrument.progress(timer, lineNumber)
+
+        finished = True
 
-    return(freqs, lineNumber, group, snpLost)
+    finally:
+        sFile.close() # for good practice
 
+        # a bad geno file, or a caller that stops reading (ex: a SNP missing
+        # from AncientReads), leaves the old {group}.output files as they were
+        if (not finished):
+            for group in outFiles:
+                outFiles[group].close()
+                os.remove(f"{group}.output.tmp")
+
+    for group in groupIndices:
+
+        if (outputFiles):
+            outFiles[group].close()
+            os.replace(f"{group}.output.tmp", f"{group}.output")
+
+        if (results != None):
+            results[group] = (freqs[group], lineNumber, group, snpLost[group])
+
+'''
+Reads {group}.output files made by computeAlleleFreqs() back as records
+for appendAncientIndividuals().
+
+groups: list of 1k genomes groups
+chunkSize: number of lines in each list of records
+
+return: generator of (group, list of (chrom, pos, AF) strings)
+'''
+def outputRecords(groups, chunkSize = 100000):
+
+    for group in groups:
+
+        groupFile = open(f"{group}.output", 'r') # opens 1k genome source file
+        groupFile.readline() # skip header
+        records = []
+
+        for line in groupFile:
+
+            lineList = line.split() # in format "chrom | pos | AF"
+            records.append((lineList[0], lineList[1], lineList[2]))
+
+            if (len(records) == chunkSize):
+                yield((group, records))
+                records = []
+
+        groupFile.close()
+
+        if (len(records) > 0):
+            yield((group, records))
 
 '''
 Appends the read data for an ancient individual to the
@@ -181,6 +627,115 @@ OUTPUTS
 '''
 def appendAncientIndividual(group, individuals, ancientFile, nameDict = None, indFile = None):
 
+    indLists = appendAncientIndividuals([group], [individuals], ancientFile, nameDict, indFile)
+
+    if (indLists == ()):
+        return()
+
+    return(indLists["_".join(individuals)])
+
+'''
+Loads AncientReads.output once into memory so any number of .reads
+files can be made from it without scanning it again.
+
+ancientFile: Preprocessed ancient individual data (from running
+             PreProcessReads.py). A .store folder is memory mapped
+             instead of parsed (see ReadStore.py).
+chunkSize: number of lines to convert to integers at a time
+
+return: list of header tokens,
+        dictionary of (chrom, pos) -> row number,
+        dictionary of (chrom, pos) -> list of row numbers for positions
+        that show up more than once,
+        numpy int32 array of read counts with shape (# SNP's, 3 * # individuals)
+        (the store's unsigned integer memory map for a .store)
+'''
+def loadAncientReads(ancientFile, chunkSize = 50000):
+
+    if (ReadStore.isStore(ancientFile)):
+        header, chroms, positions, freqs, counts = ReadStore.readStore(ancientFile)
+        rowIndex = {}
+        duplicateRows = {}
+
+        for rowNumber, key in enumerate(zip(chroms.astype(str).tolist(), positions.astype(str).tolist())):
+
+            if (key in rowIndex):
+                duplicateRows.setdefault(key, [rowIndex[key]]).append(rowNumber)
+            else:
+                rowIndex[key] = rowNumber
+
+        return(header, rowIndex, duplicateRows, counts)
+
+    aFile = open(ancientFile, 'r')
+    header = aFile.readline().split() # "Chrom | Pos | anc1_der | anc1_anc | anc1_other | anc2_der | ..."
+    rowIndex = {}
+    duplicateRows = {}
+    countChunks = []
+    chunk = []
+    rowNumber = 0
+
+    for line in aFile:
+
+        chrom, pos, reads = line.split(None, 2)
+        key = (chrom, pos)
+
+        if (key in rowIndex): # same SNP position listed more than once
+            duplicateRows.setdefault(key, [rowIndex[key]]).append(rowNumber)
+        else:
+            rowIndex[key] = rowNumber
+
+        chunk.append(reads)
+        rowNumber += 1
+
+        if (len(chunk) == chunkSize):
+            countChunks.append(np.array(" ".join(chunk).split(), dtype = np.int32).reshape(len(chunk), -1))
+            chunk = []
+
+    if (len(chunk) > 0):
+        countChunks.append(np.array(" ".join(chunk).split(), dtype = np.int32).reshape(len(chunk), -1))
+
+    aFile.close()
+
+    if (len(countChunks) > 0):
+        counts = np.vstack(countChunks)
+    else:
+        counts = np.zeros((0, len(header) - 2), dtype = np.int32)
+
+    return(header, rowIndex, duplicateRows, counts)
+
+'''
+Batch version of appendAncientIndividual(). AncientReads.output is loaded
+once and each {group}.output file is read once, then a .reads file (and
+.ind file if nameDict is given) is written for every group and sample set
+pair. Output files are the same as calling appendAncientIndividual() on
+each pair. Given records from frequencyRecords() instead, the SNPs are
+joined as the geno file is read and no {group}.output file is needed
+(see computeReads()).
+
+INPUTS
+groups: list of 1k genomes groups to append to
+sampleSets: list of LISTS of names of ancient individuals. Each list
+            becomes one .reads file per group.
+ancientFile: Preprocessed ancient individual data (from running
+             PreProcessReads.py).
+nameDict: Optional argument if your .bam file names don't match
+          the .ind file for your ancient individuals.
+indFile: If you give a nameDict, you need to provide the
+         corresponding .ind file.
+readsDir: Optional folder to write the .reads files to
+indDir: Optional folder to write the .ind files to
+binary: if True each .reads table is written as a {group}_{set}.reads.store
+        binary store instead of text (see ReadStore.py). Writing one
+        format removes the other so continuity.py never reads a stale copy.
+records: Optional generator of (group, list of (chrom, pos, AF)) in snp
+         file order for each group, like frequencyRecords() gives.
+         Read from the {group}.output files if not given.
+
+return: dictionary of sample set file name part ("ind1_ind2_...") ->
+        list of each individual's _der column in ancientFile
+'''
+def appendAncientIndividuals(groups, sampleSets, ancientFile, nameDict = None, indFile = None, readsDir = "", indDir = "", binary = False, records = None):
+
     # if we're given a nameDict, it's implied that the bamfile names
     # don't match what's in the .ind file for the ancient individual
     if (nameDict != None):
@@ -188,94 +743,187 @@ def appendAncientIndividual(group, individuals, ancientFile, nameDict = None, in
             print("You must provide a corresponding .ind file")
             return()
 
-        newIndFile = group
+        ancientIndex = readIndIndex(indFile) # looked up once per individual of every set
+        fixedDict = {} # making a new dictionary keeps the argument intact
 
-        for each in individuals:
-            newIndFile = f"{newIndFile}_{each}" # will finish as "group_ind1_ind2_..." for file name
+        for key in nameDict:
+            fixedDict[key] = nameDict[key].replace('_', '')
+
+    with Instrument.timedStage("loadAncientReads"):
+        aFileHeader, rowIndex, duplicateRows, counts = loadAncientReads(ancientFile)
+
+    indLists = {}
+    setColumns = {} # columns of counts for each sample set
+    setHeaders = {} # read columns of .reads header for each sample set
+    setIndLines = {} # lines of .ind file for each sample set
 
-        newIndFile = open(f"{newIndFile}.ind", "w")
+    for individuals in sampleSets:
+
+        setName = "_".join(individuals)
+        indList = [] # for keeping track of where individuals we want are in aFileHeader list
+        header = ""
 
         for each in individuals:
-            print(each)
-            print(nameDict[each])
-            print(individuals)
-            individualIndices, searchedLines = readIndividuals(indFile, nameDict[each])
-            fixedLine = searchedLines[0].replace('_', '') # need to remove underscores
-            newIndFile.write(fixedLine) # searchedLines should only contain 1 value
+            indList.append(aFileHeader.index(f"{each}_der")) # adds first index of ancient individual
 
-        newIndFile.close()
+        for i in range(len(indList)):
+            # adds anci_der anci_anc anci_other
+            for column in aFileHeader[indList[i]:indList[i] + 3]:
 
-    # contains header "Chrom | Pos | anc1_der | anc1_anc | anc1_other | anc2_der | ..."
-    aFile = open(ancientFile, 'r')
-    aFileLine = aFile.readline().split() # sitting on first line, is now in tokens
-    indList = [] # for keeping track of where individuals we want are in aFileLine list
+                if (nameDict != None): # need to base header off dictionary and remove '_'
+                    column = column.replace(individuals[i], fixedDict[individuals[i]])
 
-    for each in individuals:
-        indList.append(aFileLine.index(f"{each}_der")) # adds first index of ancient individual
+                header = f"{header}\t{column}"
 
-    groupFile = open(f"{group}.output", 'r') # opens 1k genome source file
-    outFile = group
+        if (nameDict != None):
+            setIndLines[setName] = []
 
-    for each in individuals:
-        outFile = f"{outFile}_{each}" # will finish as "group_ind1_ind2_..." for file name
+            for each in individuals:
+                individualIndices, searchedLines = lookupIndividuals(ancientIndex, nameDict[each])
 
-    outFile = open(f"{outFile}.reads", "w")
+                if (len(searchedLines) == 0):
+                    raise ValueError(f"{nameDict[each]} is not in {indFile}")
 
-    header = groupFile.readline() # won't start on header line in main loop
-    header = header.strip()
+                setIndLines[setName].append(searchedLines[0].replace('_', '')) # need to remove underscores
 
-    if (nameDict != None): # need to base header off dictionary and remove '_'
+        indLists[setName] = indList
+        setHeaders[setName] = header
+        setColumns[setName] = np.array([index - 2 + offset for index in indList for offset in range(3)], dtype = np.intp) # counts has no chrom and pos
 
-        fixedDict = {} # making a new dictionary keeps the argument intact
+    if (records == None):
+        records = outputRecords(groups)
 
-        for key in nameDict:
-            fixedDict[key] = nameDict[key].replace('_', '')
+    groupHeader = "Chrom\tPos\tAF"
+    readsFiles = {} # (group, setName) -> .reads file name
+    outFiles = {} # (group, setName) -> temporary text file, swapped in once every group is joined
+    groupChunks = {} # group -> list of (records, counts) kept for the stores
+    nextRows = {} # ancient reads are in the same order, matches are always after the last one
 
-        for i in range(len(indList)):
-            # adds anci_der anci_anc anci_other
-            # aFileLine[indList[i]] contains "individual_der".
-            # Here we replace "individual" with name in the
-            # dictionary but keep the "_der"
-            header = f"{header}\t{aFileLine[indList[i]].replace(individuals[i], fixedDict[individuals[i]])}\t{aFileLine[indList[i] + 1].replace(individuals[i], fixedDict[individuals[i]])}\t{aFileLine[indList[i] + 2].replace(individuals[i], fixedDict[individuals[i]])}"
+    for group in groups:
 
-    else:
+        groupChunks[group] = []
+        nextRows[group] = 0
 
-        for i in range(len(indList)):
-            # adds anci_der anci_anc anci_other
-            header = f"{header}\t{aFileLine[indList[i]]}\t{aFileLine[indList[i] + 1]}\t{aFileLine[indList[i] + 2]}" # adds anci_der anci_anc anci_other
+        for individuals in sampleSets:
 
-    outFile.write(f"{header}\n")
+            setName = "_".join(individuals)
+            readsFiles[(group, setName)] = os.path.join(readsDir, f"{group}_{setName}.reads")
 
-    aFileLine = aFile.readline() # sitting on first data line
-    
+            if (not binary):
+                outFiles[(group, setName)] = open(f"{readsFiles[(group, setName)]}.tmp", "w")
+                outFiles[(group, setName)].write(f"{groupHeader}{setHeaders[setName]}\n")
 
-    # for each line of 1k genome group, advance ancient reads file until
-    # on correct allele. We skipped alleles in cases where allele was
-    # was fixed, extinct, or had no data.
-    for line in groupFile:
+    with Instrument.timedStage("reads", unit = "SNPs") as timer:
 
-        lineList = line.split() # in format "chrom | pos | AF"
-        aFileLine = aFileLine.split() # in format "chrom | pos | anc1_der | anc1_anc | anc1_other | anc2_der..."
+        # for each line of 1k genome group, find the line of ancient reads
+        # for the same allele. We skipped alleles in cases where allele was
+        # was fixed, extinct, or had no data.
+        for group, chunk in records:
 
-        # if chrom or allele position don't match, need to advance
-        # to next line of ancient reads until they both do
+            rows = []
+            nextRow = nextRows[group]
 
-        while (lineList[0] != aFileLine[0] or lineList[1] != aFileLine[1]):
-            aFileLine = aFile.readline()
-            aFileLine = aFileLine.split()
+            for chrom, pos, freq in chunk:
 
-        writtenLine = f"{lineList[0]}\t{lineList[1]}\t{lineList[2]}"
+                key = (chrom, pos)
 
-        for i in range(len(indList)):
-            writtenLine = f"{writtenLine}\t{aFileLine[indList[i]]}\t{aFileLine[indList[i] + 1]}\t{aFileLine[indList[i] + 2]}"
+                if (key in duplicateRows):
+                    row = next((each for each in duplicateRows[key] if each >= nextRow), -1)
+                else:
+                    row = rowIndex.get(key, -1)
+
+                if (row < nextRow):
+                    records.close() # lets frequencyRecords() remove its .tmp files
+
+                    for pair in outFiles: # nothing half written is left behind
+                        outFiles[pair].close()
+                        os.remove(f"{readsFiles[pair]}.tmp")
+
+                    raise ValueError(f"{chrom} {pos} of {group} is not in {ancientFile}")
+
+                rows.append(row)
+                nextRow = row + 1
+
+            nextRows[group] = nextRow
+            chunkCounts = counts[np.array(rows, dtype = np.intp)]
+
+            if (binary):
+                groupChunks[group].append((chunk, chunkCounts))
+            else:
+                chunkLines = [f"{chrom}\t{pos}\t{freq}" for chrom, pos, freq in chunk]
+
+                for individuals in sampleSets:
+
+                    setName = "_".join(individuals)
+                    setCounts = chunkCounts[:, setColumns[setName]].tolist()
+                    for i in range(len(chunk)):
+                        readColumns = '\t'.join(map(str, setCounts[i]))
+                        outFiles[(group, setName)].write(f"{chunkLines[i]}\t{readColumns}\n")
 
-        outFile.write(f"{writtenLine}\n")
-        aFileLine = aFile.readline()
+            Instrument.progress(timer, timer["done"] + len(chunk))
+
+        for group in groups:
+
+            if (binary):
+                groupRecords = [record for chunk, chunkCounts in groupChunks[group] for record in chunk]
+                groupCounts = np.vstack([chunkCounts for chunk, chunkCounts in groupChunks[group]] + [counts[:0]])
+
+            for individuals in sampleSets:
+
+                setName = "_".join(individuals)
+                readsFile = readsFiles[(group, setName)]
+
+                if (nameDict != None):
+                    newIndFile = open(os.path.join(indDir, f"{group}_{setName}.ind"), "w")
+                    newIndFile.writelines(setIndLines[setName])
+                    newIndFile.close()
+
+                if (binary):
+                    if (os.path.exists(readsFile)):
+                        os.remove(readsFile)
+
+                    ReadStore.writeStore(f"{readsFile}.store", f"{groupHeader}{setHeaders[setName]}".split(),
+                                         [record[0] for record in groupRecords], [int(record[1]) for record in groupRecords],
+                                         groupCounts[:, setColumns[setName]], [float(record[2]) for record in groupRecords])
+                    continue
+
+                if (os.path.isdir(f"{readsFile}.store")):
+                    shutil.rmtree(f"{readsFile}.store")
+
+                outFiles[(group, setName)].close()
+                os.replace(f"{readsFile}.tmp", readsFile)
+
+    return(indLists)
+
+'''
+Makes the .reads (and .ind) files straight from the eigenstrat panel.
+Freqs from each block of the geno file are joined against the ancient
+reads as soon as they're computed, so {group}.output files don't have
+to be written and read back. Output files are the same as running
+computeAlleleFreqs() then appendAncientIndividuals().
+
+genoFile: geno file in eigenstrat or packed eigenstrat format
+indFile: ind file in eigenstrat format of the modern panel
+snpFile: snp file in eigenstrat format
+groups: list of 1k genomes groups
+sampleSets: list of LISTS of names of ancient individuals
+ancientFile: Preprocessed ancient individual data (from running PreProcessReads.py)
+nameDict: Optional, see appendAncientIndividuals()
+ancientIndFile: .ind file for your ancient individuals if you give a nameDict
+readsDir: Optional folder to write the .reads files to
+indDir: Optional folder to write the .ind files to
+binary: if True .reads tables are written as binary stores
+outputFiles: if True {group}.output files are still written
+blockSize: number of geno lines to decode at a time
+panelDir: Optional folder of cached per-population panels (see subPanels())
+
+return: same as appendAncientIndividuals()
+'''
+def computeReads(genoFile, indFile, snpFile, groups, sampleSets, ancientFile, nameDict = None, ancientIndFile = None, readsDir = "", indDir = "", binary = False, outputFiles = False, blockSize = 100000, panelDir = None):
 
-    aFile.close()   # for good practice
-    outFile.close()
+    records = frequencyRecords(genoFile, indFile, snpFile, groups, blockSize, outputFiles, None, panelDir)
 
-    return(indList)
+    return(appendAncientIndividuals(groups, sampleSets, ancientFile, nameDict, ancientIndFile, readsDir, indDir, binary, records))
 
 
 #####################################################
@@ -284,85 +932,91 @@ def appendAncientIndividual(group, individuals, ancientFile, nameDict = None, in
 #
 #####################################################
 
-#eigenstratIndFile   = "v42.4.1240K.EG.ind"
-#eigenstratGenoFile  = "v42.4.1240K.EG.geno"
-
-
-'''
-testIndFile = "test.ind"
-testGenoFile = "test.geno"
-testSNPFile = "test.snp"
-searchTerm = "test"
-chimpFile = "testChimp.geno"
-reads = "AncientReads.output"
-computeAlleleFreq(testGenoFile, testIndFile, testSNPFile, searchTerm, reads)
-'''
-
-IndFile = "v42.4.1240K.EG.ind"
-GenoFile = "v42.4.1240K.EG.geno"
-SNPFile = "v42.4.1240K.EG.snp"
-#searchTerm = "CHB"
-reads = "AncientReads.output"
-
-#searchTerms = ["ACB", "ASW","BEB", "GBR", "CDX", "CLM", "ESN", "FIN", "GWD", "GIH", "CHB", "CHS", "IBS", "ITU", "JPT", "KHV", "LWK", "MSL", "MXL", "PEL", "PUR", "PJL", "STU", "TSI", "YRI", "CEU"]
-searchTerms = ["CHB", "CHS", "CDX", "JPT", "KHV", "CEU"]
-
-'''
-for group in searchTerms:
-     results = computeAlleleFreq(GenoFile, IndFile, SNPFile, group)
-     print(group, results[3])
-'''
-
-ancientIndividuals = ["HRR051935", "HRR051936", "HRR051937",\
-                      "HRR051938", "HRR051939", "HRR051940",\
-                      "HRR051941", "HRR051942", "HRR051943",\
-                      "HRR051944", "HRR051945", "HRR051946",\
-                      "HRR051947", "HRR051948", "HRR051949",\
-                      "HRR051950", "HRR051951", "HRR051952",\
-                      "HRR051954", "HRR051955",\
-                      "HRR051956", "HRR051958",\
-                      "HRR051959", "HRR051960"]
-
-ancientDict = {"HRR051935":"Yumin",\
-               "HRR051936":"Bianbian",\
-               "HRR051937":"BS",\
-               "HRR051938":"XJS1309_M7",\
-               "HRR051939":"XJS1311_M16",\
-               "HRR051940":"XJS1309_M4",\
-               "HRR051941":"Xiaogao",\
-               "HRR051942":"Qihe2_d",\
-               "HRR051943":"LD1",\
-               "HRR051944":"LD2",\
-               "HRR051945":"SuogangB1_d",\
-               "HRR051946":"SuogangB3_d",\
-               "HRR051947":"L5705",\
-               "HRR051948":"L5700",\
-               "HRR051949":"L5692_d",\
-               "HRR051950":"L5706_d",\
-               "HRR051951":"L5704_d",\
-               "HRR051952":"L5703_d",\
-               "HRR051954":"L5701_d",\
-               "HRR051955":"L7415",\
-               "HRR051956":"L7417_d",\
-               "HRR051958":"L5698_d",\
-               "HRR051959":"L5696_d",\
-               "HRR051960":"L5694"}
-'''
-# removed HRR051957 and HRR051953 for not having a corresponding name in the ind file
-for group in searchTerms:
-    for each in ancientIndividuals:
-        appendAncientIndividual(group, [each], reads, ancientDict, "ind/early_CN.ind")
-'''
-
-for group in searchTerms:
-    appendAncientIndividual(group, ["HRR051935"], "AncientReads.output", ancientDict, "early_CN.ind") # yumin
-    appendAncientIndividual(group, ["HRR051936"], "AncientReads.output", ancientDict, "early_CN.ind") # bianbian
-    appendAncientIndividual(group, ["HRR051937"], "AncientReads.output", ancientDict, "early_CN.ind") # boshan
-    appendAncientIndividual(group, ["HRR051938", "HRR051939", "HRR051940"], "AncientReads.output", ancientDict, "early_CN.ind") # Xiaojinshan
-    appendAncientIndividual(group, ["HRR051941"], "AncientReads.output", ancientDict, "early_CN.ind") # XIaogao
-    appendAncientIndividual(group, ["HRR051942"], "AncientReads.output", ancientDict, "early_CN.ind") # Qihe
-    appendAncientIndividual(group, ["HRR051943", "HRR051944"], "AncientReads.output", ancientDict, "early_CN.ind") # Liangdao
-    appendAncientIndividual(group, ["HRR051945"], "AncientReads.output", ancientDict, "early_CN.ind") # Suogang
-    appendAncientIndividual(group, ["HRR051947", "HRR051948", "HRR051949", "HRR051950"], "AncientReads.output", ancientDict, "early_CN.ind") # Xitoucun
-    appendAncientIndividual(group, ["HRR051955", "HRR051956", "HRR051958"], "AncientReads.output", ancientDict, "early_CN.ind") # Tanshishan
-    appendAncientIndividual(group, ["HRR051960"], "AncientReads.output", ancientDict, "early_CN.ind") # Chuanyun
+# guard lets the pipeline driver import this file without running it
+if __name__ == "__main__":
+
+    #eigenstratIndFile   = "v42.4.1240K.EG.ind"
+    #eigenstratGenoFile  = "v42.4.1240K.EG.geno"
+
+
+    '''
+    testIndFile = "test.ind"
+    testGenoFile = "test.geno"
+    testSNPFile = "test.snp"
+    searchTerm = "test"
+    chimpFile = "testChimp.geno"
+    reads = "AncientReads.output"
+    computeAlleleFreq(testGenoFile, testIndFile, testSNPFile, searchTerm, reads)
+    '''
+
+    IndFile = "v42.4.1240K.EG.ind"
+    GenoFile = "v42.4.1240K.EG.geno"
+    SNPFile = "v42.4.1240K.EG.snp"
+    #searchTerm = "CHB"
+    reads = "AncientReads.output"
+
+    #searchTerms = ["ACB", "ASW","BEB", "GBR", "CDX", "CLM", "ESN", "FIN", "GWD", "GIH", "CHB", "CHS", "IBS", "ITU", "JPT", "KHV", "LWK", "MSL", "MXL", "PEL", "PUR", "PJL", "STU", "TSI", "YRI", "CEU"]
+    searchTerms = ["CHB", "CHS", "CDX", "JPT", "KHV", "CEU"]
+
+    '''
+    # one pass over the geno file for every group
+    results = computeAlleleFreqs(GenoFile, IndFile, SNPFile, searchTerms)
+    for group in searchTerms:
+         print(group, results[group][3])
+    '''
+
+    ancientIndividuals = ["HRR051935", "HRR051936", "HRR051937",\
+                          "HRR051938", "HRR051939", "HRR051940",\
+                          "HRR051941", "HRR051942", "HRR051943",\
+                          "HRR051944", "HRR051945", "HRR051946",\
+                          "HRR051947", "HRR051948", "HRR051949",\
+                          "HRR051950", "HRR051951", "HRR051952",\
+                          "HRR051954", "HRR051955",\
+                          "HRR051956", "HRR051958",\
+                          "HRR051959", "HRR051960"]
+
+    ancientDict = {"HRR051935":"Yumin",\
+                   "HRR051936":"Bianbian",\
+                   "HRR051937":"BS",\
+                   "HRR051938":"XJS1309_M7",\
+                   "HRR051939":"XJS1311_M16",\
+                   "HRR051940":"XJS1309_M4",\
+                   "HRR051941":"Xiaogao",\
+                   "HRR051942":"Qihe2_d",\
+                   "HRR051943":"LD1",\
+                   "HRR051944":"LD2",\
+                   "HRR051945":"SuogangB1_d",\
+                   "HRR051946":"SuogangB3_d",\
+                   "HRR051947":"L5705",\
+                   "HRR051948":"L5700",\
+                   "HRR051949":"L5692_d",\
+                   "HRR051950":"L5706_d",\
+                   "HRR051951":"L5704_d",\
+                   "HRR051952":"L5703_d",\
+                   "HRR051954":"L5701_d",\
+                   "HRR051955":"L7415",\
+                   "HRR051956":"L7417_d",\
+                   "HRR051958":"L5698_d",\
+                   "HRR051959":"L5696_d",\
+                   "HRR051960":"L5694"}
+    '''
+    # removed HRR051957 and HRR051953 for not having a corresponding name in the ind file
+    for group in searchTerms:
+        for each in ancientIndividuals:
+            appendAncientIndividual(group, [each], reads, ancientDict, "ind/early_CN.ind")
+    '''
+
+    sampleSets = [["HRR051935"], # yumin
+                  ["HRR051936"], # bianbian
+                  ["HRR051937"], # boshan
+                  ["HRR051938", "HRR051939", "HRR051940"], # Xiaojinshan
+                  ["HRR051941"], # XIaogao
+                  ["HRR051942"], # Qihe
+                  ["HRR051943", "HRR051944"], # Liangdao
+                  ["HRR051945"], # Suogang
+                  ["HRR051947", "HRR051948", "HRR051949", "HRR051950"], # Xitoucun
+                  ["HRR051955", "HRR051956", "HRR051958"], # Tanshishan
+                  ["HRR051960"]] # Chuanyun
+
+    # loads AncientReads.output once for every group and sample set
+    appendAncientIndividuals(searchTerms, sampleSets, reads, ancientDict, "early_CN.ind")
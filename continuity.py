@@ -1,76 +1,1019 @@
 import ancient_genotypes as a_g
+import Instrument
+import ReadStore
+import SnpFilter
+import hashlib
+import json
+import os
 import scipy.stats
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-modern_pops = ["CHB", "CHS", "CDX", "JPT", "KHV", "CEU"]
 '''
-ancient_Individuals = ["HRR051935", "HRR051936", "HRR051937",\
-                      "HRR051938", "HRR051939", "HRR051940",\
-                      "HRR051941", "HRR051942", "HRR051943",\
-                      "HRR051944", "HRR051945", "HRR051946",\
-                      "HRR051947", "HRR051948", "HRR051949",\
-                      "HRR051950", "HRR051951", "HRR051952",\
-                      "HRR051954", "HRR051955",\
-                      "HRR051956", "HRR051958",\
-                      "HRR051959", "HRR051960"]
+Hashes the contents of files so a cache entry is only reused while
+the files it was made from are unchanged.
+
+fileNames: list of files to hash
+
+return: hex digest
+'''
+def hashFiles(fileNames):
+
+    digest = hashlib.sha1()
+
+    for fileName in fileNames:
+        file = open(fileName, 'rb')
+
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+
+        file.close()
+
+    return(digest.hexdigest())
+
 '''
+Lists the files a (group, individual) pair is read from, for hashing.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set), or a
+            virtual sample set (see combinePair())
+
+return: list of file paths, a .reads.store's files in place of the
+        .reads file when there's only the store
+'''
+def pairFiles(group, individual):
+
+    if (not isinstance(individual, str)): # read from its members' pairs
+        return([each for member in setMembers(individual) for each in pairFiles(group, member)])
+
+    readsFile = "reads/" + group + '_' + individual + ".reads"
+    indFile = "ind/" + group + '_' + individual + ".ind"
+
+    if (not os.path.exists(readsFile) and os.path.isdir(f"{readsFile}.store")):
+        return(ReadStore.storeFiles(f"{readsFile}.store") + [indFile])
+
+    return([readsFile, indFile])
+
 '''
-ancient_Individuals = ["HRR051935", "HRR051936", "HRR051937",
-                        "HRR051938_HRR051939_HRR051940", "HRR051941",
-                        "HRR051942", "HRR051943_HRR051944",
-                        "HRR051945_HRR051946",
-                        "HRR051947_HRR051948_HRR051949_HRR051950_HRR051951_HRR051952_HRR051954",
-                        "HRR051955_HRR051956_HRR051958_HRR051959",
-                        "HRR051960"]
+Parses the .reads/.ind pair of a (group, individual) pair with
+Schraiber's parse_reads_by_pop(), going through a binary cache when
+cacheDir is given. Cache files are .npz named by a hash of the .reads
+and .ind contents, so reruns and both hypotheses load the parsed
+arrays instead of parsing text again. If there's no .reads file but
+there is a .reads.store (see ReadStore.py), a temporary text copy is
+made for the parser. A temporary copy is also made with only the rows
+a SNP filter keeps, and the filter's mask goes into the cache name.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set)
+cacheDir: Optional folder for parsed data
+snpFilter: Optional compiled SNP filter (see SnpFilter.compileFilter())
+
+return: unique_pops, freqs, read_lists as given by parse_reads_by_pop()
 '''
-ancient_Individuals = ["HRR051935", "HRR051936", "HRR051937",
-                        "HRR051938_HRR051939_HRR051940", "HRR051941",
-                        "HRR051942", "HRR051943_HRR051944",
-                        "HRR051945",
-                        "HRR051947_HRR051948_HRR051949_HRR051950",
-                        "HRR051955_HRR051956_HRR051958",
-                        "HRR051960"]
+def parsePair(group, individual, cacheDir = None, snpFilter = None):
+
+    readsFile = "reads/" + group + '_' + individual + ".reads"
+    indFile = "ind/" + group + '_' + individual + ".ind"
+    storeFile = f"{readsFile}.store"
+    fromStore = not os.path.exists(readsFile) and os.path.isdir(storeFile)
+    maskFile = None if snpFilter == None else snpFilter["maskFile"]
+
+    if (cacheDir != None):
+        cacheName = hashFiles(pairFiles(group, individual))
+
+        if (maskFile != None): # each filter parses its own rows
+            cacheName = f"{cacheName}.{os.path.splitext(os.path.basename(maskFile))[0]}"
+
+        cacheFile = os.path.join(cacheDir, f"{cacheName}.npz")
+
+        if (os.path.exists(cacheFile)):
+            cache = np.load(cacheFile)
+            unique_pops = list(cache["unique_pops"])
+            freqs = []
+            read_lists = []
+
+            for pop in range(len(unique_pops)):
+                freqs.append(cache[f"freqs_{pop}"])
+                read_lists.append([cache[f"reads_{pop}_{ind}"] for ind in range(int(cache[f"inds_{pop}"]))])
+
+            return(unique_pops, freqs, read_lists)
+
+    # reading in data, the parser's "Reading line" prints go to the log instead of stdout
+    with Instrument.timedStage("parse", report = False), Instrument.capturedStdout("parse", pair = f"{group}_{individual}"):
+
+        if (fromStore or maskFile != None): # Schraiber's parser only reads text, and reads every row
+            textFile = f"{readsFile}.{os.getpid()}.tmp"
+            SnpFilter.writeReadsText(storeFile if fromStore else readsFile, textFile, snpFilter)
+            unique_pops, inds, label, pops, freqs, read_lists = a_g.parse_reads_by_pop(textFile, indFile)
+            os.remove(textFile)
+        else:
+            unique_pops, inds, label, pops, freqs, read_lists = a_g.parse_reads_by_pop(readsFile, indFile)
+
+    if (cacheDir != None):
+        arrays = {"unique_pops": np.array([str(pop) for pop in unique_pops])}
+
+        for pop in range(len(unique_pops)):
+            arrays[f"freqs_{pop}"] = np.asarray(freqs[pop])
+            arrays[f"inds_{pop}"] = len(read_lists[pop])
+
+            for ind in range(len(read_lists[pop])):
+                arrays[f"reads_{pop}_{ind}"] = np.asarray(read_lists[pop][ind])
+
+        # write then rename so a job reading the cache never sees half a file
+        os.makedirs(cacheDir, exist_ok = True)
+        tempFile = open(f"{cacheFile}.{os.getpid()}.tmp", 'wb')
+        np.savez(tempFile, **arrays)
+        tempFile.close()
+        os.replace(f"{cacheFile}.{os.getpid()}.tmp", cacheFile)
+
+    return(unique_pops, freqs, read_lists)
+
 '''
-modern_pops = ["KHV", "CEU"]
-ancient_Individuals = ["HRR051935"]
+Name of a sample set in results and record file names.
+
+individual: ancient individual, "ind1_ind2_..." sample set or a
+            virtual sample set (see combinePair())
+
+return: the name as is, or for a virtual sample set its members joined
+        by '_' with pooled members joined by '+' (ex: "ind1_ind2+ind3")
+'''
+def pairName(individual):
+
+    if (isinstance(individual, str)):
+        return(individual)
+
+    return("_".join(member if isinstance(member, str) else "+".join(member) for member in individual))
+
+'''
+Lists the single ancient individuals a virtual sample set is made of.
+
+individuals: virtual sample set (see combinePair())
+
+return: list of individuals in order, pooled ones included
+'''
+def setMembers(individuals):
+
+    members = []
+
+    for member in individuals:
+        members.extend([member] if isinstance(member, str) else member)
+
+    return(members)
+
+'''
+Builds a sample set in memory from the pairs of its single members,
+so a new grouping of ancient individuals needs no .reads/.ind files
+of its own and nothing is parsed again (with cacheDir, each member's
+pair is parsed once and loaded from the cache after that). Every
+member needs a {group}_{member}.reads (or .reads.store) and .ind pair
+holding only that individual. Members are grouped by the population in
+their .ind file, the same as Schraiber's parser does for a file with
+all of them in it. A member that is itself a list is pooled: its
+individuals' read counts are added up into one individual, like
+merging their bam files. Pooled individuals must share a population.
+
+group: 1k genomes group
+individuals: list of ancient individuals and lists of individuals to
+             pool (ex: ["HRR051938", ["HRR051939", "HRR051940"]])
+cacheDir: Optional folder for parsed data (see parsePair())
+snpFilter: Optional compiled SNP filter (see SnpFilter.compileFilter())
+
+return: unique_pops, freqs, read_lists like parsePair()
+'''
+def combinePair(group, individuals, cacheDir = None, snpFilter = None):
+
+    freqs = None
+    popReads = {} # population -> list of read arrays, one per (pooled) individual
+
+    for member in individuals:
+
+        pooled = [member] if isinstance(member, str) else member
+        reads = None
+
+        for each in pooled:
+
+            pops, memberFreqs, memberLists = parsePair(group, each, cacheDir, snpFilter)
+
+            if (len(pops) != 1 or len(memberLists[0]) != 1):
+                raise ValueError(f"{group}_{each} has to hold a single ancient individual")
+
+            # every member's pair comes from the same {group}.output rows
+            if (freqs is None):
+                freqs = np.asarray(memberFreqs[0])
+                firstMember = each
+            elif (not np.array_equal(np.asarray(memberFreqs[0]), freqs)):
+                raise ValueError(f"{group}_{each} and {group}_{firstMember} don't have the same SNPs")
+
+            if (reads is None):
+                reads = np.array(memberLists[0][0]) # a copy, coverage_filter() changes it in place
+                pop = pops[0]
+            elif (pops[0] != pop):
+                raise ValueError(f"can't pool {', '.join(pooled)}, they're not in the same population")
+            else:
+                reads = reads + np.asarray(memberLists[0][0])
+
+        popReads.setdefault(pop, []).append(reads)
+
+    unique_pops = sorted(popReads)
+
+    return(unique_pops, [freqs.copy() for pop in unique_pops], [popReads[pop] for pop in unique_pops])
+
+'''
+Reads the .reads/.ind pair made by appendAncientIndividuals() for a
+(modern population, ancient individual) pair and removes extremely
+high and low coverage SNPs. With a SNP filter only the SNPs it keeps
+are read, and reads outside its coverage range are zeroed first.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set), or a
+            list for a virtual sample set built by combinePair()
+cacheDir: Optional folder for parsed data (see parsePair())
+snpFilter: Optional compiled SNP filter (see SnpFilter.compileFilter())
+
+return: unique_pops, freqs, read_lists as given by Schraiber's parse_reads_by_pop()
 '''
-for group in modern_pops:
-    for individual in ancient_Individuals:
+def readPair(group, individual, cacheDir = None, snpFilter = None):
 
-        # reading in data
-        unique_pops, inds, label, pops, freqs, read_lists = a_g.parse_reads_by_pop("reads/" + group + '_' + individual +".reads", "ind/" + group + '_' + individual + ".ind")
+    if (isinstance(individual, str)):
+        unique_pops, freqs, read_lists = parsePair(group, individual, cacheDir, snpFilter)
+    else:
+        unique_pops, freqs, read_lists = combinePair(group, individual, cacheDir, snpFilter)
 
+    SnpFilter.coverageBand(read_lists, snpFilter)
+
+    if (snpFilter == None or snpFilter["percentileFilter"]):
         a_g.coverage_filter(read_lists) # removing extremely high and low coverage SNPs
 
-        # estimating parameters
-        opts_cont_false = a_g.optimize_pop_params_error_parallel(freqs,read_lists,48,continuity=False) #will only use one core; you can change the 1 to however many cores you want to use
-        print(opts_cont_false)
-        opts_cont_true = a_g.optimize_pop_params_error_parallel(freqs,read_lists,48,continuity=True)
-        print(opts_cont_true)
-        likelihood_false = np.array([-x[1] for x in opts_cont_false]) #minus sign is because scipy.optimize minimizes the negative log likelihood
-        likelihood_true = np.array([-x[1] for x in opts_cont_true])
-        LRT = 2*(likelihood_false - likelihood_true)
-        p_vals = scipy.stats.chi2.logsf(LRT,1) #returns the LOG p-values
+    return(unique_pops, freqs, read_lists)
+
+'''
+Collapses the SNPs of each population into their unique (frequency,
+read counts of every individual) patterns. At low coverage most SNPs
+share a few patterns, so the weights say how much of the data each
+distinct likelihood term stands for.
+
+freqs: freqs as given by readPair()
+read_lists: read_lists as given by readPair()
+
+return: list with (numpy array of pattern freqs, list of numpy arrays of
+        pattern reads for each individual, numpy array of # SNPs with
+        each pattern) for each population
+'''
+def collapsePatterns(freqs, read_lists):
+
+    patterns = []
+
+    for pop in range(len(freqs)):
+
+        popFreqs = np.asarray(freqs[pop], dtype = np.float64)
+        readColumns = [np.asarray(reads).reshape(len(popFreqs), -1) for reads in read_lists[pop]]
+        rows = np.hstack([popFreqs.reshape(-1, 1)] + [reads.astype(np.float64) for reads in readColumns])
+        unique, weights = np.unique(rows, axis = 0, return_counts = True)
+        patternReads = []
+        column = 1
+
+        for reads in readColumns:
+            patternReads.append(unique[:, column:column + reads.shape[1]].astype(reads.dtype))
+            column += reads.shape[1]
+
+        patterns.append((unique[:, 0], patternReads, weights))
+
+    return(patterns)
+
+'''
+Drops the SNPs no individual of a population has reads at (including
+the ones coverage_filter() zeroed). With no reads a SNP's likelihood is
+1 whatever t1, t2 and the error rates are, so the fit is unchanged, but
+at low coverage these are most of the SNPs the optimizer goes over on
+every step. A population left with no SNPs has nothing to fit, so it's
+dropped and logged as skipped. The SNP and informative SNP counts are
+logged, and the distinct pattern counts when asked for (see
+collapsePatterns(), it sorts every informative SNP, so once a pair is
+enough).
+
+freqs: freqs as given by readPair()
+read_lists: read_lists as given by readPair()
+pair: "group_individual" name to log the counts under
+countPatterns: if True the number of distinct patterns is logged too
+
+return: list of the populations kept (indices into unique_pops),
+        freqs, read_lists of those populations with only the SNPs that
+        have reads
+'''
+def informativeSites(freqs, read_lists, pair, countPatterns = False):
+
+    kept = []
+    keptFreqs = []
+    keptReads = []
+    counts = []
+
+    for pop in range(len(freqs)):
+
+        popFreqs = np.asarray(freqs[pop])
+        covered = np.zeros(len(popFreqs), dtype = bool)
+
+        for reads in read_lists[pop]:
+            covered |= np.asarray(reads).reshape(len(popFreqs), -1).sum(axis = 1) > 0
+
+        counts.append({"sites": len(popFreqs), "informative": int(covered.sum())})
+
+        if (not covered.any()): # the optimizer would get empty arrays
+            continue
+
+        kept.append(pop)
+        keptFreqs.append(popFreqs[covered])
+        keptReads.append([np.asarray(reads)[covered] for reads in read_lists[pop]])
+
+    if (countPatterns):
+        for pop, (patternFreqs, patternReads, weights) in zip(kept, collapsePatterns(keptFreqs, keptReads)):
+            counts[pop]["patterns"] = len(weights)
+
+    Instrument.logEvent("sites", "fit", pair = pair, populations = counts)
+
+    if (len(kept) < len(freqs)):
+        Instrument.logEvent("skipped", "fit", pair = pair, populations = [pop for pop in range(len(freqs)) if pop not in kept],
+                            reason = "no SNPs with reads")
+
+    return(kept, keptFreqs, keptReads)
+
+'''
+Fits one hypothesis for one (group, individual) pair. This is a single
+job of the continuity grid and runs in its own process.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set), or a virtual sample set (see combinePair())
+continuity: True to fit the continuity model, False for the unrestricted one
+cores: number of cores Schraiber's optimizer may use for this job
+cacheDir: Optional folder for parsed data (see parsePair())
+snpFilter: Optional compiled SNP filter (see SnpFilter.compileFilter())
+
+return: list holding (group, individual, continuity, populations, optimizer output)
+'''
+def fitHypothesis(group, individual, continuity, cores, cacheDir = None, snpFilter = None):
+
+    unique_pops, freqs, read_lists = readPair(group, individual, cacheDir, snpFilter)
+    # both hypotheses see the same SNPs, patterns are counted by the first
+    kept, freqs, read_lists = informativeSites(freqs, read_lists, f"{group}_{pairName(individual)}", not continuity)
+    unique_pops = [unique_pops[pop] for pop in kept]
+
+    # estimating parameters
+    with Instrument.timedStage("fit", report = False):
+        opts = a_g.optimize_pop_params_error_parallel(freqs,read_lists,cores,continuity=continuity)
+
+    return([(group, pairName(individual), continuity, unique_pops, opts)])
+
+'''
+Fits both hypotheses of a (group, individual) pair in one job, reusing the
+continuity=False fit for the continuity=True one where it can. Continuity is
+the unrestricted model with t2 = 0, so wherever the unrestricted optimum
+already has t2 at its lower bound it is also the restricted optimum and is
+reused as is (t1 and errors kept, t2 dropped). The other populations are fit
+again from scratch with continuity=True. Unrestricted fits rarely end with
+t2 at the bound, and the two hypotheses then run one after the other in a
+single job, so fitHypothesis() jobs are usually faster.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set), or a virtual sample set (see combinePair())
+cores: number of cores Schraiber's optimizer may use for this job
+cacheDir: Optional folder for parsed data (see parsePair())
+t2Tolerance: largest t2 that still counts as being at the bound
+snpFilter: Optional compiled SNP filter (see SnpFilter.compileFilter())
+
+return: list holding the continuity=False and continuity=True
+        (group, individual, continuity, populations, optimizer output)
+'''
+def fitPair(group, individual, cores, cacheDir = None, t2Tolerance = 1e-8, snpFilter = None):
+
+    unique_pops, freqs, read_lists = readPair(group, individual, cacheDir, snpFilter)
+    kept, freqs, read_lists = informativeSites(freqs, read_lists, f"{group}_{pairName(individual)}", True)
+    unique_pops = [unique_pops[pop] for pop in kept]
+
+    with Instrument.timedStage("fit", report = False):
+        opts_cont_false = a_g.optimize_pop_params_error_parallel(freqs,read_lists,cores,continuity=False)
+
+    opts_cont_true = [None] * len(opts_cont_false)
+    refit = [] # populations whose unrestricted t2 isn't at 0
+
+    for i in range(len(opts_cont_false)):
+
+        params, negLikelihood, info = opts_cont_false[i][:3]
+
+        if (params[1] <= t2Tolerance): # same optimum, no need to fit again
+            opts_cont_true[i] = (np.concatenate(([params[0]], params[2:])), negLikelihood, {"warm_start": True, "nit": 0, "funcalls": 0})
+        else:
+            refit.append(i)
+
+    if (len(refit) > 0):
+        with Instrument.timedStage("fit", report = False):
+            refitOpts = a_g.optimize_pop_params_error_parallel([freqs[i] for i in refit],[read_lists[i] for i in refit],cores,continuity=True)
+
+        for i in range(len(refit)):
+            opts_cont_true[refit[i]] = refitOpts[i]
+
+    name = pairName(individual)
+
+    return([(group, name, False, unique_pops, opts_cont_false), (group, name, True, unique_pops, opts_cont_true)])
+
+'''
+Likelihood ratio test of continuity for each population of a pair.
+
+opts_cont_false: optimizer output with continuity=False
+opts_cont_true: optimizer output with continuity=True
+
+return: numpy arrays of log likelihoods with continuity false and true,
+        LRT, and LOG p values, one element per population
+'''
+def likelihoodRatio(opts_cont_false, opts_cont_true):
+
+    likelihood_false = np.array([-x[1] for x in opts_cont_false]) #minus sign is because scipy.optimize minimizes the negative log likelihood
+    likelihood_true = np.array([-x[1] for x in opts_cont_true])
+    LRT = 2*(likelihood_false - likelihood_true)
+    p_vals = scipy.stats.chi2.logsf(LRT,1) #returns the LOG p-values
+
+    return(likelihood_false, likelihood_true, LRT, p_vals)
+
+'''
+Gets an iteration or function call count from the info dictionary
+scipy's fmin_l_bfgs_b gives as the last part of an optimizer output.
+
+opt: optimizer output for one population
+key: "nit" for iterations or "funcalls" for function evaluations
+
+return: the count, or None if the optimizer didn't give one
+'''
+def optimizerCount(opt, key):
+
+    if (len(opt) < 3 or not isinstance(opt[2], dict) or key not in opt[2]):
+        return(None)
+
+    return(int(opt[2][key]))
+
+'''
+Makes machine readable result records for a (group, individual) pair,
+one per population in the pair's .ind file. Field names match the
+columns of CleanResults.createCSV(). p is the LOG p value.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set)
+unique_pops: populations in the pair's .ind file
+opts_cont_false: optimizer output with continuity=False
+opts_cont_true: optimizer output with continuity=True
+
+return: list of dictionaries
+'''
+def resultRecords(group, individual, unique_pops, opts_cont_false, opts_cont_true):
+
+    likelihood_false, likelihood_true, LRT, p_vals = likelihoodRatio(opts_cont_false, opts_cont_true)
+    records = []
+
+    for i in range(len(opts_cont_false)):
+
+        params_false = opts_cont_false[i][0] # t1 | t2 | error_ind1 | error_ind2 | ...
+        params_true = opts_cont_true[i][0] # t1 | error_ind1 | error_ind2 | ...
+
+        records.append({"population": group,
+                        "individual": individual,
+                        "ancient_population": str(unique_pops[i]),
+                        "continuity_false_t1": float(params_false[0]),
+                        "continuity_false_t2": float(params_false[1]),
+                        "continuity_false_error": [float(error) for error in params_false[2:]],
+                        "continuity_false_likelihood": float(likelihood_false[i]),
+                        "continuity_true_t1": float(params_true[0]),
+                        "continuity_true_t2": 0.0,
+                        "continuity_true_error": [float(error) for error in params_true[1:]],
+                        "continuity_true_likelihood": float(likelihood_true[i]),
+                        "LRT": float(LRT[i]),
+                        "p": float(p_vals[i]),
+                        "continuity_false_iterations": optimizerCount(opts_cont_false[i], "nit"),
+                        "continuity_false_function_calls": optimizerCount(opts_cont_false[i], "funcalls"),
+                        "continuity_true_iterations": optimizerCount(opts_cont_true[i], "nit"),
+                        "continuity_true_function_calls": optimizerCount(opts_cont_true[i], "funcalls"),
+                        "continuity_true_warm_start": len(opts_cont_true[i]) > 2 and bool(opts_cont_true[i][2].get("warm_start", False))})
+
+    return(records)
+
+'''
+Prints the results of a (group, individual) pair once both hypotheses
+have been fit. CleanResults.createCSV() reads this format.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set)
+opts_cont_false: optimizer output with continuity=False
+opts_cont_true: optimizer output with continuity=True
+'''
+def printResults(group, individual, opts_cont_false, opts_cont_true):
+
+    print(opts_cont_false)
+    print(opts_cont_true)
+    likelihood_false, likelihood_true, LRT, p_vals = likelihoodRatio(opts_cont_false, opts_cont_true)
+
+    print("1k genomes group: " + group)
+    print("Ancient Individual: " + individual)
+    print("t1 continuity false:")
+    print(opts_cont_false[0][0])
+    print("t2 continuity false: ")
+    print(opts_cont_false[0][1])
+    print("continuity false error: ")
+    for error in opts_cont_false[2:]:
+        print(error)
+    print("t1 continuity true: ")
+    print( opts_cont_true[0][0])
+    print("t2 continuity true:")
+    print("0")
+    print("continuity true error: ")
+    for error in opts_cont_true[1:]:
+        print(error)
+    print("LRT: ")
+    print(LRT)
+    print("P values: ")
+    print(p_vals)
+    print('', flush = True)
+
+'''
+Runs the whole grid of (modern population, ancient individual) pairs.
+Both hypotheses of every pair go into one job queue over a process pool,
+so small pairs don't leave cores idle while waiting on big ones. Results
+for a pair are printed as soon as both of its fits are done.
+If resultsFile is given, a JSON line per (group, individual, population)
+is also written there as it completes (see resultRecords()).
+
+groups: list of 1k genomes groups
+individuals: list of ancient individuals (or "ind1_ind2_..." sample sets).
+             A list in place of a name is a virtual sample set built in
+             memory from its members' pairs (see combinePair()), results
+             go under its pairName().
+totalCores: number of cores to use for the whole grid
+coresPerJob: cores given to Schraiber's optimizer for each fit. Jobs in
+             flight is totalCores // coresPerJob. The optimizer only
+             splits work by population in the .ind file, so 1 is best
+             unless sample sets hold several populations.
+resultsFile: Optional .jsonl file for result records. WILL OVERWRITE.
+cacheDir: Optional folder for parsed .reads/.ind data. Every pair (every
+          member's pair for virtual sample sets) is parsed into it first
+          so both hypotheses load from the cache.
+warmStart: if True each pair is one job that reuses the continuity=False
+           fit for populations with t2 at its bound (see fitPair()).
+           Off by default since the hypotheses then can't run in
+           parallel.
+pairs: Optional list of (group, individual) pairs to run instead of
+       every group with every individual
+recordsDir: Optional folder to also write each pair's records to its
+            own group_individual.jsonl file
+snpFilter: Optional SNP filter compiled with SnpFilter.compileFilter()
+           (ex: transversions only, no X). Only the SNPs it keeps are
+           fit, without new .reads files.
+'''
+def runContinuityGrid(groups, individuals, totalCores = 48, coresPerJob = 1, resultsFile = None, cacheDir = None, warmStart = False, pairs = None, recordsDir = None, snpFilter = None):
+
+    jobsInFlight = max(1, totalCores // coresPerJob)
+    fits = {} # (group, individual) -> {continuity: opts}
+    recordFile = None
+
+    if (resultsFile != None):
+        recordFile = open(resultsFile, 'w')
+
+    if (pairs == None):
+        pairs = [(group, individual) for group in groups for individual in individuals]
+
+    if (recordsDir != None):
+        os.makedirs(recordsDir, exist_ok = True)
+
+    pairsDone = 0
+
+    # the pool is shut down inside the timer so the fits' CPU time is counted
+    with Instrument.timedStage("continuity", len(pairs), "pairs") as timer, ProcessPoolExecutor(max_workers = jobsInFlight) as pool:
+
+        jobs = []
+
+        if (cacheDir != None): # fill the cache before the fits start reading it
+            parsePairs = []
+
+            for group, individual in pairs:
+                for each in ([individual] if isinstance(individual, str) else setMembers(individual)):
+                    if ((group, each) not in parsePairs): # members are shared by virtual sample sets
+                        parsePairs.append((group, each))
+
+            with Instrument.timedStage("parseCache", len(parsePairs), "pairs") as parseTimer:
+
+                parseJobs = [pool.submit(parsePair, group, individual, cacheDir, snpFilter) for group, individual in parsePairs]
+
+                for job in as_completed(parseJobs):
+                    job.result()
+                    Instrument.progress(parseTimer, parseTimer["done"] + 1)
+
+        for group, individual in pairs:
+
+            if (warmStart): # the second fit needs the first, so they share a job
+                jobs.append(pool.submit(fitPair, group, individual, coresPerJob, cacheDir, snpFilter = snpFilter))
+                continue
+
+            for continuity in (False, True):
+                jobs.append(pool.submit(fitHypothesis, group, individual, continuity, coresPerJob, cacheDir, snpFilter))
+
+        for job in as_completed(jobs):
+
+            for group, individual, continuity, unique_pops, opts in job.result():
+
+                pairFits = fits.setdefault((group, individual), {})
+                pairFits[continuity] = opts
+
+                if (len(pairFits) == 2): # both hypotheses done
+
+                    if (len(unique_pops) > 0):
+                        printResults(group, individual, pairFits[False], pairFits[True])
+                    else: # no population had SNPs with reads (see informativeSites())
+                        Instrument.logEvent("skipped", "continuity", pair = f"{group}_{individual}", reason = "no SNPs with reads")
+
+                    records = resultRecords(group, individual, unique_pops, pairFits[False], pairFits[True])
+
+                    if (recordFile != None):
+                        for record in records:
+                            recordFile.write(f"{json.dumps(record)}\n")
+                        recordFile.flush() # records are usable while the grid is still running
+
+                    if (recordsDir != None): # written whole then renamed so it only exists once complete
+                        pairFile = os.path.join(recordsDir, f"{group}_{individual}.jsonl")
+                        tempFile = open(f"{pairFile}.tmp", 'w')
+                        tempFile.writelines([f"{json.dumps(record)}\n" for record in records])
+                        tempFile.close()
+                        os.replace(f"{pairFile}.tmp", pairFile)
+
+                    del fits[(group, individual)]
+                    pairsDone += 1
+                    Instrument.progress(timer, pairsDone)
+
+    if (recordFile != None):
+        recordFile.close()
+
+'''
+Assigns every SNP row of a pair's .reads file to a genomic block of
+blockLength bases on its chromosome.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set), or a virtual sample set (see combinePair())
+blockLength: block size in bases
+snpFilter: Optional compiled SNP filter, only the rows it keeps get a block
+
+return: numpy array of block numbers (0 to # blocks - 1), one per .reads row
+'''
+def snpBlocks(group, individual, blockLength = 5000000, snpFilter = None):
+
+    if (not isinstance(individual, str)): # members all have the same rows
+        individual = setMembers(individual)[0]
+
+    readsFileName = "reads/" + group + '_' + individual + ".reads"
+
+    if (not os.path.exists(readsFileName) and os.path.isdir(f"{readsFileName}.store")):
+        header, chroms, positions, freqs, counts = ReadStore.readStore(f"{readsFileName}.store")
+        chroms = chroms.astype(str)
+    else:
+        chroms = []
+        positions = []
+        readsFile = open(readsFileName, 'r')
+        readsFile.readline() # skip header
+
+        for line in readsFile:
+            chrom, pos = line.split(None, 2)[:2]
+            chroms.append(chrom)
+            positions.append(int(pos))
+
+        readsFile.close()
+        chroms = np.array(chroms, dtype = str)
+        positions = np.array(positions, dtype = np.int64)
+
+    if (snpFilter != None and snpFilter["maskFile"] != None): # same rows parsePair() gives the parser
+        keep = SnpFilter.rowMask(SnpFilter.loadMask(snpFilter["maskFile"]), chroms, positions)
+        chroms = chroms[keep]
+        positions = positions[keep]
+
+    blockKeys = list(zip(chroms.tolist(), (positions // blockLength).tolist()))
+
+    blocks = []
+    blockNumbers = {}
+
+    for key in blockKeys: # blocks numbered in file order
+        blocks.append(blockNumbers.setdefault(key, len(blockNumbers)))
+
+    return(np.array(blocks, dtype = np.intp))
+
+'''
+Picks the SNP rows of one resampling replicate.
+
+blocks: block number of each SNP from snpBlocks()
+snpCount: number of SNPs in the population's freqs, must be the
+          number of rows blocks has
+method: "jackknife" or "bootstrap"
+sampledBlocks: jackknife: list holding the block to leave out.
+               bootstrap: list of blocks drawn with replacement.
+               None for the full data.
+
+return: numpy array of row indices into freqs and read_lists
+'''
+def replicateRows(blocks, snpCount, method, sampledBlocks):
+
+    if (len(blocks) != snpCount): # SNPs would get another row's block
+        raise ValueError(f"{snpCount} SNPs were parsed but snpBlocks() found {len(blocks)} .reads rows")
+
+    if (sampledBlocks == None):
+        return(np.arange(snpCount))
+
+    if (method == "jackknife"):
+        return(np.flatnonzero(blocks != sampledBlocks[0]))
+
+    # rows of each drawn block, one copy per draw
+    return(np.concatenate([np.flatnonzero(blocks == block) for block in sampledBlocks] + [np.zeros(0, dtype = np.intp)]))
+
+'''
+Fits both hypotheses on one resampling replicate of a pair. This is a
+single job of runResampling() and runs in its own process.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set), or a virtual sample set (see combinePair())
+method: "jackknife" or "bootstrap"
+replicate: replicate number, -1 for the full data
+sampledBlocks: blocks of the replicate (see replicateRows())
+cores: number of cores Schraiber's optimizer may use for this job
+cacheDir: Optional folder for parsed data (see parsePair())
+blocks: block number of each SNP from snpBlocks(), made once per pair
+        so replicates don't read the .reads table again
+snpFilter: Optional compiled SNP filter (see SnpFilter.compileFilter())
+
+return: (group, individual, replicate, list of [continuity false t1,
+        continuity false t2, continuity true t1, LRT] for each population)
+'''
+def fitReplicate(group, individual, method, replicate, sampledBlocks, cores, cacheDir, blocks, snpFilter = None):
+
+    unique_pops, freqs, read_lists = readPair(group, individual, cacheDir, snpFilter)
+
+    for pop in range(len(freqs)):
+        rows = replicateRows(blocks, len(freqs[pop]), method, sampledBlocks)
+        freqs[pop] = np.asarray(freqs[pop])[rows]
+        read_lists[pop] = [np.asarray(reads)[rows] for reads in read_lists[pop]]
+
+    # after resampling, bootstrap replicates repeat rows and a dropped row is dropped every time
+    kept, freqs, read_lists = informativeSites(freqs, read_lists, f"{group}_{pairName(individual)}", replicate == -1)
+
+    with Instrument.timedStage("fit", report = False):
+        opts_cont_false = a_g.optimize_pop_params_error_parallel(freqs,read_lists,cores,continuity=False)
+        opts_cont_true = a_g.optimize_pop_params_error_parallel(freqs,read_lists,cores,continuity=True)
+
+    likelihood_false, likelihood_true, LRT, p_vals = likelihoodRatio(opts_cont_false, opts_cont_true)
+    stats = [[float("nan")] * 4 for pop in unique_pops] # a population with no SNPs in this replicate wasn't fit
+
+    for i in range(len(opts_cont_false)):
+        stats[kept[i]] = [float(opts_cont_false[i][0][0]), float(opts_cont_false[i][0][1]), float(opts_cont_true[i][0][0]), float(LRT[i])]
+
+    return(group, pairName(individual), replicate, stats)
+
+'''
+Standard error and 95% confidence interval of a statistic from its
+resampling replicates. Jackknife uses the delete-one block jackknife
+variance and a normal interval. Bootstrap uses the replicate standard
+deviation and a percentile interval.
+
+estimate: statistic on the full data
+replicates: numpy array of the statistic on each replicate
+method: "jackknife" or "bootstrap"
+
+return: (standard error, CI low, CI high)
+'''
+def resamplingInterval(estimate, replicates, method):
+
+    if (len(replicates) < 2):
+        return(float("nan"), float("nan"), float("nan"))
+
+    if (method == "jackknife"):
+        blockCount = len(replicates)
+        se = np.sqrt((blockCount - 1) / blockCount * np.sum((replicates - replicates.mean()) ** 2))
+        return(float(se), float(estimate - 1.959964 * se), float(estimate + 1.959964 * se))
+
+    low, high = np.percentile(replicates, [2.5, 97.5])
+
+    return(float(np.std(replicates, ddof = 1)), float(low), float(high))
+
+'''
+Prints the resampling results of a pair and writes them as JSON lines
+if recordFile is open.
+
+group: 1k genomes group
+individual: ancient individual (or "ind1_ind2_..." sample set)
+method: "jackknife" or "bootstrap"
+pairStats: dictionary of replicate number -> stats from fitReplicate(),
+           -1 is the full data
+replicates: number of replicates
+recordFile: open .jsonl file or None
+'''
+def reportResampling(group, individual, method, pairStats, replicates, recordFile):
+
+    statNames = ["continuity_false_t1", "continuity_false_t2", "continuity_true_t1", "LRT"]
+    full = pairStats[-1]
+    replicateStats = np.array([pairStats[replicate] for replicate in range(replicates)]).reshape(replicates, len(full), len(statNames))
+
+    for pop in range(len(full)):
+
+        record = {"population": group, "individual": individual, "ancient_population_index": pop,
+                  "method": method, "replicates": replicates}
 
         print("1k genomes group: " + group)
         print("Ancient Individual: " + individual)
-        print("t1 continuity false:")
-        print(opts_cont_false[0][0])
-        print("t2 continuity false: ")
-        print(opts_cont_false[0][1])
-        print("continuity false error: ")
-        for error in opts_cont_false[2:]:
-            print(error)
-        print("t1 continuity true: ")
-        print( opts_cont_true[0][0])
-        print("t2 continuity true:")
-        print("0")
-        print("continuity true error: ")
-        for error in opts_cont_true[1:]:
-            print(error)
-        print("LRT: ")
-        print(LRT)
-        print("P values: ")
-        print(p_vals)
-        print('')
+        print(f"{method} replicates: {replicates}")
+
+        for stat in range(len(statNames)):
+            se, low, high = resamplingInterval(full[pop][stat], replicateStats[:, pop, stat], method)
+            record[statNames[stat]] = full[pop][stat]
+            record[f"{statNames[stat]}_se"] = se
+            record[f"{statNames[stat]}_ci"] = [low, high]
+            print(f"{statNames[stat]}: {full[pop][stat]} SE: {se} 95% CI: [{low}, {high}]")
+
+        print('', flush = True)
+
+        if (recordFile != None):
+            recordFile.write(f"{json.dumps(record)}\n")
+            recordFile.flush()
+
+'''
+Block jackknife or bootstrap standard errors and confidence intervals for
+t1, t2 and the LRT of every (group, individual) pair. SNPs are grouped into
+genomic blocks (see snpBlocks()) and each replicate is one job on a process
+pool. Every finished replicate is appended to a checkpoint file per pair, so
+rerunning with the same checkpointDir only fits the missing replicates. The
+first line of a checkpoint file holds the settings and a hash of the pair's
+files it was made with, and a rerun with different ones raises a ValueError
+instead of mixing in replicates of other data.
+Results print as each pair finishes, and are written as JSON lines if
+resultsFile is given.
+
+groups: list of 1k genomes groups
+individuals: list of ancient individuals (or "ind1_ind2_..." sample sets),
+             lists for virtual sample sets (see runContinuityGrid())
+method: "jackknife" (one replicate per block) or "bootstrap"
+replicates: number of bootstrap replicates. Ignored for jackknife.
+blockLength: block size in bases
+totalCores: number of cores to use
+coresPerJob: cores given to Schraiber's optimizer for each replicate
+cacheDir: Optional folder for parsed .reads/.ind data (see parsePair())
+checkpointDir: folder for replicate checkpoints
+resultsFile: Optional .jsonl file for resampling records. WILL OVERWRITE.
+seed: seed for drawing bootstrap blocks
+snpFilter: Optional compiled SNP filter (see runContinuityGrid())
+'''
+def runResampling(groups, individuals, method = "jackknife", replicates = 100, blockLength = 5000000, totalCores = 48, coresPerJob = 1, cacheDir = None, checkpointDir = "resampling", resultsFile = None, seed = 0, snpFilter = None):
+
+    os.makedirs(checkpointDir, exist_ok = True)
+    jobsInFlight = max(1, totalCores // coresPerJob)
+    pairStats = {} # (group, individual) -> {replicate: stats}
+    pairReplicates = {} # (group, individual) -> sampled blocks of each replicate
+    pairBlocks = {} # (group, individual) -> block of each SNP
+    checkpointFiles = {}
+    recordFile = None
+
+    # checkpoints are all checked before any fit starts
+    for group in groups:
+        for individual in individuals:
+
+            key = (group, pairName(individual))
+            pairStats[key] = {}
+            checkpointFile = os.path.join(checkpointDir, f"{group}_{pairName(individual)}.{method}.jsonl")
+            # what the replicates depend on, seed and replicates only matter for bootstrap
+            settings = {"method": method, "blockLength": blockLength,
+                        "replicates": replicates if method == "bootstrap" else None,
+                        "seed": seed if method == "bootstrap" else None,
+                        "snpFilter": snpFilter, "inputs": hashFiles(pairFiles(group, individual))}
+
+            if (os.path.exists(checkpointFile) and os.path.getsize(checkpointFile) > 0): # replicates from an earlier run
+                file = open(checkpointFile, 'r')
+                header = json.loads(file.readline())
+
+                if (header.get("settings") != json.loads(json.dumps(settings))):
+                    file.close()
+                    raise ValueError(f"{checkpointFile} was made with other settings or input files, remove it or use another checkpointDir")
+
+                for line in file:
+                    if (line.strip()):
+                        done = json.loads(line)
+                        pairStats[key][done["replicate"]] = done["stats"]
+
+                file.close()
+                checkpointFiles[key] = open(checkpointFile, 'a')
+            else:
+                checkpointFiles[key] = open(checkpointFile, 'w')
+                checkpointFiles[key].write(f"{json.dumps({'settings': settings})}\n")
+                checkpointFiles[key].flush()
+
+            pairBlocks[key] = snpBlocks(group, individual, blockLength, snpFilter)
+            blockCount = int(pairBlocks[key].max(initial = -1)) + 1
+
+            if (method == "jackknife"):
+                pairReplicates[key] = [[block] for block in range(blockCount)]
+            else:
+                # each replicate gets its own generator so reruns draw the same blocks
+                pairReplicates[key] = [np.random.default_rng([seed, replicate]).integers(0, blockCount, blockCount).tolist() for replicate in range(replicates)]
+
+    if (resultsFile != None):
+        recordFile = open(resultsFile, 'w')
+
+    # the pool is shut down inside the timer so the fits' CPU time is counted
+    with Instrument.timedStage("resampling", unit = "replicates") as timer, ProcessPoolExecutor(max_workers = jobsInFlight) as pool:
+
+        jobs = []
+
+        for group in groups:
+            for individual in individuals:
+
+                key = (group, pairName(individual))
+
+                if (-1 not in pairStats[key]): # full data
+                    jobs.append(pool.submit(fitReplicate, group, individual, method, -1, None, coresPerJob, cacheDir, pairBlocks[key], snpFilter))
+
+                for replicate in range(len(pairReplicates[key])):
+                    if (replicate not in pairStats[key]):
+                        jobs.append(pool.submit(fitReplicate, group, individual, method, replicate, pairReplicates[key][replicate], coresPerJob, cacheDir, pairBlocks[key], snpFilter))
+
+        for key in pairStats: # pairs finished in an earlier run
+            if (len(pairStats[key]) == len(pairReplicates[key]) + 1):
+                reportResampling(key[0], key[1], method, pairStats[key], len(pairReplicates[key]), recordFile)
+
+        timer["total"] = len(jobs)
+        replicatesDone = 0
+
+        for job in as_completed(jobs):
+
+            group, individual, replicate, stats = job.result()
+            key = (group, individual)
+            pairStats[key][replicate] = stats
+            checkpointFiles[key].write(f"{json.dumps({'replicate': replicate, 'stats': stats})}\n")
+            checkpointFiles[key].flush()
+            replicatesDone += 1
+            Instrument.progress(timer, replicatesDone)
+
+            if (len(pairStats[key]) == len(pairReplicates[key]) + 1): # full data and every replicate done
+                reportResampling(group, individual, method, pairStats[key], len(pairReplicates[key]), recordFile)
+
+    for key in checkpointFiles:
+        checkpointFiles[key].close()
+
+    if (recordFile != None):
+        recordFile.close()
+
+#############################
+#
+# Main
+#
+#############################
+
+# guard keeps process pool workers from re-running the main block
+if __name__ == "__main__":
+
+    modern_pops = ["CHB", "CHS", "CDX", "JPT", "KHV", "CEU"]
+    '''
+    ancient_Individuals = ["HRR051935", "HRR051936", "HRR051937",\
+                          "HRR051938", "HRR051939", "HRR051940",\
+                          "HRR051941", "HRR051942", "HRR051943",\
+                          "HRR051944", "HRR051945", "HRR051946",\
+                          "HRR051947", "HRR051948", "HRR051949",\
+                          "HRR051950", "HRR051951", "HRR051952",\
+                          "HRR051954", "HRR051955",\
+                          "HRR051956", "HRR051958",\
+                          "HRR051959", "HRR051960"]
+    '''
+    '''
+    ancient_Individuals = ["HRR051935", "HRR051936", "HRR051937",
+                            "HRR051938_HRR051939_HRR051940", "HRR051941",
+                            "HRR051942", "HRR051943_HRR051944",
+                            "HRR051945_HRR051946",
+                            "HRR051947_HRR051948_HRR051949_HRR051950_HRR051951_HRR051952_HRR051954",
+                            "HRR051955_HRR051956_HRR051958_HRR051959",
+                            "HRR051960"]
+    '''
+    ancient_Individuals = ["HRR051935", "HRR051936", "HRR051937",
+                            "HRR051938_HRR051939_HRR051940", "HRR051941",
+                            "HRR051942", "HRR051943_HRR051944",
+                            "HRR051945",
+                            "HRR051947_HRR051948_HRR051949_HRR051950",
+                            "HRR051955_HRR051956_HRR051958",
+                            "HRR051960"]
+    '''
+    modern_pops = ["KHV", "CEU"]
+    ancient_Individuals = ["HRR051935"]
+    '''
+
+    totalCores = 48 # cores for the whole grid
+    coresPerJob = 1 # cores for each fit, jobs in flight is totalCores // coresPerJob
+
+    resultsFile = "continuity.jsonl" # one JSON record per (group, individual, population)
+    cacheDir = "cache" # parsed .reads/.ind data, reused while the files are unchanged
+    warmStart = False # True reuses continuity=False fits with t2 at 0 (see fitPair())
+
+    runContinuityGrid(modern_pops, ancient_Individuals, totalCores, coresPerJob, resultsFile, cacheDir, warmStart)
+
+    '''
+    # block jackknife standard errors and CIs for t1, t2 and LRT
+    runResampling(modern_pops, ancient_Individuals, "jackknife", totalCores = totalCores, coresPerJob = coresPerJob, cacheDir = cacheDir, resultsFile = "resampling.jsonl")
+    '''
 
+    '''
+    # transversions off the X and Y only, from the same .reads files
+    snpFilter = SnpFilter.compileFilter({"excludeChromosomes": ["X", "Y"], "mutations": "transversions"}, "v42.4.1240K.EG.snp", cacheDir)
+    runContinuityGrid(modern_pops, ancient_Individuals, totalCores, coresPerJob, "continuity_transversions.jsonl", cacheDir, warmStart, snpFilter = snpFilter)
+    '''